@@ -11,55 +11,229 @@ WARNING: This answers to any both unread and unanswered mail, even if it is year
 
 Simply instantiate a ``AutoReplier`` and call the ``run`` method on an instance. Use a loop to run continuously the run method or use a cron task to execute the script.
 Use (using Ctrl+C, typically) to stop the loop or until an error occurs, like a network failure.
+The modules asyncio and http.server are only imported when the pipeline or the metrics server are used, to keep the one-shot mode fast.
 """
+from __future__ import annotations
 import base64
+import copy
+import errno
+import heapq
+import math
 import os
 import socket
 import pathlib
+import random
 import traceback
 import logging
 import sqlite3
 import threading
+import zlib
 import atexit
 import signal
 import re
+import select
+import ssl
 import sys
 import time
 import locale
 import datetime
-import html
+import email.policy
 import xml.etree.ElementTree as etree
+from collections import OrderedDict
+from collections.abc import Callable, Iterable, Iterator
 from enum import Enum
 from email import message_from_bytes, message
+from email.feedparser import BytesFeedParser
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import make_msgid
-from imaplib import IMAP4, IMAP4_SSL, ParseFlags
-from logging.handlers import RotatingFileHandler
-from smtplib import SMTP, SMTP_SSL
+from imaplib import IMAP4, IMAP4_SSL
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import SimpleQueue
+from smtplib import SMTP, SMTP_SSL, SMTPException, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
 from textwrap import dedent
 from time import sleep
 from io import StringIO
 from html.parser import HTMLParser
+from typing import TYPE_CHECKING, TextIO
 # not working with 3.9.2 on Debian from polyglot.detect import Detector
 
 __author__ = 'David Rolland, contact@infodavid.org, based on script written by Bertrand Bordage'
 __copyright__ = 'Copyright © 2022 David Rolland'
 __license__ = 'MIT'
 
+if TYPE_CHECKING:
+    import asyncio
+    import concurrent.futures
+    from http.server import ThreadingHTTPServer
+    from mailbox import Mailbox
+
 IMAP4_PORT: int = 143
 SMTP_PORT: int = 25
+SMTP_MAX_IDLE: int = 60
+SMTP_TIMEOUT: float = 60.0  # Timeout in seconds of the operations on the SMTP socket
+SMTP_RATE: float = 1.0
+SMTP_BURST: int = 10
+SMTP_SEND_ATTEMPTS: int = 5
+SMTP_WORKERS: int = 2
+IMAP_RATE: float = 20.0
+IMAP_BURST: int = 50
+IMAP_ATTEMPTS: int = 5
+IMAP_TIMEOUT: float = 60.0  # Timeout in seconds of the operations on the IMAP socket
+IMAP_NOOP_INTERVAL: int = 300  # Delay in seconds after which an unused IMAP connection is checked using NOOP
+RECONNECT_DELAY: float = 1.0  # Delay in seconds before the second attempt to connect, doubled after each failure
+RECONNECT_MAX_DELAY: float = 300.0  # Maximum delay in seconds between two attempts to connect
+RECONNECT_ERRNOS: frozenset = frozenset((errno.ENETUNREACH, errno.ENETDOWN, errno.ENETRESET, errno.EHOSTUNREACH, errno.EHOSTDOWN))
+IMAP_THROTTLING_PATTERN: re.Pattern = re.compile(rb'\[(THROTTLED|LIMIT|UNAVAILABLE)\]|throttl', re.IGNORECASE)
+TOKEN_BUCKET_MAX_SLOWDOWN: int = 64  # Maximum ratio between the nominal rate and the reduced one
+TOKEN_BUCKET_RECOVERY: float = 1.25  # Ratio applied to the reduced rate after each successful operation
 DEFAULT_LANGUAGE: str = 'en'
 DEFAULT_KEY: str = 'default'
 IMAP_DATE_FORMAT: str = "%d-%b-%Y"
 AUTOREPLIED_FLAG: str = 'AUTOREPLIED'
+IMAP_BATCH_SIZE: int = 50
+IMAP_STORE_BATCH_SIZE: int = 1000  # Maximum number of messages flagged by a single UID STORE command
+PIPELINE_QUEUE_SIZE: int = 100
+SHARD_MIN_SIZE: int = 1000  # Minimum number of messages found by a search to split them between the worker processes
+BLOCK_CACHE_SIZE: int = 10000
+RELOAD_INTERVAL: int = 5  # Delay in seconds between two checks of the modification of the configuration file
+LOG_DETAIL_RATIO: float = 1.0  # Ratio of the messages whose processing is detailed in the logs
+MAINTENANCE_INTERVAL: int = 3600  # Delay in seconds between two maintenances of the database
+STORE_PURGE_BATCH_SIZE: int = 1000  # Maximum number of rows deleted by a single transaction
+STORE_VACUUM_PAGES: int = 1000  # Maximum number of free pages released by a single incremental vacuum
+SKIP_RULES_CHUNK_SIZE: int = 200  # Number of regular expressions merged in a single one
+SKIP_RULES_SPECIAL_CHARS: frozenset = frozenset('\\^$*+?()[]{}|')
+SKIP_RULES_PREFIX_LENGTH: int = 3  # Length of the literal prefixes used to index the regular expressions
+SKIP_RULES_BACKREFERENCE_PATTERN: re.Pattern = re.compile(r'\\\d|\(\?P=')
+IMAP_BODY_MAX_SIZE: int = 16384
+IMAP_IDLE_TIMEOUT: int = 28 * 60  # Servers may drop the IDLE command after 29 minutes
+IMAP_IDLE_TAG: bytes = b'IDLE0'
+IMAP_IDLE_PATTERN: re.Pattern = re.compile(rb'^\* \d+ (EXISTS|RECENT)')
+IMAP_SETTINGS: tuple[str, ...] = ('imap_server', 'imap_port', 'imap_use_ssl', 'imap_user', 'imap_password', 'imap_timeout')  # Settings requiring a new IMAP connection
+SMTP_SETTINGS: tuple[str, ...] = ('smtp_server', 'smtp_port', 'smtp_use_ssl', 'smtp_user', 'smtp_password', 'smtp_timeout')  # Settings requiring new SMTP connections
+IMAP_STATUS_PATTERN: re.Pattern = re.compile(rb'(UIDNEXT|UIDVALIDITY) (\d+)')
+IMAP_HEADER_FIELDS: str = 'FROM REPLY-TO TO SUBJECT MESSAGE-ID CONTENT-LANGUAGE CONTENT-TYPE CONTENT-TRANSFER-ENCODING MIME-VERSION'
+METRICS_ADDRESS: str = '127.0.0.1'
+METRICS_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Upper bounds in seconds
+METRIC_SEARCHED: str = 'autoreplier_messages_searched_total'
+METRIC_SKIPPED: str = 'autoreplier_messages_skipped_total'
+METRIC_REPLIED: str = 'autoreplier_messages_replied_total'
+METRIC_FAILED: str = 'autoreplier_messages_failed_total'
+METRIC_STAGE: str = 'autoreplier_stage_seconds'
+METRIC_CYCLE: str = 'autoreplier_cycle_seconds'
+METRIC_REFRESH_DELAY: str = 'autoreplier_refresh_delay_seconds'
+METRIC_BACKLOG: str = 'autoreplier_backlog_messages'
+METRIC_STORE_ROWS: str = 'autoreplier_store_rows'
+METRIC_STORE_BYTES: str = 'autoreplier_store_bytes'
+METRIC_STORE_PURGED: str = 'autoreplier_store_purged_total'
+METRIC_RECONNECTIONS: str = 'autoreplier_reconnections_total'
+# Types and descriptions of the metrics
+METRICS_TYPES: dict[str, str] = {
+    METRIC_SEARCHED: 'counter',
+    METRIC_SKIPPED: 'counter',
+    METRIC_REPLIED: 'counter',
+    METRIC_FAILED: 'counter',
+    METRIC_STAGE: 'histogram',
+    METRIC_CYCLE: 'gauge',
+    METRIC_REFRESH_DELAY: 'gauge',
+    METRIC_BACKLOG: 'gauge',
+    METRIC_STORE_ROWS: 'gauge',
+    METRIC_STORE_BYTES: 'gauge',
+    METRIC_STORE_PURGED: 'counter',
+    METRIC_RECONNECTIONS: 'counter'
+}
+METRICS_HELP: dict[str, str] = {
+    METRIC_SEARCHED: 'Number of messages found by the searches',
+    METRIC_SKIPPED: 'Number of messages skipped by reason (address, domain, subject, block or flagged)',
+    METRIC_REPLIED: 'Number of replies sent',
+    METRIC_FAILED: 'Number of replies which cannot be created or sent',
+    METRIC_STAGE: 'Duration of the operations by stage (search, fetch, store, lookup, render, send and maintenance)',
+    METRIC_CYCLE: 'Duration of the last check',
+    METRIC_REFRESH_DELAY: 'Delay between two checks',
+    METRIC_BACKLOG: 'Number of messages found by the last search and not yet processed',
+    METRIC_STORE_ROWS: 'Number of addresses in the database after the last maintenance',
+    METRIC_STORE_BYTES: 'Size of the database after the last maintenance',
+    METRIC_STORE_PURGED: 'Number of expired addresses deleted from the database',
+    METRIC_RECONNECTIONS: 'Number of IMAP connections opened again after a transient error'
+}
+FETCH_START_PATTERN: re.Pattern = re.compile(rb'^\s*(\d+) \(')
+FETCH_UID_PATTERN: re.Pattern = re.compile(rb'UID (\d+)')
+FETCH_FLAGS_PATTERN: re.Pattern = re.compile(rb'FLAGS \(([^)]*)\)')
+FETCH_LITERAL_PATTERN: re.Pattern = re.compile(rb'([A-Z0-9.]+(?:\[[^\]]*\])?(?:<\d+>)?) \{\d+\}$')
+LANGUAGE_DETECTION_MAX_SIZE: int = 4096  # Maximum number of characters of the body used to detect the language
+MESSAGE_PARSE_CHUNK_SIZE: int = 8192  # Number of bytes given at once to the parser of the messages
+REPLAY_HEADER_MAX_SIZE: int = 65536  # Maximum number of bytes of the headers parsed by the replay, added to the maximum size of the body
+LANGUAGE_DETECTION_STEP: int = 32  # Number of trigrams read between two checks of the confidence
+LANGUAGE_DETECTION_MARGIN: float = 20.0  # Difference of log-likelihood between the two best languages to stop reading the body
+LANGUAGE_DETECTION_MIN_MARGIN: float = 3.0  # Minimum difference of log-likelihood between the two best languages to return a language
+LANGUAGE_CACHE_SIZE: int = 10000
+LANGUAGE_CACHE_TTL: int = 7 * 24 * 3600
+LANGUAGE_WORD_PATTERN: re.Pattern = re.compile(r'[^\W\d_]+')
+# Samples used to build the profiles of the languages supported by the detector
+LANGUAGE_SAMPLES: dict[str, str] = {
+    'de': 'Vielen Dank für Ihre Nachricht. Ich bin zurzeit nicht im Büro und werde am Montag zurück sein. Während meiner Abwesenheit habe ich nur '
+          'eingeschränkten Zugriff auf meine E-Mails. In dringenden Fällen wenden Sie sich bitte an meinen Kollegen, der Ihnen gerne weiterhilft. '
+          'Könnten Sie mir bitte die Unterlagen bis zum Ende der Woche schicken? Wir möchten wissen, ob die Besprechung auf nächsten Dienstagnachmittag '
+          'verschoben werden kann. Im Anhang finden Sie den Bericht, den Sie gestern angefordert haben. Bitte lassen Sie mich wissen, wenn Sie Fragen '
+          'zur Rechnung oder zur Lieferung der Bestellung haben. Mit freundlichen Grüßen und einen schönen Tag. Das Wetter war an diesem Wochenende '
+          'wirklich schön und wir sind mit den Kindern an den Strand gefahren. Was halten Sie von dem neuen Projekt? Ich rufe Sie an, wenn ich wieder '
+          'da bin. Es gibt noch einige Punkte, die wir gemeinsam besprechen sollten, aber das ist nicht so wichtig. Hallo, wie geht es dir?',
+    'en': 'Thank you for your message. I am currently out of the office and will return on Monday. During my absence I will have limited access '
+          'to my emails. For urgent matters please contact my colleague who will be happy to help you. Could you please send me the documents '
+          'before the end of the week? We would like to know if the meeting can be moved to next Tuesday afternoon. I have attached the report '
+          'that you requested yesterday. Please let me know if you have any questions about the invoice or the delivery of the order. Best regards '
+          'and have a nice day. The weather was really good this weekend and we went to the beach with the children. What do you think about the '
+          'new project? I will call you when I am back. There are still a few points that we should discuss together, but this is not so important. '
+          'Hello, how are you?',
+    'es': 'Gracias por su mensaje. Actualmente estoy fuera de la oficina y volveré el lunes. Durante mi ausencia tendré un acceso limitado a mi '
+          'correo electrónico. Para asuntos urgentes, por favor póngase en contacto con mi compañero, que estará encantado de ayudarle. ¿Podría '
+          'enviarme los documentos antes del final de la semana? Nos gustaría saber si la reunión se puede cambiar al próximo martes por la tarde. '
+          'Le adjunto el informe que me pidió ayer. No dude en decirme si tiene alguna pregunta sobre la factura o la entrega del pedido. Un saludo '
+          'cordial y que tenga un buen día. El tiempo fue muy bueno este fin de semana y fuimos a la playa con los niños. ¿Qué piensa usted del '
+          'nuevo proyecto? Le llamaré cuando vuelva. Todavía hay algunos puntos que deberíamos hablar juntos, pero no es tan importante. Hola, '
+          '¿cómo estás?',
+    'fr': 'Merci pour votre message. Je suis actuellement absent du bureau et je serai de retour lundi. Pendant mon absence, j\'aurai un accès '
+          'limité à mes courriels. Pour toute demande urgente, veuillez contacter mon collègue qui se fera un plaisir de vous aider. Pourriez-vous '
+          'm\'envoyer les documents avant la fin de la semaine ? Nous aimerions savoir si la réunion peut être déplacée à mardi prochain dans '
+          'l\'après-midi. Vous trouverez ci-joint le rapport que vous avez demandé hier. N\'hésitez pas à me contacter si vous avez des questions '
+          'sur la facture ou la livraison de la commande. Bien cordialement et bonne journée. Il faisait très beau ce week-end et nous sommes allés '
+          'à la plage avec les enfants. Que pensez-vous du nouveau projet ? Je vous appellerai à mon retour. Il reste encore quelques points que '
+          'nous devrions aborder ensemble, mais ce n\'est pas très important. Bonjour, comment vas-tu ?',
+    'it': 'Grazie per il suo messaggio. Al momento sono fuori ufficio e tornerò lunedì. Durante la mia assenza avrò un accesso limitato alla posta '
+          'elettronica. Per questioni urgenti la prego di contattare il mio collega, che sarà lieto di aiutarla. Potrebbe inviarmi i documenti '
+          'entro la fine della settimana? Vorremmo sapere se la riunione può essere spostata a martedì prossimo nel pomeriggio. In allegato trova '
+          'la relazione che mi ha chiesto ieri. Mi faccia sapere se ha domande sulla fattura o sulla consegna dell\'ordine. Cordiali saluti e buona '
+          'giornata. Il tempo è stato davvero bello questo fine settimana e siamo andati al mare con i bambini. Che cosa ne pensa del nuovo '
+          'progetto? La chiamerò quando sarò di ritorno. Ci sono ancora alcuni punti che dovremmo discutere insieme, ma non è così importante. '
+          'Ciao, come stai?',
+    'nl': 'Bedankt voor uw bericht. Ik ben momenteel niet op kantoor en ben maandag weer terug. Tijdens mijn afwezigheid heb ik beperkt toegang '
+          'tot mijn e-mail. Voor dringende zaken kunt u contact opnemen met mijn collega, die u graag verder helpt. Zou u mij de documenten voor '
+          'het einde van de week kunnen sturen? Wij willen graag weten of de vergadering kan worden verplaatst naar volgende dinsdagmiddag. In de '
+          'bijlage vindt u het rapport dat u gisteren heeft gevraagd. Laat het me weten als u vragen heeft over de factuur of de levering van de '
+          'bestelling. Met vriendelijke groet en een fijne dag. Het weer was dit weekend echt mooi en we zijn met de kinderen naar het strand '
+          'gegaan. Wat vindt u van het nieuwe project? Ik bel u als ik terug ben. Er zijn nog een paar punten die we samen moeten bespreken, maar '
+          'dat is niet zo belangrijk. Hallo, hoe gaat het met je?',
+    'pt': 'Obrigado pela sua mensagem. Neste momento estou fora do escritório e voltarei na segunda-feira. Durante a minha ausência terei acesso '
+          'limitado ao meu correio eletrónico. Para assuntos urgentes, por favor entre em contacto com o meu colega, que terá todo o gosto em '
+          'ajudar. Poderia enviar-me os documentos até ao final da semana? Gostaríamos de saber se a reunião pode ser adiada para a próxima '
+          'terça-feira à tarde. Em anexo encontra o relatório que me pediu ontem. Diga-me se tiver alguma dúvida sobre a fatura ou a entrega da '
+          'encomenda. Com os melhores cumprimentos e tenha um bom dia. O tempo esteve muito bom este fim de semana e fomos à praia com as crianças. '
+          'O que acha do novo projeto? Ligo-lhe quando voltar. Ainda há alguns pontos que devíamos discutir juntos, mas não é assim tão '
+          'importante. Olá, como estás?',
+}
+
+FetchItems = dict[str, bytes]
+FetchResult = tuple[int, list[str], FetchItems]
 
 
-def create_rotating_log(path: str, level: str) -> logging.Logger:
+def create_rotating_log(path: str, level: str, queued: bool = False) -> logging.Logger:
     """
-    Create the logger with file rotation
+    Create the logger with file rotation.
+    When queued, the records are put in a queue and formatted and written by a background thread, so a slow disk does not delay the replies.
+    The listener of the queue is available using the listener attribute of the queue handler and is stopped at exit.
     :param path: the path of the main log file
     :param level: the log level as defined in logging module
+    :param queued: True to write the records using a background thread
     :return: the logger
     """
     result: logging.Logger = logging.getLogger("AutoReplier")
@@ -76,47 +250,343 @@ def create_rotating_log(path: str, level: str) -> logging.Logger:
     console_handler: logging.Handler = logging.StreamHandler()
     console_handler.setLevel(level)
     console_handler.setFormatter(formatter)
-    result.addHandler(console_handler)
     file_handler: logging.Handler = RotatingFileHandler(path, maxBytes=1024 * 1024 * 5, backupCount=5)
     # noinspection PyUnresolvedReferences
     file_handler.setLevel(level)
     file_handler.setFormatter(formatter)
-    result.addHandler(file_handler)
+    if queued:
+        records: SimpleQueue = SimpleQueue()
+        listener: QueueListener = QueueListener(records, console_handler, file_handler, respect_handler_level=True)
+        queue_handler: QueueHandler = QueueHandler(records)
+        queue_handler.listener = listener
+        result.addHandler(queue_handler)
+        listener.start()
+        atexit.register(listener.stop)
+    else:
+        result.addHandler(console_handler)
+        result.addHandler(file_handler)
+    # noinspection PyUnresolvedReferences
+    result.setLevel(level)
+    return result
+
+
+def create_console_log(level: str) -> logging.Logger:
+    """
+    Create the logger writing to the standard error only, used when the log file of the replier must not be touched
+    :param level: the log level as defined in logging module
+    :return: the logger
+    """
+    result: logging.Logger = logging.getLogger("AutoReplier")
+    # noinspection Spellchecker
+    formatter: logging.Formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    console_handler: logging.Handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(level)
+    console_handler.setFormatter(formatter)
+    result.addHandler(console_handler)
     # noinspection PyUnresolvedReferences
     result.setLevel(level)
     return result
 
 
+def get_address(value: str) -> str:
+    """
+    Return the address part of a header value like: Name <address>
+    :param value: the header value
+    :return: the address
+    """
+    if value and '<' in value:
+        return (value.split('<'))[1].split('>')[0]
+    return value
+
+
+def get_fetch_item(items: FetchItems, name: str) -> bytes:
+    """
+    Return the fetched item having a name starting with the given one
+    :param items: the items by name
+    :param name: the name or the beginning of the name, like BODY[HEADER
+    :return: the item or None
+    """
+    for key, value in items.items():
+        if key.startswith(name):
+            return value
+    return None
+
+
+def compress_uid_set(uids: list[int]) -> str:
+    """
+    Build an IMAP message set using ranges (1:3,5,7:9) from the given identifiers
+    :param uids: the identifiers
+    :return: the message set
+    """
+    buffer: list[str] = []
+    start: int = None
+    end: int = None
+    for uid in sorted(set(uids)):
+        if start is not None and uid == end + 1:
+            end = uid
+            continue
+        if start is not None:
+            buffer.append(str(start) if start == end else str(start) + ':' + str(end))
+        start = end = uid
+    if start is not None:
+        buffer.append(str(start) if start == end else str(start) + ':' + str(end))
+    return ','.join(buffer)
+
+
+def iter_fetch_response(data: list) -> Iterator[FetchResult]:
+    """
+    Parse the data returned by a FETCH or UID FETCH command and yield the messages one by one
+    :param data: the data returned by imaplib
+    :return: the iterator on the tuples (uid, flags, items by name)
+    """
+    uid: int = None
+    flags: list[str] = []
+    items: FetchItems = {}
+    started: bool = False
+    for element in data:
+        if element is None:
+            continue
+        prefix: bytes = element[0] if isinstance(element, tuple) else element
+        if FETCH_START_PATTERN.match(prefix):
+            if started:
+                yield uid, flags, items
+            uid, flags, items = None, [], {}
+            started = True
+        m = FETCH_UID_PATTERN.search(prefix)
+        if m:
+            uid = int(m.group(1))
+        m = FETCH_FLAGS_PATTERN.search(prefix)
+        if m:
+            flags = [flag.decode() for flag in m.group(1).split()]
+        if isinstance(element, tuple):
+            m = FETCH_LITERAL_PATTERN.search(prefix)
+            if m:
+                items[m.group(1).decode()] = element[1]
+    if started:
+        yield uid, flags, items
+
+
+def is_transient_error(ex: BaseException) -> bool:
+    """
+    Classify an error raised by a connection to the IMAP or SMTP server
+    :param ex: the error
+    :return: True if the connection can be opened again (timeout, connection refused, reset or closed, network unreachable, TLS or name resolution error),
+     False if the error is fatal (authentication failure, command rejected by the server, invalid certificate)
+    """
+    if isinstance(ex, IMAP4.abort):
+        return True
+    if isinstance(ex, IMAP4.error):
+        return False
+    if isinstance(ex, SMTPServerDisconnected):
+        return True
+    if isinstance(ex, SMTPResponseException):
+        return 400 <= ex.smtp_code < 500
+    if isinstance(ex, SMTPRecipientsRefused):
+        return any(400 <= v[0] < 500 for v in ex.recipients.values())
+    if isinstance(ex, (SMTPException, ssl.SSLCertVerificationError)):
+        return False
+    if isinstance(ex, (TimeoutError, ConnectionError, EOFError, socket.gaierror, ssl.SSLError)):
+        return True
+    return isinstance(ex, OSError) and ex.errno in RECONNECT_ERRNOS
+
+
+def get_backoff_delay(attempt: int, delay: float = RECONNECT_DELAY, max_delay: float = RECONNECT_MAX_DELAY) -> float:
+    """
+    Return the delay before a new attempt to connect, doubled after each failure up to the maximum delay.
+    A random part of up to half of the delay is removed, so the clients disconnected at once do not connect again at once.
+    :param attempt: the number of failed attempts, minus one
+    :param delay: the delay after the first failure
+    :param max_delay: the maximum delay
+    :return: the delay in seconds
+    """
+    result: float = min(max_delay, delay * 2 ** min(attempt, 32))
+    return result - random.uniform(0, result / 2)
+
+
 # noinspection PyTypeChecker
-def get_message_language(value: message.Message) -> str:
+class LanguageDetector:
+    """
+    Detector of the language of a text using the profiles of character trigrams of the supported languages.
+    The text is read by steps and the detection stops when a language is clearly more likely than the others.
+    """
+    __languages: list[str] = []  # Languages to detect, having a sample
+    __table: dict[str, tuple[float, ...]] = {}  # Logarithm of the probability of each trigram by language
+
+    def __init__(self, languages: list[str]):
+        """
+        Initialize
+        :param languages: the codes of the languages to detect, the ones without sample are ignored
+        """
+        self.__languages = sorted({v.lower() for v in languages if v and v.lower() in LANGUAGE_SAMPLES})
+        self.__table = {}
+        counts: list[dict[str, int]] = []
+        for language in self.__languages:
+            count: dict[str, int] = {}
+            for trigram in LanguageDetector.iter_trigrams(LANGUAGE_SAMPLES[language]):
+                count[trigram] = count.get(trigram, 0) + 1
+            counts.append(count)
+        vocabulary: set[str] = set().union(*counts)
+        totals: list[int] = [sum(v.values()) + len(vocabulary) for v in counts]
+        # Laplace smoothing for the trigrams not available in the sample of a language
+        for trigram in vocabulary:
+            self.__table[trigram] = tuple(math.log((count.get(trigram, 0) + 1) / total) for count, total in zip(counts, totals))
+
+    @staticmethod
+    def iter_trigrams(text: str) -> Iterator[str]:
+        """
+        Iterate on the trigrams of the words of the text, the words are lowercased and surrounded by spaces
+        :param text: the text
+        :return: the iterator on the trigrams
+        """
+        for match in LANGUAGE_WORD_PATTERN.finditer(text):
+            word: str = ' ' + match.group(0).lower() + ' '
+            for i in range(len(word) - 2):
+                yield word[i:i + 3]
+
+    @property
+    def languages(self) -> list[str]:
+        """
+        Return the languages to detect
+        :return: the codes of the languages
+        """
+        return self.__languages
+
+    def detect(self, text: str) -> str:
+        """
+        Detect the language of the text using at most LANGUAGE_DETECTION_MAX_SIZE characters
+        :param text: the text
+        :return: the code of the language or None if there is no language to choose or if the text is not conclusive
+        """
+        if len(self.__languages) < 2 or not text:
+            return None
+        scores: list[float] = [0.0] * len(self.__languages)
+        read: int = 0
+        for trigram in LanguageDetector.iter_trigrams(text[:LANGUAGE_DETECTION_MAX_SIZE]):
+            row: tuple[float, ...] = self.__table.get(trigram)
+            if row is None:
+                continue
+            scores = [a + b for a, b in zip(scores, row)]
+            read += 1
+            if read % LANGUAGE_DETECTION_STEP == 0:
+                best, second = sorted(scores, reverse=True)[:2]
+                if best - second >= LANGUAGE_DETECTION_MARGIN:
+                    break
+        best, second = sorted(scores, reverse=True)[:2]
+        if best - second < LANGUAGE_DETECTION_MIN_MARGIN:
+            return None
+        return self.__languages[scores.index(best)]
+
+
+class TextPartMessage(message.Message):
+    """
+    Message or part of message created by parse_message, the payloads of the parts which are not texts are not kept.
+    The complete text parts are added to the given list, so the parse can be stopped after the first one.
+    """
+    __texts: list[message.Message] = None
+
+    def __init__(self, texts: list[message.Message], policy: email.policy.Policy = email.policy.compat32):
+        """
+        Initialize
+        :param texts: the list receiving the complete text parts
+        :param policy: the policy of the parser
+        """
+        super().__init__(policy)
+        self.__texts = texts
+
+    def set_payload(self, payload: str, charset: str = None) -> None:
+        """
+        Set the payload, the payload is replaced by an empty string when the part is not a text
+        :param payload: the payload
+        :param charset: the character set
+        """
+        if self.get_content_maintype() != 'text' or 'attachment' in str(self.get('Content-Disposition')):
+            super().set_payload('', charset)
+            return
+        super().set_payload(payload, charset)
+        self.__texts.append(self)
+
+
+def parse_message(chunks: Iterable[bytes], max_size: int) -> message.Message:
+    """
+    Parse the message using a feed parser, the parse stops when the first text part is complete or when the maximum size is reached.
+    The payloads of the parts which are not texts are not kept, so the memory used does not depend on the size of the attachments.
+    :param chunks: the bytes of the message, like the headers and the beginning of the body or the blocks read from a file
+    :param max_size: the maximum number of bytes parsed
+    :return: the message, truncated if the maximum size has been reached
+    """
+    texts: list[message.Message] = []
+    parser: BytesFeedParser = BytesFeedParser(_factory=lambda policy=email.policy.compat32: TextPartMessage(texts, policy))
+    remaining: int = max_size
+    for chunk in chunks:
+        for i in range(0, len(chunk), MESSAGE_PARSE_CHUNK_SIZE):
+            data: bytes = chunk[i:i + min(MESSAGE_PARSE_CHUNK_SIZE, remaining)]
+            parser.feed(data)
+            remaining -= len(data)
+            if remaining <= 0 or texts:
+                return parser.close()
+    return parser.close()
+
+
+def get_part_text(part: message.Message, max_size: int = LANGUAGE_DETECTION_MAX_SIZE) -> str:
+    """
+    Decode the beginning of the text of a part, the part may be truncated when only the beginning of the body is fetched
+    :param part: the part
+    :param max_size: the maximum number of characters
+    :return: the text
+    """
+    if str(part.get('Content-Transfer-Encoding', '')).strip().lower() == 'base64':
+        payload: str = part.get_payload(decode=False)
+        if not isinstance(payload, str):
+            return ''
+        # Ignore the characters of an incomplete quantum
+        encoded: str = ''.join(payload[:max_size * 2].split())
+        try:
+            data: bytes = base64.b64decode(encoded[:len(encoded) // 4 * 4])
+        except ValueError:
+            return ''
+    else:
+        data: bytes = part.get_payload(decode=True)
+        if not data:
+            return ''
+        data = data[:max_size * 4]
+    try:
+        return data.decode(part.get_content_charset() or 'utf-8', errors='replace')[:max_size]
+    except LookupError:
+        return data.decode('utf-8', errors='replace')[:max_size]
+
+
+def get_message_text(value: message.Message, max_size: int = LANGUAGE_DETECTION_MAX_SIZE) -> str:
+    """
+    Return the beginning of the first text of the message, the tags are removed if the message has only an HTML text
+    :param value: the message
+    :param max_size: the maximum number of characters
+    :return: the text or an empty string
+    """
+    html_part: message.Message = None
+    for part in value.walk():
+        if part.is_multipart() or 'attachment' in str(part.get('Content-Disposition')):
+            continue
+        ctype: str = part.get_content_type()
+        if ctype == 'text/plain':
+            return get_part_text(part, max_size)
+        if ctype == 'text/html' and html_part is None:
+            html_part = part
+    if html_part is None:
+        return ''
+    return HTMLStripper.strip_tags(get_part_text(html_part, max_size * 4))[:max_size]
+
+
+def get_message_language(value: message.Message, detector: LanguageDetector = None) -> str:
     """
     Attempt to retrieve the language associated to the message
     :param value: the message
+    :param detector: the detector of the languages or None to use the default language
     :return: the language code or default
     """
-    # pylint: disable=unused-variable
-    body: str = None
-    # pylint: enable=unused-variable
-    if value.is_multipart():
-        for part in value.walk():
-            ctype: str = part.get_content_type()
-            cdispo: str = str(part.get('Content-Disposition'))
-            # skip any text/plain (txt) attachments
-            if ctype == 'text/plain' and 'attachment' not in cdispo:
-                body = html.escape(str(part.get_payload(decode=True), 'utf-8'))  # decode
-                break
-    # not multipart - i.e. plain text, no attachments, keeping fingers crossed
-    else:
-        ctype: str = value.get_content_type()
-        if ctype != 'text/html':
-            body = html.escape(str(value.get_payload(decode=True), 'utf-8'))
-        else:
-            body = str(value.get_payload(decode=True), 'utf-8')
-    # Not working with 3.9.2 on Debian
-    #if body is not None:
-    #    for language in Detector(body).languages:
-    #        if language.confidence > 85:
-    #            return language.code
+    if detector is not None and len(detector.languages) > 1:
+        language: str = detector.detect(get_message_text(value))
+        if language:
+            return language
     return DEFAULT_LANGUAGE
 
 
@@ -231,6 +701,7 @@ AddressList = list[str]
 DomainList = list[str]
 SubjectList = list[str]
 TemplateList = list[ReplyTemplate]
+CompiledRules = list[tuple[re.Pattern, list[str]]]
 
 
 # pylint: disable=too-many-instance-attributes
@@ -243,6 +714,16 @@ class AutoReplierSettings:
     imap_server: str = None  # Full name or IP address of your IMAP server
     imap_use_ssl: bool = False  # Set True to use SSL
     imap_port: int = IMAP4_PORT  # Port of your IMAP server
+    imap_batch_size: int = IMAP_BATCH_SIZE  # Number of messages fetched by a single UID FETCH command
+    imap_body_max_size: int = IMAP_BODY_MAX_SIZE  # Maximum number of bytes of the body fetched when the language is required
+    imap_idle: bool = True  # Set False to disable the IDLE command even if supported by the server
+    imap_idle_timeout: int = IMAP_IDLE_TIMEOUT  # Delay in seconds before the IDLE command is issued again
+    imap_rate: float = IMAP_RATE  # Maximum number of IMAP commands by second, 0 for no limit
+    imap_burst: int = IMAP_BURST  # Maximum number of IMAP commands sent without waiting
+    imap_timeout: float = IMAP_TIMEOUT  # Timeout in seconds of the operations on the IMAP socket
+    imap_noop_interval: int = IMAP_NOOP_INTERVAL  # Delay in seconds after which an unused IMAP connection is checked using NOOP, 0 to disable
+    imap_reconnect_delay: float = RECONNECT_DELAY  # Delay in seconds before the second attempt to connect, doubled after each failure
+    imap_reconnect_max_delay: float = RECONNECT_MAX_DELAY  # Maximum delay in seconds between two attempts to connect
     imap_user: str = None  # User used to connect to your IMAP server
     imap_password: str = None  # Password (base64 encoded) of the user used to connect to your IMAP server
     smtp_server: str = None  # Full name or IP address of your SMTP server
@@ -250,15 +731,46 @@ class AutoReplierSettings:
     smtp_port: int = SMTP_PORT  # Port of your SMTP server
     smtp_user: str = None  # User used to connect to your SMTP server
     smtp_password: str = None  # Password (base64 encoded) of the user used to connect to your SMTP server
+    smtp_max_idle: int = SMTP_MAX_IDLE  # Delay in seconds after which an idle SMTP connection is closed
+    smtp_timeout: float = SMTP_TIMEOUT  # Timeout in seconds of the operations on the SMTP socket
+    smtp_rate: float = SMTP_RATE  # Maximum number of messages sent by second, 0 for no limit
+    smtp_burst: int = SMTP_BURST  # Maximum number of messages sent without waiting
+    smtp_workers: int = SMTP_WORKERS  # Number of SMTP connections used to send the replies in parallel when the pipeline is used
     block_hours: int = 12  # Number of hours used to block incoming email address
+    block_cache_size: int = BLOCK_CACHE_SIZE  # Maximum number of blocked addresses kept in memory
+    maintenance_interval: int = MAINTENANCE_INTERVAL  # Delay in seconds between two purges of the expired addresses, 0 to disable the purge
     skipped_addresses: AddressList = []  # List of email addresses (or regular expressions) used to ignore incoming message
     skipped_domains: DomainList = []  # List of domains (or regular expressions)  to ignore incoming message
     skipped_subjects: SubjectList = []  # List of subjects (or regular expressions)  to ignore incoming message
     templates: TemplateList = []  # List of reply templates
     path: str = None  # Path for the files used by the application
+    config_path: str = None  # Path of the XML configuration, watched to reload the changes
+    reload_interval: int = RELOAD_INTERVAL  # Delay in seconds between two checks of the modification of the configuration, 0 to disable the reload
     db_path: str = 'autoreplier.db'
     log_path: str  # Path to the logs file, not used in this version
     log_level: str  # Level of logs, not used in this version
+    log_queued: bool = False  # Set True to write the logs using a background thread
+    log_detail_ratio: float = LOG_DETAIL_RATIO  # Ratio of the messages whose processing is detailed in the logs, the checks are always summarized
+
+    name: str = ''  # Name of the mailbox, used when several mailboxes are hosted by the same process
+    workers: int = 4  # Number of threads used to check the mailboxes when several mailboxes are hosted by the same process
+    pipeline: bool = True  # Set False to process the messages sequentially instead of using the asynchronous pipeline
+    queue_size: int = PIPELINE_QUEUE_SIZE  # Maximum number of messages waiting between two stages of the pipeline
+    shards: int = 0  # Number of worker processes used to process a large number of messages, 0 or 1 to process them in this process
+    shard_min_size: int = SHARD_MIN_SIZE  # Minimum number of messages found by a search to split them between the worker processes
+    node: str = None  # Name of the node used by the leases of the mailboxes, the host name by default
+    lease_duration: int = 0  # Duration in seconds of the lease of a mailbox when the database is shared by several nodes, 0 to disable the leases
+    metrics_address: str = METRICS_ADDRESS  # Address of the metrics server
+    metrics_port: int = 0  # Port of the metrics server, 0 to disable the server
+
+    def __init__(self):
+        """
+        Initialize
+        """
+        self.skipped_addresses = []
+        self.skipped_domains = []
+        self.skipped_subjects = []
+        self.templates = []
 
     def parse(self, path: str) -> None:
         """
@@ -267,6 +779,70 @@ class AutoReplierSettings:
         with open(path, encoding='utf-8') as f:
             tree = etree.parse(f)
         root_node: etree.Element = tree.getroot()
+        self._parse_root(root_node)
+        self._parse_mailbox(root_node, root_node)
+        self.path = os.path.dirname(path)
+        self.config_path = path
+
+    def parse_all(self, path: str) -> list:
+        """
+        Parse the XML configuration describing one or several mailboxes.
+        The returned settings are copies of these settings, the skipped elements and the templates of the configuration element
+        are shared by all the mailboxes and the attributes of a mailbox element override the ones of the configuration element.
+        :param path: the path of the XML configuration
+        :return: the list of settings, one by mailbox
+        """
+        with open(path, encoding='utf-8') as f:
+            tree = etree.parse(f)
+        root_node: etree.Element = tree.getroot()
+        mailbox_nodes: list[etree.Element] = root_node.findall('mailboxes/mailbox')
+        if not mailbox_nodes:
+            self.parse(path)
+            return [self]
+        result: list[AutoReplierSettings] = []
+        for mailbox_node in mailbox_nodes:
+            settings: AutoReplierSettings = copy.copy(self)
+            AutoReplierSettings.__init__(settings)
+            settings._parse_root(root_node)
+            settings.name = mailbox_node.get('name')
+            if not settings.name:
+                raise IOError('No name attribute specified on the mailbox element, refer to the autoreplier.xsd')
+            v = mailbox_node.get('date')
+            if v is not None:
+                settings.date = datetime.datetime.strptime(v, '%Y-%m-%d')
+            elif settings.date is None:
+                raise IOError('No date attribute specified on the configuration or on the mailbox ' + settings.name + ', refer to the autoreplier.xsd')
+            v = mailbox_node.get('block-hours')
+            if v is not None:
+                settings.block_hours = int(v)
+            settings._parse_skipped(root_node)
+            settings._parse_mailbox(root_node, mailbox_node)
+            if not settings.templates:
+                settings._parse_templates(root_node)
+            settings.path = os.path.dirname(path)
+            settings.config_path = path
+            result.append(settings)
+        return result
+
+    def reload(self) -> 'AutoReplierSettings':
+        """
+        Parse again the XML configuration used to create these settings.
+        The attributes not described by the configuration, like the path of the database, are copied from these settings.
+        :return: the new settings of the same mailbox
+        """
+        base: AutoReplierSettings = copy.copy(self)
+        AutoReplierSettings.__init__(base)
+        for settings in base.parse_all(self.config_path):
+            if settings.name == self.name:
+                return settings
+        raise IOError('Mailbox not found in the configuration: ' + self.name)
+
+    # pylint: disable=too-many-branches
+    def _parse_root(self, root_node: etree.Element) -> None:
+        """
+        Parse the attributes of the configuration element.
+        :param root_node: the configuration element
+        """
         v = root_node.get('refresh-delay')
         if v is not None:
             self.refresh_delay = int(v)
@@ -275,29 +851,93 @@ class AutoReplierSettings:
         v = root_node.get('date')
         if v is not None:
             self.date = datetime.datetime.strptime(v, '%Y-%m-%d')
-        else:
+        elif root_node.find('mailboxes') is None:
             raise IOError('No date attribute specified in the XML configuration, refer to the autoreplier.xsd')
         v = root_node.get('block-hours')
         if v is not None:
             self.block_hours = int(v)
         else:
             self.block_hours = 12
+        v = root_node.get('block-cache-size')
+        if v is not None:
+            self.block_cache_size = int(v)
+        else:
+            self.block_cache_size = BLOCK_CACHE_SIZE
+        v = root_node.get('maintenance-interval')
+        if v is not None:
+            self.maintenance_interval = int(v)
+        else:
+            self.maintenance_interval = MAINTENANCE_INTERVAL
+        v = root_node.get('reload-interval')
+        if v is not None:
+            self.reload_interval = int(v)
+        else:
+            self.reload_interval = RELOAD_INTERVAL
+        v = root_node.get('workers')
+        if v is not None:
+            self.workers = int(v)
+        self.pipeline = root_node.get('pipeline') not in ('False', 'false')
+        v = root_node.get('queue-size')
+        if v is not None:
+            self.queue_size = int(v)
+        else:
+            self.queue_size = PIPELINE_QUEUE_SIZE
+        v = root_node.get('shards')
+        if v is not None:
+            self.shards = int(v)
+        else:
+            self.shards = 0
+        v = root_node.get('shard-min-size')
+        if v is not None:
+            self.shard_min_size = int(v)
+        else:
+            self.shard_min_size = SHARD_MIN_SIZE
+        v = root_node.get('node')
+        if v is not None:
+            self.node = v
+        v = root_node.get('lease-duration')
+        if v is not None:
+            self.lease_duration = int(v)
+        else:
+            self.lease_duration = 0
+        metrics_node: etree.Element = root_node.find('metrics')
+        if metrics_node is not None:
+            v = metrics_node.get('address')
+            if v is not None:
+                self.metrics_address = v
+            else:
+                self.metrics_address = METRICS_ADDRESS
+            self.metrics_port = int(metrics_node.get('port'))
         log_node: etree.Element = root_node.find('log')
+        self.log_queued = False
+        self.log_detail_ratio = LOG_DETAIL_RATIO
         if log_node is not None:
+            self.log_queued = log_node.get('queued') in {'True', 'true'}
+            v = log_node.get('detail-ratio')
+            if v is not None:
+                self.log_detail_ratio = float(v)
             v = log_node.find('path')
             if v is not None:
                 self.log_path = v.text
             v = log_node.find('level')
             if v is not None:
                 self.log_level = v.text
+
+    # pylint: disable=too-many-branches
+    def _parse_mailbox(self, root_node: etree.Element, node: etree.Element) -> None:
+        """
+        Parse the servers, the skipped elements and the templates.
+        :param root_node: the configuration element
+        :param node: the configuration or mailbox element
+        """
         accounts = {}
-        for node in tree.findall('accounts/account'):
-            v1 = node.get('user')
-            v2 = node.get('password')
-            v3 = node.get('id')
+        for account_node in root_node.findall('accounts/account'):
+            v1 = account_node.get('user')
+            v2 = account_node.get('password')
+            v3 = account_node.get('id')
             if v1 is not None and v2 is not None and v3 is not None:
                 accounts[v3] = [v1, v2]
-        imap_node: etree.Element = root_node.find('imap')
+        imap_node: etree.Element = node.find('imap')
         if imap_node is not None:
             self.imap_server = imap_node.get('server')
             v = imap_node.get('port')
@@ -306,6 +946,32 @@ class AutoReplierSettings:
             else:
                 self.imap_port = 143
             self.imap_use_ssl = imap_node.get('ssl') == 'True' or imap_node.get('ssl') == 'true'
+            v = imap_node.get('batch-size')
+            if v is not None:
+                self.imap_batch_size = int(v)
+            else:
+                self.imap_batch_size = IMAP_BATCH_SIZE
+            v = imap_node.get('body-max-size')
+            if v is not None:
+                self.imap_body_max_size = int(v)
+            else:
+                self.imap_body_max_size = IMAP_BODY_MAX_SIZE
+            self.imap_idle = imap_node.get('idle') not in ('False', 'false')
+            v = imap_node.get('idle-timeout')
+            if v is not None:
+                self.imap_idle_timeout = min(int(v), IMAP_IDLE_TIMEOUT)
+            else:
+                self.imap_idle_timeout = IMAP_IDLE_TIMEOUT
+            v = imap_node.get('rate')
+            if v is not None:
+                self.imap_rate = float(v)
+            else:
+                self.imap_rate = IMAP_RATE
+            v = imap_node.get('burst')
+            if v is not None:
+                self.imap_burst = int(v)
+            else:
+                self.imap_burst = IMAP_BURST
         else:
             raise IOError('No imap element specified in the XML configuration, refer to the autoreplier.xsd')
         account_id: str = imap_node.get('account-id')
@@ -313,7 +979,7 @@ class AutoReplierSettings:
         if account:
             self.imap_user = account[0]
             self.imap_password = account[1]
-        smtp_node: etree.Element = root_node.find('smtp')
+        smtp_node: etree.Element = node.find('smtp')
         if smtp_node is not None:
             self.smtp_server = smtp_node.get('server')
             v = smtp_node.get('port')
@@ -322,6 +988,26 @@ class AutoReplierSettings:
             else:
                 self.smtp_port = 25
             self.smtp_use_ssl = smtp_node.get('ssl') == 'True' or smtp_node.get('ssl') == 'true'
+            v = smtp_node.get('max-idle')
+            if v is not None:
+                self.smtp_max_idle = int(v)
+            else:
+                self.smtp_max_idle = SMTP_MAX_IDLE
+            v = smtp_node.get('rate')
+            if v is not None:
+                self.smtp_rate = float(v)
+            else:
+                self.smtp_rate = SMTP_RATE
+            v = smtp_node.get('burst')
+            if v is not None:
+                self.smtp_burst = int(v)
+            else:
+                self.smtp_burst = SMTP_BURST
+            v = smtp_node.get('workers')
+            if v is not None:
+                self.smtp_workers = int(v)
+            else:
+                self.smtp_workers = SMTP_WORKERS
         else:
             raise IOError('No smtp element specified in the XML configuration, refer to the autoreplier.xsd')
         account_id = smtp_node.get('account-id')
@@ -329,440 +1015,2811 @@ class AutoReplierSettings:
         if account:
             self.smtp_user = account[0]
             self.smtp_password = account[1]
-        for node in tree.findall('skipped/domains/domain'):
-            self.skipped_domains.append(node.text)
-        for node in tree.findall('skipped/addresses/address'):
-            self.skipped_addresses.append(node.text)
-        for node in tree.findall('skipped/subjects/subject'):
-            self.skipped_subjects.append(node.text)
-        for node in tree.findall('templates/template'):
+        self._parse_connections(imap_node, smtp_node)
+        self._parse_skipped(node)
+        self._parse_templates(node)
+
+    def _parse_connections(self, imap_node: etree.Element, smtp_node: etree.Element) -> None:
+        """
+        Parse the timeouts of the connections and the delays used to open them again.
+        :param imap_node: the imap element
+        :param smtp_node: the smtp element
+        """
+        v = imap_node.get('timeout')
+        if v is not None:
+            self.imap_timeout = float(v)
+        else:
+            self.imap_timeout = IMAP_TIMEOUT
+        v = imap_node.get('noop-interval')
+        if v is not None:
+            self.imap_noop_interval = int(v)
+        else:
+            self.imap_noop_interval = IMAP_NOOP_INTERVAL
+        v = imap_node.get('reconnect-delay')
+        if v is not None:
+            self.imap_reconnect_delay = float(v)
+        else:
+            self.imap_reconnect_delay = RECONNECT_DELAY
+        v = imap_node.get('reconnect-max-delay')
+        if v is not None:
+            self.imap_reconnect_max_delay = float(v)
+        else:
+            self.imap_reconnect_max_delay = RECONNECT_MAX_DELAY
+        v = smtp_node.get('timeout')
+        if v is not None:
+            self.smtp_timeout = float(v)
+        else:
+            self.smtp_timeout = SMTP_TIMEOUT
+
+    def _parse_skipped(self, node: etree.Element) -> None:
+        """
+        Parse the skipped domains, addresses and subjects.
+        :param node: the configuration or mailbox element
+        """
+        for v in node.findall('skipped/domains/domain'):
+            self.skipped_domains.append(v.text)
+        for v in node.findall('skipped/addresses/address'):
+            self.skipped_addresses.append(v.text)
+        for v in node.findall('skipped/subjects/subject'):
+            self.skipped_subjects.append(v.text)
+
+    def _parse_templates(self, node: etree.Element) -> None:
+        """
+        Parse the templates.
+        :param node: the configuration or mailbox element
+        """
+        for v in node.findall('templates/template'):
             template: ReplyTemplate = ReplyTemplate()
-            template.parse(node)
+            template.parse(v)
             self.templates.append(template)
-        self.path = os.path.dirname(path)
 
 
-class AutoReplier:
+class SkipRules:
     """
-    Read your unread and unanswered messages and reply automatically if a template is available using the same address as the recipient of the incoming message.
+    Rules used to ignore the incoming messages using the address of the sender, its domain or the subject.
+    Like the regular expressions, the literal values are matched from the beginning of the value: they are kept in sets by length.
+    The domains like *.example.org matching the subdomains of example.org are kept in a tree of labels in reversed order and the regular
+    expressions are indexed by their literal prefix and merged in a few alternations.
     """
-    __logger: logging.Logger = None
-    __settings: AutoReplierSettings = None
-    __imap: IMAP4 = None
-    __smtp: SMTP = None
-    __active: bool = False
-    __test: bool = False
-    __rate_limit: int = 2
-    __age_in_days: int = 1
-    __login_retry_delay: int = 15
-    __login_retries: int = 10
-    __html_templates: dict[str, dict[str, ReplyTemplate]] = {}  # List of reply templates in HTML by address and language
-    __text_templates: dict[str, dict[str, ReplyTemplate]] = {}  # List of reply templates in plain text by address and language
-    __skipped_addresses: list[str] = []  # List of texts or patterns describing the addresses to ignore
-    __skipped_domains: list[str] = []  # List of texts or patterns describing the domains to ignore
-    __skipped_subjects: list[str] = []  # List of texts or patterns describing the subjects to ignore
-
-    def __init__(self, settings: AutoReplierSettings, logger: logging.Logger):
-        self.__settings = settings
-        self.__logger = logger
-        self.__logger.info('Initializing ' + self.__class__.__name__ + '...')
-        # Status flags
-        self.__active = False
-        # Locks
-        self.__lock: threading.RLock = threading.RLock()
-        self.__start_lock: threading.RLock = threading.RLock()
-        self.__stop_lock: threading.RLock = threading.RLock()
-        # Hooks
-        atexit.register(self.stop)
-        signal.signal(signal.SIGINT, self.stop)
-        self._initialize()
-        self._login()
+    ADDRESS: str = 'address'
+    DOMAIN: str = 'domain'
+    SUBJECT: str = 'subject'
+    __WILDCARD: str = '*'  # Key of the rule matching the subdomains in the tree
 
-    # noinspection PyTypeChecker
-    # pylint: disable=too-complex
-    def _initialize(self) -> None:
+    def __init__(self, addresses: AddressList, domains: DomainList, subjects: SubjectList, logger: logging.Logger):
         """
-        Do some preprocessing tasks.
+        Initialize and compile the rules
+        :param addresses: the addresses or regular expressions
+        :param domains: the domains or regular expressions
+        :param subjects: the subjects or regular expressions
+        :param logger: the logger
         """
-        for template in self.__settings.templates:
-            if template.body is not None and template.lang is not None:
-                if template.lang == 'en':
-                    new_locale = 'en_US.utf8'
-                else:
-                    new_locale = template.lang.lower() + '_' + template.lang.upper() + '.utf8'
-                if self.__logger.isEnabledFor(logging.DEBUG):
-                    self.__logger.debug('Locale for template: ' + new_locale)
-                previous_locale: str = locale.getlocale(locale.LC_TIME)
-                locale.setlocale(locale.LC_TIME, new_locale)
-                template.body = template.body.replace('${date}', self.__settings.date.strftime("%A %-d %B %Y"))
-                locale.setlocale(locale.LC_TIME, previous_locale)
-            #HTML or text template ?
-            d1: dict[str, dict[str, ReplyTemplate]] = self.__text_templates
-            if template.type == ReplyTemplateType.HTML:
-                d1 = self.__html_templates
-            #Set default if not already done
-            if DEFAULT_KEY in d1:
-                d2: dict[str, ReplyTemplate] = d1[DEFAULT_KEY]
+        self.__logger = logger
+        self.__addresses: dict[int, set[str]] = {}
+        self.__domains: dict[int, set[str]] = {}
+        self.__subjects: dict[int, set[str]] = {}
+        self.__subdomains: dict = {}
+        self.__address_patterns: dict[str, CompiledRules] = {}
+        self.__domain_patterns: dict[str, CompiledRules] = {}
+        self.__subject_patterns: dict[str, CompiledRules] = {}
+        self.__count: int = 0
+        regexes: list[str] = []
+        for value in addresses:
+            if self._is_literal(value):
+                SkipRules._add_literal(self.__addresses, value.lower())
             else:
-                d2: dict[str, ReplyTemplate] = {}
-                d1[DEFAULT_KEY] = d2
-            if len(d2) == 0:
-                d2[DEFAULT_KEY] = template
-                if self.__logger.isEnabledFor(logging.DEBUG):
-                    self.__logger.debug('Template added to default: ' + str(template))
-            #Set using email
-            if template.email:
-                if template.email in d1:
-                    d2: dict[str, ReplyTemplate] = d1[template.email]
-                else:
-                    d2: dict[str, ReplyTemplate] = {}
-                    d1[template.email] = d2
+                regexes.append(value)
+        self.__address_patterns = self._compile(regexes, self.__addresses)
+        regexes = []
+        for value in domains:
+            if value.startswith('*.') and self._is_literal(value[2:]):
+                self._add_subdomains(value[2:].lower())
+            elif self._is_literal(value):
+                SkipRules._add_literal(self.__domains, value.lower())
             else:
-                d2 = d1[DEFAULT_KEY]
-            #Set using language
-            if template.lang:
-                if template.lang not in d2:
-                    d2[template.lang] = template
-                    if self.__logger.isEnabledFor(logging.DEBUG):
-                        self.__logger.debug('Template added to ' + template.lang + ': ' + str(template))
+                regexes.append(value)
+        self.__domain_patterns = self._compile(regexes, None)
+        regexes = []
+        for value in subjects:
+            if self._is_literal(value):
+                SkipRules._add_literal(self.__subjects, value)
             else:
-                d2[DEFAULT_KEY] = template
-        for value in self.__settings.skipped_addresses:
-            try:
-                self.__skipped_addresses.append(re.compile(value, flags=0))
-            except re.error as ex:
-                _, _, exc_traceback4 = sys.exc_info()
-                traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
-                self.__logger.error(ex)
-                self.__skipped_addresses.append(value)
-        for value in self.__settings.skipped_domains:
-            try:
-                self.__skipped_domains.append(re.compile(value, flags=0))
-            except re.error as ex:
-                _, _, exc_traceback4 = sys.exc_info()
-                traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
-                self.__logger.error(ex)
-                self.__skipped_domains.append(value)
-        for value in self.__settings.skipped_subjects:
-            try:
-                self.__skipped_subjects.append(re.compile(value, flags=0))
-            except re.error as ex:
+                regexes.append(value)
+        self.__subject_patterns = self._compile(regexes, self.__subjects)
+        # The shortest values are checked first
+        self.__addresses = dict(sorted(self.__addresses.items()))
+        self.__domains = dict(sorted(self.__domains.items()))
+        self.__subjects = dict(sorted(self.__subjects.items()))
+        self.__count = len(addresses) + len(domains) + len(subjects)
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Skip rules compiled: %s', str(self.__count))
+
+    @staticmethod
+    def _is_literal(value: str) -> bool:
+        """
+        Check if the value does not use the special characters of the regular expressions (the dot is considered as a literal)
+        :param value: the value
+        :return: True if the value is a literal
+        """
+        return not any(c in SKIP_RULES_SPECIAL_CHARS for c in value)
+
+    @staticmethod
+    def _get_prefix(value: str) -> str:
+        """
+        Return the literal prefix of the regular expression
+        :param value: the regular expression
+        :return: the prefix, empty if the expression has no literal prefix
+        """
+        if '|' in value:
+            return ''
+        prefix: list[str] = []
+        for c in value:
+            if c in SKIP_RULES_SPECIAL_CHARS or c == '.':
+                if c in '?*{' and prefix:
+                    # The previous character is optional
+                    prefix.pop()
+                break
+            prefix.append(c)
+        return ''.join(prefix[:SKIP_RULES_PREFIX_LENGTH])
+
+    @staticmethod
+    def _add_literal(literals: dict[int, set[str]], value: str) -> None:
+        """
+        Add the literal value to the sets by length
+        :param literals: the sets of literal values by length
+        :param value: the value
+        """
+        literals.setdefault(len(value), set()).add(value)
+
+    def _add_subdomains(self, value: str) -> None:
+        """
+        Add the domain whose subdomains are ignored to the tree of labels
+        :param value: the domain without the *. prefix
+        """
+        node: dict = self.__subdomains
+        for label in reversed(value.split('.')):
+            node = node.setdefault('.' + label, {})
+        node[SkipRules.__WILDCARD] = '*.' + value
+
+    def _compile(self, values: list[str], literals: dict[int, set[str]]) -> dict[str, CompiledRules]:
+        """
+        Index the regular expressions by literal prefix and merge them by chunks
+        :param values: the regular expressions
+        :param literals: the literal values receiving the invalid regular expressions or None to ignore them
+        :return: the compiled patterns associated to the list of the original expressions in the order of the groups, by prefix
+        """
+        result: dict[str, CompiledRules] = {}
+        valid: dict[str, list[str]] = {}
+        for value in values:
+            try:
+                re.compile(value)
+            except re.error as ex:
                 _, _, exc_traceback4 = sys.exc_info()
                 traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
                 self.__logger.error(ex)
-                self.__skipped_subjects.append(value)
+                if literals is not None:
+                    SkipRules._add_literal(literals, value)
+                continue
+            prefix: str = SkipRules._get_prefix(value)
+            if SKIP_RULES_BACKREFERENCE_PATTERN.search(value):
+                # Group numbers would change in an alternation
+                result.setdefault(prefix, []).append((re.compile('(' + value + ')'), [value]))
+            else:
+                valid.setdefault(prefix, []).append(value)
+        for prefix, chunks in valid.items():
+            compiled: CompiledRules = result.setdefault(prefix, [])
+            for i in range(0, len(chunks), SKIP_RULES_CHUNK_SIZE):
+                chunk: list[str] = chunks[i:i + SKIP_RULES_CHUNK_SIZE]
+                try:
+                    compiled.append((re.compile('|'.join(f'(?P<_skip{j}>{value})' for j, value in enumerate(chunk))), chunk))
+                except re.error:
+                    # Expressions using global flags or named groups cannot be merged
+                    for value in chunk:
+                        compiled.append((re.compile('(?P<_skip0>' + value + ')'), [value]))
+        return result
+
+    @staticmethod
+    def _search(patterns: dict[str, CompiledRules], value: str) -> str:
+        """
+        Search a regular expression matching the value
+        :param patterns: the compiled patterns by prefix
+        :param value: the value
+        :return: the original expression or None
+        """
+        if not patterns:
+            return None
+        for length in range(min(len(value), SKIP_RULES_PREFIX_LENGTH), -1, -1):
+            for pattern, sources in patterns.get(value[:length], ()):
+                m = pattern.match(value)
+                if m:
+                    if len(sources) == 1:
+                        return sources[0]
+                    return sources[int(m.lastgroup.removeprefix('_skip'))]
+        return None
+
+    @staticmethod
+    def _search_literal(literals: dict[int, set[str]], value: str) -> str:
+        """
+        Search a literal value starting the value
+        :param literals: the sets of literal values by length
+        :param value: the value
+        :return: the literal value or None
+        """
+        for length, values in literals.items():
+            if length > len(value):
+                break
+            if value[:length] in values:
+                return value[:length]
+        return None
+
+    def _search_subdomains(self, value: str) -> str:
+        """
+        Search a parent domain of the domain in the tree of labels
+        :param value: the domain
+        :return: the matching rule or None
+        """
+        node: dict = self.__subdomains
+        labels: list[str] = value.split('.')
+        for i in range(len(labels) - 1, 0, -1):
+            node = node.get('.' + labels[i])
+            if node is None:
+                return None
+            if SkipRules.__WILDCARD in node:
+                return node[SkipRules.__WILDCARD]
+        return None
+
+    def match(self, sender: str, domain: str, subject: str) -> tuple[str, str]:
+        """
+        Search a rule matching the message
+        :param sender: the address of the sender
+        :param domain: the domain of the sender
+        :param subject: the subject
+        :return: the tuple (kind of rule, rule) or None
+        """
+        if sender:
+            rule: str = SkipRules._search_literal(self.__addresses, sender.lower())
+            if rule is None:
+                rule = self._search(self.__address_patterns, sender)
+            if rule is not None:
+                return SkipRules.ADDRESS, rule
+        if domain:
+            rule = SkipRules._search_literal(self.__domains, domain.lower())
+            if rule is None:
+                rule = self._search_subdomains(domain.lower())
+            if rule is None:
+                rule = self._search(self.__domain_patterns, domain)
+            if rule is not None:
+                return SkipRules.DOMAIN, rule
+        if subject is not None:
+            rule = SkipRules._search_literal(self.__subjects, subject)
+            if rule is None:
+                rule = self._search(self.__subject_patterns, subject)
+            if rule is not None:
+                return SkipRules.SUBJECT, rule
+        return None
+
+    def __len__(self) -> int:
+        return self.__count
+
+
+class TTLCache:
+    """
+    Thread safe cache with a maximum size using the LRU eviction and a time to live of the entries.
+    """
+    __max_size: int = 0
+    __ttl: float = 0
+
+    def __init__(self, max_size: int, ttl: float):
+        """
+        Initialize
+        :param max_size: the maximum number of entries
+        :param ttl: the time to live of the entries in seconds
+        """
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock: threading.Lock = threading.Lock()
+
+    def get(self, key: object, default: object = None) -> object:
+        """
+        Return the value associated to the key if not expired
+        :param key: the key
+        :param default: the value returned when the key is not in the cache
+        :return: the value or the default one
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self.__entries[key]
+                return default
+            self.__entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: object, value: object) -> None:
+        """
+        Associate the value to the key
+        :param key: the key
+        :param value: the value
+        """
+        if self.__max_size <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.__ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+
+    def remove(self, key: object) -> None:
+        """
+        Remove the value associated to the key
+        :param key: the key
+        """
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Remove all the entries
+        """
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+class SenderStore:
+    """
+    Persistent store of the senders used to block the incoming addresses during the configured hours.
+    The connection is kept open for the life of the replier, the journal uses the WAL mode and the statements are kept prepared by the cache of the sqlite3 module.
+    The recently used addresses are kept in memory and the new dates are written by the flush method using a single transaction.
+    The addresses are associated to the name of the mailbox, so the store can be shared by the replies of several mailboxes.
+    The store also keeps the synchronization state of each mailbox (UIDVALIDITY and last processed UID), written with the dates.
+    The expired addresses are deleted by the purge method and the free pages are released by the compact method.
+    When several processes use the same database, the claim method atomically checks and writes the date of an address.
+    When several nodes use the same database, each mailbox is checked by the node holding its lease. The nodes write their heartbeats and
+    a fencing token is given to the holder of a lease, incremented when another node takes the lease, so the synchronization state written
+    by a node which has lost the lease is ignored.
+    """
+    SCHEMA_VERSION: int = 5
+    SELECT_DATE: str = 'SELECT date FROM senders WHERE mailbox=? AND mail=?'
+    UPSERT: str = 'INSERT INTO senders (mailbox, mail, date) VALUES (?, ?, ?) ON CONFLICT(mailbox, mail) DO UPDATE SET date=excluded.date'
+    DELETE: str = 'DELETE FROM senders WHERE mailbox=? AND mail=?'
+    COUNT: str = 'SELECT count(*) FROM senders'
+    PURGE: str = 'DELETE FROM senders WHERE id IN (SELECT id FROM senders WHERE mailbox=? AND date<? LIMIT ?)'
+    SELECT_SYNC_STATE: str = 'SELECT uidvalidity, last_uid FROM sync_state WHERE mailbox=?'
+    # The state is only written when no fencing token is given or when the token is the one of the lease
+    UPSERT_SYNC_STATE: str = ('INSERT INTO sync_state (mailbox, uidvalidity, last_uid) SELECT ?, ?, ? '
+                              'WHERE ? IS NULL OR EXISTS (SELECT 1 FROM leases WHERE mailbox=? AND token=?) '
+                              'ON CONFLICT(mailbox) DO UPDATE SET uidvalidity=excluded.uidvalidity, last_uid=excluded.last_uid')
+    SELECT_LEASE: str = 'SELECT node, token, expires FROM leases WHERE mailbox=?'
+    UPSERT_LEASE: str = ('INSERT INTO leases (mailbox, node, token, expires) VALUES (?, ?, ?, ?) '
+                         'ON CONFLICT(mailbox) DO UPDATE SET node=excluded.node, token=excluded.token, expires=excluded.expires')
+    RELEASE_LEASE: str = 'UPDATE leases SET expires=? WHERE mailbox=? AND node=? AND token=?'
+    UPSERT_NODE: str = 'INSERT INTO nodes (node, heartbeat) VALUES (?, ?) ON CONFLICT(node) DO UPDATE SET heartbeat=excluded.heartbeat'
+    SELECT_NODES: str = 'SELECT node FROM nodes WHERE heartbeat>=? ORDER BY node'
+    __logger: logging.Logger = None
+    __path: str = None
+    __con: sqlite3.Connection = None
+
+    def __init__(self, path: str, logger: logging.Logger, cache_size: int = BLOCK_CACHE_SIZE, ttl: float = 12 * 3600):
+        """
+        Initialize
+        :param path: the path of the database
+        :param logger: the logger
+        :param cache_size: the maximum number of addresses kept in memory
+        :param ttl: the time to live in seconds of the addresses kept in memory, usually the block duration
+        """
+        self.__path = path
+        self.__logger = logger
+        self.__lock: threading.RLock = threading.RLock()
+        self.__cache: TTLCache = TTLCache(cache_size, ttl)
+        self.__pending: dict[tuple[str, str], int] = {}  # Dates not yet written by mailbox and address
+        self.__pending_sync: dict[str, tuple[int, int, int]] = {}  # Synchronization states and fencing tokens not yet written by mailbox
+
+    def open(self) -> None:
+        """
+        Open the connection and migrate the schema if required.
+        """
+        with self.__lock:
+            if self.__con:
+                return
+            self.__logger.info('Connecting to the database: %s...', self.__path)
+            # Transactions are explicitly handled
+            self.__con = sqlite3.connect(self.__path, isolation_level=None, check_same_thread=False, cached_statements=64)
+            # Only applied to a new database, the existing ones are converted by the migration
+            self.__con.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.__con.execute('PRAGMA journal_mode=WAL')
+            self.__con.execute('PRAGMA synchronous=NORMAL')
+            self._migrate()
+            self.__logger.info('Connected to the database, entries in table: %s', str(self.count()))
+
+    def close(self) -> None:
+        """
+        Write the pending dates and close the connection.
+        """
+        with self.__lock:
+            if self.__con:
+                self.flush()
+                self.__logger.debug('Closing the database...')
+                self.__con.close()
+                self.__con = None
+
+    def _migrate(self) -> None:
+        """
+        Create or upgrade the schema.
+        Version 1 stores the dates as integers (seconds since epoch) and uses a unique index on the addresses.
+        Version 2 associates the addresses to the mailboxes.
+        Version 3 adds the synchronization state of the mailboxes.
+        Version 4 adds an index on the dates used by the purge and converts the database to the incremental vacuum.
+        Version 5 adds the leases of the mailboxes and the heartbeats of the nodes.
+        """
+        version: int = self.__con.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SenderStore.SCHEMA_VERSION:
+            return
+        self.__logger.info('Migrating the database from version %s to %s...', str(version), str(SenderStore.SCHEMA_VERSION))
+        self.__con.execute('BEGIN IMMEDIATE')
+        try:
+            if version < 1:
+                legacy: bool = self.__con.execute("SELECT count(*) FROM sqlite_master WHERE type='table' AND name='senders'").fetchone()[0] > 0
+                self.__con.execute('CREATE TABLE senders_v1 (id INTEGER PRIMARY KEY, mail TEXT NOT NULL, date INTEGER NOT NULL)')
+                if legacy:
+                    # Dates were stored as text using the local time
+                    self.__con.execute("INSERT INTO senders_v1 (mail, date) SELECT mail, max(CAST(strftime('%s', date, 'utc') AS INTEGER)) "
+                                       "FROM senders WHERE mail IS NOT NULL AND date IS NOT NULL GROUP BY mail")
+                    self.__con.execute('DROP TABLE senders')
+                self.__con.execute('ALTER TABLE senders_v1 RENAME TO senders')
+                self.__con.execute('CREATE UNIQUE INDEX senders_mail ON senders (mail)')
+            if version < 2:
+                self.__con.execute("ALTER TABLE senders ADD COLUMN mailbox TEXT NOT NULL DEFAULT ''")
+                self.__con.execute('DROP INDEX senders_mail')
+                self.__con.execute('CREATE UNIQUE INDEX senders_mailbox_mail ON senders (mailbox, mail)')
+            if version < 3:
+                self.__con.execute('CREATE TABLE sync_state (mailbox TEXT PRIMARY KEY, uidvalidity INTEGER NOT NULL, last_uid INTEGER NOT NULL)')
+            if version < 4:
+                self.__con.execute('CREATE INDEX senders_date ON senders (date)')
+            if version < 5:
+                self.__con.execute('CREATE TABLE leases (mailbox TEXT PRIMARY KEY, node TEXT NOT NULL, token INTEGER NOT NULL, expires INTEGER NOT NULL)')
+                self.__con.execute('CREATE TABLE nodes (node TEXT PRIMARY KEY, heartbeat INTEGER NOT NULL)')
+            self.__con.execute(f'PRAGMA user_version={SenderStore.SCHEMA_VERSION}')
+            self.__con.execute('COMMIT')
+        except sqlite3.Error:
+            self.__con.execute('ROLLBACK')
+            raise
+        # The vacuum mode of an existing database is only changed by a full vacuum, outside a transaction
+        if self.__con.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            self.__logger.info('Converting the database to the incremental vacuum...')
+            self.__con.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.__con.execute('VACUUM')
+        self.__logger.info('Database migrated')
+
+    def get(self, mail: str, mailbox: str = '') -> int:
+        """
+        Return the last date associated to the address
+        :param mail: the address
+        :param mailbox: the name of the mailbox
+        :return: the date in seconds since epoch or None
+        """
+        key: tuple[str, str] = (mailbox, mail)
+        with self.__lock:
+            result: int = self.__pending.get(key)
+            if result is None:
+                result = self.__cache.get(key)
+            if result is None:
+                row = self.__con.execute(SenderStore.SELECT_DATE, key).fetchone()
+                if row:
+                    result = row[0]
+                    self.__cache.put(key, result)
+        return result
+
+    def put(self, mail: str, date: int, mailbox: str = '') -> None:
+        """
+        Associate the date to the address, the date is written by the next flush
+        :param mail: the address
+        :param date: the date in seconds since epoch
+        :param mailbox: the name of the mailbox
+        """
+        key: tuple[str, str] = (mailbox, mail)
+        with self.__lock:
+            self.__pending[key] = date
+            self.__cache.put(key, date)
+
+    def claim(self, mail: str, date: int, since: int, mailbox: str = '') -> bool:
+        """
+        Associate the date to the address unless the address is associated to a date not older than the given one.
+        The date is checked and written using an immediate transaction, so only one of the processes sharing the database can claim the address.
+        :param mail: the address
+        :param date: the date in seconds since epoch
+        :param since: the date in seconds since epoch from which the address is blocked
+        :param mailbox: the name of the mailbox
+        :return: True if the address has been claimed, False if it is blocked
+        """
+        key: tuple[str, str] = (mailbox, mail)
+        with self.__lock:
+            then: int = self.__pending.get(key)
+            if then is None:
+                then = self.__cache.get(key)
+            if then is not None and then >= since:
+                return False
+            self.__con.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.__con.execute(SenderStore.SELECT_DATE, key).fetchone()
+                if row and row[0] >= since:
+                    self.__con.execute('COMMIT')
+                    self.__cache.put(key, row[0])
+                    return False
+                self.__con.execute(SenderStore.UPSERT, (mailbox, mail, date))
+                self.__con.execute('COMMIT')
+            except sqlite3.Error:
+                self.__con.execute('ROLLBACK')
+                raise
+            self.__pending.pop(key, None)
+            self.__cache.put(key, date)
+        return True
+
+    def remove(self, mail: str, mailbox: str = '') -> None:
+        """
+        Remove the date associated to the address, used when the reply to the address has not been sent
+        :param mail: the address
+        :param mailbox: the name of the mailbox
+        """
+        key: tuple[str, str] = (mailbox, mail)
+        with self.__lock:
+            self.__pending.pop(key, None)
+            self.__cache.remove(key)
+            if self.__con:
+                self.__con.execute(SenderStore.DELETE, key)
+
+    def invalidate(self) -> None:
+        """
+        Remove the addresses kept in memory, used when the database has been modified by other processes.
+        """
+        with self.__lock:
+            self.__cache.clear()
+
+    def get_sync_state(self, mailbox: str = '') -> tuple[int, int]:
+        """
+        Return the synchronization state of the mailbox
+        :param mailbox: the name of the mailbox
+        :return: the tuple (UIDVALIDITY, last processed UID) or None if the mailbox has never been synchronized
+        """
+        with self.__lock:
+            pending: tuple[int, int, int] = self.__pending_sync.get(mailbox)
+            if pending is not None:
+                return pending[0], pending[1]
+            row = self.__con.execute(SenderStore.SELECT_SYNC_STATE, (mailbox,)).fetchone()
+        if row:
+            return row[0], row[1]
+        return None
+
+    def put_sync_state(self, uidvalidity: int, last_uid: int, mailbox: str = '', token: int = None) -> None:
+        """
+        Set the synchronization state of the mailbox, the state is written by the next flush with the pending dates
+        :param uidvalidity: the UIDVALIDITY of the mailbox
+        :param last_uid: the last processed UID
+        :param mailbox: the name of the mailbox
+        :param token: the fencing token of the lease of the mailbox, the state is not written if the lease has been taken by another node
+        """
+        with self.__lock:
+            self.__pending_sync[mailbox] = (uidvalidity, last_uid, token)
+
+    def acquire_lease(self, mailbox: str, node: str, now: int, duration: int, since: int, *, nodes: list[str] = None) -> int:
+        """
+        Acquire or renew the lease of the mailbox using an immediate transaction.
+        The lease is renewed if held by the node and taken if it does not exist, if it has expired before the given date or if it has expired
+        and its holder is not alive.
+        :param mailbox: the name of the mailbox
+        :param node: the name of the node
+        :param now: the current date in seconds since epoch
+        :param duration: the duration of the lease in seconds
+        :param since: the date in seconds since epoch before which the expired lease of another node can be taken
+        :param nodes: the nodes alive or None if unknown
+        :return: the fencing token or None if the lease is held by another node
+        """
+        with self.__lock:
+            self.__con.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.__con.execute(SenderStore.SELECT_LEASE, (mailbox,)).fetchone()
+                token: int = None
+                if row is None:
+                    token = 1
+                elif row[0] == node:
+                    token = row[1]
+                elif row[2] <= since or (row[2] <= now and nodes is not None and row[0] not in nodes):
+                    token = row[1] + 1
+                if token is not None:
+                    self.__con.execute(SenderStore.UPSERT_LEASE, (mailbox, node, token, now + duration))
+                self.__con.execute('COMMIT')
+            except sqlite3.Error:
+                self.__con.execute('ROLLBACK')
+                raise
+        return token
+
+    def release_lease(self, mailbox: str, node: str, token: int, expires: int = 0) -> None:
+        """
+        Release the lease of the mailbox if still held by the node using the given token
+        :param mailbox: the name of the mailbox
+        :param node: the name of the node
+        :param token: the fencing token
+        :param expires: the expiration date in seconds since epoch, 0 to let any node take the lease
+        """
+        with self.__lock:
+            self.__con.execute(SenderStore.RELEASE_LEASE, (expires, mailbox, node, token))
+
+    def heartbeat(self, node: str, now: int) -> None:
+        """
+        Write the heartbeat of the node
+        :param node: the name of the node
+        :param now: the current date in seconds since epoch
+        """
+        with self.__lock:
+            self.__con.execute(SenderStore.UPSERT_NODE, (node, now))
+
+    def get_nodes(self, since: int) -> list[str]:
+        """
+        Return the nodes alive
+        :param since: the date in seconds since epoch of the oldest heartbeat of a node alive
+        :return: the names of the nodes
+        """
+        with self.__lock:
+            return [row[0] for row in self.__con.execute(SenderStore.SELECT_NODES, (since,))]
+
+    def flush(self) -> None:
+        """
+        Write the pending dates and synchronization states using a single transaction.
+        """
+        with self.__lock:
+            if (not self.__pending and not self.__pending_sync) or not self.__con:
+                return
+            self.__con.execute('BEGIN')
+            try:
+                self.__con.executemany(SenderStore.UPSERT, ((k[0], k[1], v) for k, v in self.__pending.items()))
+                self.__con.executemany(SenderStore.UPSERT_SYNC_STATE, ((k, v[0], v[1], v[2], k, v[2]) for k, v in self.__pending_sync.items()))
+                self.__con.execute('COMMIT')
+            except sqlite3.Error:
+                self.__con.execute('ROLLBACK')
+                raise
+            if self.__logger.isEnabledFor(logging.DEBUG):
+                self.__logger.debug('Entries written in the database: %s', str(len(self.__pending)))
+            self.__pending.clear()
+            self.__pending_sync.clear()
+
+    def count(self) -> int:
+        """
+        Return the number of addresses
+        :return: the number of entries
+        """
+        with self.__lock:
+            self.flush()
+            return self.__con.execute(SenderStore.COUNT).fetchone()[0]
+
+    def get_size(self) -> int:
+        """
+        Return the size of the database, excluding the journal
+        :return: the size in bytes
+        """
+        with self.__lock:
+            return self.__con.execute('PRAGMA page_count').fetchone()[0] * self.__con.execute('PRAGMA page_size').fetchone()[0]
+
+    def purge(self, before: int, mailbox: str = '') -> int:
+        """
+        Delete the addresses of the mailbox associated to a date older than the given one.
+        The rows are deleted by batches using a transaction for each one, so the other accesses are not blocked for a long time.
+        :param before: the date in seconds since epoch
+        :param mailbox: the name of the mailbox
+        :return: the number of deleted addresses
+        """
+        result: int = 0
+        while True:
+            with self.__lock:
+                self.flush()
+                deleted: int = self.__con.execute(SenderStore.PURGE, (mailbox, before, STORE_PURGE_BATCH_SIZE)).rowcount
+            result += deleted
+            if deleted < STORE_PURGE_BATCH_SIZE:
+                break
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Entries deleted from the database: %s', str(result))
+        return result
+
+    def compact(self) -> int:
+        """
+        Release a part of the free pages of the database and update the statistics of the query planner when required
+        :return: the number of released pages
+        """
+        with self.__lock:
+            free: int = self.__con.execute('PRAGMA freelist_count').fetchone()[0]
+            self.__con.execute(f'PRAGMA incremental_vacuum({STORE_VACUUM_PAGES})').fetchall()
+            result: int = free - self.__con.execute('PRAGMA freelist_count').fetchone()[0]
+            self.__con.execute('PRAGMA optimize')
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Pages released from the database: %s', str(result))
+        return result
+
+
+class TokenBucket:
+    """
+    Rate limiter using a token bucket.
+    The rate is reduced when the server reports a throttling and is progressively restored when the operations succeed.
+    """
+    __logger: logging.Logger = None
+    __name: str = None
+    __nominal_rate: float = 0  # Number of operations by second, 0 or negative for no limit
+    __rate: float = 0
+    __burst: int = 1
+    __tokens: float = 0
+    __updated: float = 0
+    __waited: float = 0  # Total time spent waiting for tokens in seconds
+
+    def __init__(self, name: str, rate: float, burst: int, logger: logging.Logger):
+        """
+        Initialize
+        :param name: the name used in the logs
+        :param rate: the number of operations by second, 0 or negative for no limit
+        :param burst: the maximum number of operations without waiting
+        :param logger: the logger
+        """
+        self.__name = name
+        self.__nominal_rate = rate
+        self.__rate = rate
+        self.__burst = max(1, burst)
+        self.__tokens = self.__burst
+        self.__updated = time.monotonic()
+        self.__logger = logger
+        self.__lock: threading.Lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token
+        :return: the delay in seconds to wait before doing the operation
+        """
+        if self.__nominal_rate <= 0:
+            return 0
+        with self.__lock:
+            now: float = time.monotonic()
+            self.__tokens = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= 1
+            if self.__tokens >= 0:
+                return 0
+            delay: float = -self.__tokens / self.__rate
+            self.__waited += delay
+            return delay
+
+    def acquire(self) -> float:
+        """
+        Take a token and wait if required
+        :return: the delay in seconds spent waiting
+        """
+        delay: float = self.reserve()
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    def throttle(self) -> None:
+        """
+        Halve the rate after a throttling response of the server.
+        """
+        if self.__nominal_rate <= 0:
+            return
+        with self.__lock:
+            self.__rate = max(self.__nominal_rate / TOKEN_BUCKET_MAX_SLOWDOWN, self.__rate / 2)
+            self.__tokens = min(self.__tokens, 0)
+        self.__logger.warning('Throttled by the server, %s', str(self))
+
+    def succeed(self) -> None:
+        """
+        Restore progressively the rate after a successful operation.
+        """
+        if self.__rate >= self.__nominal_rate:
+            return
+        with self.__lock:
+            self.__rate = min(self.__nominal_rate, self.__rate * TOKEN_BUCKET_RECOVERY)
+            restored: bool = self.__rate >= self.__nominal_rate
+        if restored:
+            self.__logger.info('Rate restored, %s', str(self))
+
+    def __str__(self) -> str:
+        if self.__nominal_rate <= 0:
+            return self.__name + ' rate: unlimited'
+        return (self.__name + ' rate: ' + f'{self.__rate:.3g}' + '/s (nominal: ' + f'{self.__nominal_rate:.3g}' + '/s, burst: ' + str(self.__burst)
+                + ', tokens: ' + f'{max(0.0, self.__tokens):.1f}' + ', waited: ' + f'{self.__waited:.1f}' + 's)')
+
+
+class Metrics:
+    """
+    Thread safe registry of counters, gauges and histograms, exposed using the Prometheus text format or as a dictionary.
+    The values are identified by the name of the metric and by labels, like the name of the mailbox.
+    """
+    __lock: threading.Lock = None
+    __counters: dict[tuple[str, tuple], float] = {}
+    __gauges: dict[tuple[str, tuple], float] = {}
+    __histograms: dict[tuple[str, tuple], list[float]] = {}  # Count by bucket, then the sum and the count of the observations
+
+    def __init__(self):
+        """
+        Initialize
+        """
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        Increment a counter
+        :param name: the name of the counter
+        :param value: the increment
+        :param labels: the labels
+        """
+        key: tuple[str, tuple] = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """
+        Set the value of a gauge
+        :param name: the name of the gauge
+        :param value: the value
+        :param labels: the labels
+        """
+        with self.__lock:
+            self.__gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add(self, name: str, value: float, **labels) -> None:
+        """
+        Add a value to a gauge
+        :param name: the name of the gauge
+        :param value: the value to add, negative to decrease the gauge
+        :param labels: the labels
+        """
+        key: tuple[str, tuple] = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__gauges[key] = self.__gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """
+        Add an observation to a histogram
+        :param name: the name of the histogram
+        :param value: the observed value, usually a duration in seconds
+        :param labels: the labels
+        """
+        key: tuple[str, tuple] = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram: list[float] = self.__histograms.get(key)
+            if histogram is None:
+                histogram = [0] * (len(METRICS_BUCKETS) + 2)
+                self.__histograms[key] = histogram
+            for i, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def merge(self, values: dict[str, list[dict]]) -> None:
+        """
+        Add the counters and the histograms of a snapshot, like the one of a worker process, the gauges are ignored
+        :param values: the snapshot
+        """
+        for name, items in values.items():
+            for item in items:
+                if 'buckets' not in item:
+                    if METRICS_TYPES.get(name) == 'counter':
+                        self.inc(name, item['value'], **item['labels'])
+                    continue
+                key: tuple[str, tuple] = (name, tuple(sorted(item['labels'].items())))
+                with self.__lock:
+                    histogram: list[float] = self.__histograms.get(key)
+                    if histogram is None:
+                        histogram = [0] * (len(METRICS_BUCKETS) + 2)
+                        self.__histograms[key] = histogram
+                    previous: int = 0
+                    for i, count in enumerate(item['buckets'].values()):
+                        histogram[i] += count - previous
+                        previous = count
+                    histogram[-2] += item['sum']
+                    histogram[-1] += item['count']
+
+    def get(self, name: str, **labels) -> float:
+        """
+        Return the sum of the values of a counter or a gauge having at least the given labels
+        :param name: the name of the counter or gauge
+        :param labels: the labels
+        :return: the sum of the values, 0 if not found
+        """
+        result: float = 0
+        with self.__lock:
+            for (k, values), value in list(self.__counters.items()) + list(self.__gauges.items()):
+                if k == name and labels.items() <= dict(values).items():
+                    result += value
+        return result
+
+    def snapshot(self) -> dict[str, list[dict]]:
+        """
+        Return the values of the metrics, the result can be serialized using JSON
+        :return: the list of the values by name of metric, each value has the labels and the value or the buckets, the sum and the count
+        """
+        result: dict[str, list[dict]] = {}
+        with self.__lock:
+            for (name, labels), value in list(self.__counters.items()) + list(self.__gauges.items()):
+                result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in self.__histograms.items():
+                buckets: dict[str, int] = {}
+                total: int = 0
+                for bound, count in zip(METRICS_BUCKETS, histogram):
+                    total += count
+                    buckets[str(bound)] = total
+                result.setdefault(name, []).append({'labels': dict(labels), 'buckets': buckets, 'sum': histogram[-2], 'count': histogram[-1]})
+        return result
+
+    @staticmethod
+    def _format_labels(labels: dict[str, str]) -> str:
+        """
+        Format the labels using the Prometheus text format
+        :param labels: the labels
+        :return: the labels between braces or an empty string
+        """
+        if not labels:
+            return ''
+        values: list[str] = []
+        for k, v in labels.items():
+            values.append(k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"')
+        return '{' + ','.join(values) + '}'
+
+    def to_prometheus(self) -> str:
+        """
+        Return the values of the metrics using the Prometheus text format (version 0.0.4)
+        :return: the text
+        """
+        buffer: StringIO = StringIO()
+        for name, values in sorted(self.snapshot().items()):
+            buffer.write('# HELP ' + name + ' ' + METRICS_HELP.get(name, name) + '\n')
+            buffer.write('# TYPE ' + name + ' ' + METRICS_TYPES.get(name, 'untyped') + '\n')
+            for value in values:
+                labels: dict[str, str] = value['labels']
+                if 'buckets' not in value:
+                    buffer.write(name + Metrics._format_labels(labels) + ' ' + repr(float(value['value'])) + '\n')
+                    continue
+                for bound, count in value['buckets'].items():
+                    buffer.write(name + '_bucket' + Metrics._format_labels({**labels, 'le': bound}) + ' ' + str(count) + '\n')
+                buffer.write(name + '_bucket' + Metrics._format_labels({**labels, 'le': '+Inf'}) + ' ' + str(value['count']) + '\n')
+                buffer.write(name + '_sum' + Metrics._format_labels(labels) + ' ' + repr(float(value['sum'])) + '\n')
+                buffer.write(name + '_count' + Metrics._format_labels(labels) + ' ' + str(value['count']) + '\n')
+        return buffer.getvalue()
+
+
+def create_metrics_request_handler() -> type:
+    """
+    Create the class of the handler of the requests of the metrics server, the http.server module is imported on first use
+    :return: the class
+    """
+    # pylint: disable=import-outside-toplevel
+    import json
+    from http.server import BaseHTTPRequestHandler
+    # pylint: enable=import-outside-toplevel
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        """
+        Handler of the requests of the metrics server: /metrics returns the Prometheus text format and /metrics.json the JSON snapshot.
+        """
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            """
+            Handle the GET requests.
+            """
+            path: str = self.path.split('?')[0]
+            if path == '/metrics':
+                body: bytes = self.server.metrics.to_prometheus().encode('utf-8')
+                content_type: str = 'text/plain; version=0.0.4; charset=utf-8'
+            elif path == '/metrics.json':
+                body: bytes = json.dumps(self.server.metrics.snapshot()).encode('utf-8')
+                content_type: str = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            """
+            Write the requests in the logs using the DEBUG level
+            :param format: the format
+            :param args: the arguments
+            """
+            if self.server.logger.isEnabledFor(logging.DEBUG):
+                self.server.logger.debug('Metrics request: ' + (format % args))
+    return MetricsRequestHandler
+
+
+class MetricsServer:
+    """
+    Local HTTP server exposing the metrics, the requests are handled by daemon threads.
+    """
+    __logger: logging.Logger = None
+    __server: ThreadingHTTPServer = None
+
+    def __init__(self, metrics: Metrics, address: str, port: int, logger: logging.Logger):
+        """
+        Initialize
+        :param metrics: the metrics
+        :param address: the address to listen on
+        :param port: the port to listen on, 0 to use a free port
+        :param logger: the logger
+        """
+        self.__metrics = metrics
+        self.__address = address
+        self.__port = port
+        self.__logger = logger
+
+    @property
+    def port(self) -> int:
+        """
+        Return the port of the server
+        :return: the port or None if not started
+        """
+        if self.__server is None:
+            return None
+        return self.__server.server_address[1]
+
+    def start(self) -> None:
+        """
+        Start listening in a daemon thread.
+        """
+        if self.__server is not None:
+            return
+        # pylint: disable=import-outside-toplevel
+        from http.server import ThreadingHTTPServer
+        # pylint: enable=import-outside-toplevel
+        self.__server = ThreadingHTTPServer((self.__address, self.__port), create_metrics_request_handler())
+        self.__server.daemon_threads = True
+        self.__server.metrics = self.__metrics
+        self.__server.logger = self.__logger
+        threading.Thread(target=self.__server.serve_forever, name='metrics', daemon=True).start()
+        self.__logger.info('Metrics available on http://%s:%s/metrics', self.__address, str(self.port))
+
+    def stop(self) -> None:
+        """
+        Stop the server.
+        """
+        if self.__server is None:
+            return
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__server = None
+
+
+class SmtpSession:
+    """
+    Connection to the SMTP server opened on demand.
+    The connection is checked using NOOP before sending a batch of messages, it is closed when it stays idle longer than the maximum
+    idle delay and only the SMTP connection is opened again when the server closes it.
+    """
+    __logger: logging.Logger = None
+    __settings: AutoReplierSettings = None
+    __smtp: SMTP = None
+    __last_use: float = 0
+
+    def __init__(self, settings: AutoReplierSettings, logger: logging.Logger):
+        """
+        Initialize
+        :param settings: the settings
+        :param logger: the logger
+        """
+        self.__settings = settings
+        self.__logger = logger
+        self.__lock: threading.RLock = threading.RLock()
+
+    def _connect(self) -> SMTP:
+        """
+        Connect and login on the SMTP server.
+        :return: the connection
+        """
+        if self.__settings.smtp_use_ssl:
+            if self.__logger.isEnabledFor(logging.DEBUG):
+                self.__logger.debug('Using SMTP SSL and server: ' + self.__settings.smtp_server + ' and port: ' + str(self.__settings.smtp_port))
+            smtp: SMTP = SMTP_SSL(self.__settings.smtp_server, self.__settings.smtp_port, timeout=self.__settings.smtp_timeout)
+        else:
+            if self.__logger.isEnabledFor(logging.DEBUG):
+                self.__logger.debug('Using SMTP and server: ' + self.__settings.smtp_server + ' and port: ' + str(self.__settings.smtp_port))
+            smtp: SMTP = SMTP(self.__settings.smtp_server, self.__settings.smtp_port, timeout=self.__settings.smtp_timeout)
+        v: str = base64.b64decode(self.__settings.smtp_password).decode('utf8')
+        self.__logger.info('SMTP login using user: ' + self.__settings.smtp_user + ' and password: ' + re.sub('.', '*', v) + '...')
+        smtp.login(self.__settings.smtp_user, v)
+        return smtp
+
+    def _get(self) -> SMTP:
+        """
+        Return the connection, the connection is opened if required.
+        :return: the connection
+        """
+        if self.__smtp is not None and time.monotonic() - self.__last_use > self.__settings.smtp_max_idle:
+            self.__logger.debug('SMTP connection idle for too long, reconnecting...')
+            self.close()
+        if self.__smtp is None:
+            self.__smtp = self._connect()
+        self.__last_use = time.monotonic()
+        return self.__smtp
+
+    def is_connected(self) -> bool:
+        """
+        Check if the connection is opened.
+        :return: True if opened
+        """
+        return self.__smtp is not None
+
+    def check(self) -> None:
+        """
+        Check the connection using NOOP before sending a batch of messages, the connection is closed if the server does not respond.
+        """
+        with self.__lock:
+            if self.__smtp is None or time.monotonic() - self.__last_use > self.__settings.smtp_max_idle:
+                return
+            try:
+                code, _ = self.__smtp.noop()
+                if code == 250:
+                    self.__last_use = time.monotonic()
+                    return
+                self.__logger.debug('SMTP NOOP returned: %s', str(code))
+            except OSError as ex:
+                self.__logger.debug('SMTP NOOP failed: %s', str(ex))
+            self.close()
+
+    def send(self, from_addr: str, to_addrs: list[str], msg: bytes) -> None:
+        """
+        Send the message, the connection is opened again if the server closed it and closed when it fails, so the next message opens it again.
+        :param from_addr: the address of the sender
+        :param to_addrs: the addresses of the recipients
+        :param msg: the message
+        """
+        with self.__lock:
+            try:
+                try:
+                    self._get().sendmail(from_addr, to_addrs, msg)
+                except SMTPServerDisconnected:
+                    self.__logger.warning('SMTP connection closed by the server, reconnecting...')
+                    self.close()
+                    self._get().sendmail(from_addr, to_addrs, msg)
+            except (SMTPResponseException, SMTPRecipientsRefused):
+                # Rejected by the server, the connection can still be used
+                raise
+            except OSError:
+                self.close()
+                raise
+            self.__last_use = time.monotonic()
+
+    def close_if_idle(self) -> None:
+        """
+        Close the connection if it stayed idle longer than the maximum idle delay.
+        """
+        with self.__lock:
+            if self.__smtp is not None and time.monotonic() - self.__last_use > self.__settings.smtp_max_idle:
+                self.__logger.debug('Closing idle SMTP connection...')
+                self.close()
+
+    def close(self) -> None:
+        """
+        Close the connection.
+        """
+        with self.__lock:
+            if self.__smtp is None:
+                return
+            try:
+                self.__smtp.quit()
+            except OSError:
+                self.__smtp.close()
+            self.__smtp = None
+
+
+class PreparedReply:
+    """
+    Reply built and serialized once, only the headers depending on the incoming message are added when it is rendered.
+    """
+    __headers: bytes = b''  # Serialized headers of the reply (Content-Type, MIME-Version, Content-Language)
+    __body: bytes = b''  # Serialized body of the reply, starting with the empty line separating it from the headers
+    __policy: email.policy.Policy = None
+
+    def __init__(self, mail: MIMEMultipart):
+        """
+        Initialize
+        :param mail: the reply without the headers depending on the incoming message
+        """
+        self.__policy = mail.policy
+        data: bytes = mail.as_bytes()
+        separator: str = self.__policy.linesep.encode()
+        index: int = data.find(separator * 2)
+        if index < 0:
+            self.__headers = data
+            self.__body = separator
+        else:
+            self.__headers = data[:index + len(separator)]
+            self.__body = data[index + len(separator):]
+
+    def render(self, original: message.Message) -> bytes:
+        """
+        Render the reply to the given message
+        :param original: the original message
+        :return: the bytes of the reply
+        """
+        buffer: list[bytes] = [self.__headers]
+        for name, value in (('Message-ID', make_msgid()), ('References', original['Message-ID']), ('In-Reply-To', original['Message-ID']),
+                            ('Subject', 'Re: ' + original['Subject']), ('From', get_address(original['To'])), ('To', original['Reply-To'] or original['From'])):
+            if value is not None:
+                buffer.append(self.__policy.fold_binary(name, value))
+        buffer.append(self.__body)
+        return b''.join(buffer)
+
+
+class AutoReplier:
+    """
+    Read your unread and unanswered messages and reply automatically if a template is available using the same address as the recipient of the incoming message.
+    """
+    __logger: logging.Logger = None
+    __settings: AutoReplierSettings = None
+    __imap: IMAP4 = None
+    __smtp: SmtpSession = None
+    __smtp_sessions: list[SmtpSession] = []  # Sessions used by the send workers of the pipeline, the first one is the default session
+    __store: SenderStore = None
+    __active: bool = False
+    __test: bool = False
+    __imap_limiter: TokenBucket = None
+    __smtp_limiter: TokenBucket = None
+    __age_in_days: int = 1
+    __login_retries: int = 10  # Maximum number of consecutive attempts to connect after a transient error
+    __html_templates: dict[str, dict[str, ReplyTemplate]] = {}  # List of reply templates in HTML by address and language
+    __text_templates: dict[str, dict[str, ReplyTemplate]] = {}  # List of reply templates in plain text by address and language
+    __replies: dict[tuple[str, str], PreparedReply] = {}  # Replies prepared by address and language
+    __detector: LanguageDetector = None  # Detector of the languages of the templates
+    __languages: TTLCache = None  # Languages detected by sender
+    __skip_rules: SkipRules = None  # Rules describing the addresses, domains and subjects to ignore
+    __metrics: Metrics = None
+    __metrics_server: MetricsServer = None
+    __last_uid: int = None  # Highest UID checked by the last search
+    __flagged: list[int] = []  # Messages to flag at the end of the cycle
+    __failed: list[int] = []  # Messages whose reply has not been sent during the cycle
+    __next_maintenance: float = 0  # Monotonic time of the next maintenance of the database
+    __config_mtime: int = None  # Modification time in nanoseconds of the configuration file used by the current settings
+    __config_changed: bool = False  # True when the configuration file has been modified and not yet reloaded
+    __next_reload_check: float = 0  # Monotonic time of the next check of the modification of the configuration file
+    __claim: bool = False  # True to claim the senders in the database, when the messages of the mailbox are processed by several processes
+    __lease_token: int = None  # Fencing token of the lease of the mailbox or None if the lease is not held
+    __next_lease_renewal: float = 0  # Monotonic time of the next renewal of the lease
+    __selected: bool = False  # True when the mailbox is selected, the selection is kept across the checks
+    __uidvalidity: int = None  # UIDVALIDITY reported by the server for the selected mailbox
+    __last_noop: float = 0  # Monotonic time of the last command checking the IMAP connection (SELECT, NOOP or end of IDLE)
+
+    def __init__(self, settings: AutoReplierSettings, logger: logging.Logger, store: SenderStore = None, login: bool = True, metrics: Metrics = None, *,
+                 hooks: bool = True):
+        """
+        Initialize and login
+        :param settings: the settings
+        :param logger: the logger
+        :param store: the store of the senders shared with other repliers or None to use a store dedicated to this replier
+        :param login: False to skip the login, the replier can only prepare replies until it is started
+        :param metrics: the metrics shared with other repliers or None to use metrics dedicated to this replier
+        :param hooks: False to not register the exit and interruption handlers, when they are registered by the pool hosting the replier
+        """
+        self.__settings = settings
+        self.__logger = logger
+        self.__logger.info('Initializing ' + self.__class__.__name__ + '...')
+        self.__html_templates = {}
+        self.__text_templates = {}
+        self.__replies = {}
+        self.__smtp_sessions = []
+        self.__flagged = []
+        self.__failed = []
+        self.__config_mtime = self._get_configuration_mtime()
+        self.__languages = TTLCache(LANGUAGE_CACHE_SIZE, LANGUAGE_CACHE_TTL)
+        self.__store = store
+        self.__store_shared: bool = store is not None
+        self.__metrics = metrics if metrics is not None else Metrics()
+        self.__metrics.set(METRIC_REFRESH_DELAY, settings.refresh_delay, mailbox=settings.name)
+        self.__imap_limiter = TokenBucket('IMAP', settings.imap_rate, settings.imap_burst, logger)
+        self.__smtp_limiter = TokenBucket('SMTP', settings.smtp_rate, settings.smtp_burst, logger)
+        # Status flags
+        self.__active = False
+        # Locks
+        self.__lock: threading.RLock = threading.RLock()
+        self.__start_lock: threading.RLock = threading.RLock()
+        self.__stop_lock: threading.RLock = threading.RLock()
+        # Hooks
+        if hooks:
+            atexit.register(self.stop)
+            signal.signal(signal.SIGINT, self.stop)
+        self._initialize()
+        if login:
+            self._login()
+
+    # noinspection PyTypeChecker
+    def _initialize(self) -> None:
+        """
+        Do some preprocessing tasks.
+        """
+        for template in self.__settings.templates:
+            if template.body is not None and template.lang is not None:
+                if template.lang == 'en':
+                    new_locale = 'en_US.utf8'
+                else:
+                    new_locale = template.lang.lower() + '_' + template.lang.upper() + '.utf8'
+                if self.__logger.isEnabledFor(logging.DEBUG):
+                    self.__logger.debug('Locale for template: ' + new_locale)
+                previous_locale: str = locale.getlocale(locale.LC_TIME)
+                try:
+                    locale.setlocale(locale.LC_TIME, new_locale)
+                except locale.Error:
+                    self.__logger.warning('Locale not available: %s, the date is formatted using the current locale', new_locale)
+                template.body = template.body.replace('${date}', self.__settings.date.strftime("%A %-d %B %Y"))
+                locale.setlocale(locale.LC_TIME, previous_locale)
+            #HTML or text template ?
+            d1: dict[str, dict[str, ReplyTemplate]] = self.__text_templates
+            if template.type == ReplyTemplateType.HTML:
+                d1 = self.__html_templates
+            #Set default if not already done
+            if DEFAULT_KEY in d1:
+                d2: dict[str, ReplyTemplate] = d1[DEFAULT_KEY]
+            else:
+                d2: dict[str, ReplyTemplate] = {}
+                d1[DEFAULT_KEY] = d2
+            if len(d2) == 0:
+                d2[DEFAULT_KEY] = template
+                if self.__logger.isEnabledFor(logging.DEBUG):
+                    self.__logger.debug('Template added to default: ' + str(template))
+            #Set using email
+            if template.email:
+                if template.email in d1:
+                    d2: dict[str, ReplyTemplate] = d1[template.email]
+                else:
+                    d2: dict[str, ReplyTemplate] = {}
+                    d1[template.email] = d2
+            else:
+                d2 = d1[DEFAULT_KEY]
+            #Set using language
+            if template.lang:
+                if template.lang not in d2:
+                    d2[template.lang] = template
+                    if self.__logger.isEnabledFor(logging.DEBUG):
+                        self.__logger.debug('Template added to ' + template.lang + ': ' + str(template))
+            else:
+                d2[DEFAULT_KEY] = template
+        self._prepare_replies()
+        self.__detector = LanguageDetector([v.lang for v in self.__settings.templates])
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Languages detected: ' + ', '.join(self.__detector.languages))
+        self.__skip_rules = SkipRules(self.__settings.skipped_addresses, self.__settings.skipped_domains, self.__settings.skipped_subjects, self.__logger)
+
+    def _get_configuration_mtime(self) -> int:
+        """
+        Return the modification time of the configuration file
+        :return: the time in nanoseconds or None if the settings have not been parsed from a file or if the file is not readable
+        """
+        if not self.__settings.config_path:
+            return None
+        try:
+            return os.stat(self.__settings.config_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _is_configuration_changed(self) -> bool:
+        """
+        Check if the configuration file has been modified since the settings have been parsed.
+        The file is checked at most one time per reload interval.
+        :return: True if the configuration must be reloaded
+        """
+        if not self.__config_changed and self.__settings.config_path and self.__settings.reload_interval > 0 and time.monotonic() >= self.__next_reload_check:
+            self.__next_reload_check = time.monotonic() + self.__settings.reload_interval
+            mtime: int = self._get_configuration_mtime()
+            self.__config_changed = mtime is not None and mtime != self.__config_mtime
+        return self.__config_changed
+
+    def _reload_configuration(self) -> None:
+        """
+        Parse the configuration file again and apply the new settings if the file has been modified.
+        """
+        if not self._is_configuration_changed():
+            return
+        self.__config_changed = False
+        self.__config_mtime = self._get_configuration_mtime()
+        self.__logger.info('Configuration modified, reloading %s...', self.__settings.config_path)
+        try:
+            settings: AutoReplierSettings = self.__settings.reload()
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            self.__logger.error('Configuration not reloaded, the current settings are kept: %s', str(ex))
+            return
+        # pylint: enable=broad-exception-caught
+        self.reload(settings)
+
+    def reload(self, settings: AutoReplierSettings) -> bool:
+        """
+        Apply new settings, must be called between two checks.
+        The templates, the prepared replies, the language detector and the skip rules are built before replacing the current ones,
+        so the current ones are kept if the new settings are not valid.
+        The IMAP and SMTP connections are kept unless their own settings have changed.
+        :param settings: the new settings
+        :return: True if the new settings have been applied
+        """
+        previous: AutoReplierSettings = self.__settings
+        state: tuple = (self.__text_templates, self.__html_templates, self.__replies, self.__detector, self.__skip_rules)
+        self.__settings = settings
+        self.__text_templates = {}
+        self.__html_templates = {}
+        self.__replies = {}
+        try:
+            self._initialize()
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
+            self.__logger.error('Settings not applied, the current settings are kept: %s', str(ex))
+            self.__settings = previous
+            self.__text_templates, self.__html_templates, self.__replies, self.__detector, self.__skip_rules = state
+            return False
+        # pylint: enable=broad-exception-caught
+        for name in ('db_path', 'block_cache_size', 'metrics_address', 'metrics_port'):
+            if getattr(settings, name) != getattr(previous, name):
+                self.__logger.warning('Setting %s is only applied on restart', name)
+        if (settings.imap_rate, settings.imap_burst) != (previous.imap_rate, previous.imap_burst):
+            self.__imap_limiter = TokenBucket('IMAP', settings.imap_rate, settings.imap_burst, self.__logger)
+        if (settings.smtp_rate, settings.smtp_burst) != (previous.smtp_rate, previous.smtp_burst):
+            self.__smtp_limiter = TokenBucket('SMTP', settings.smtp_rate, settings.smtp_burst, self.__logger)
+        self.__metrics.set(METRIC_REFRESH_DELAY, settings.refresh_delay, mailbox=settings.name)
+        if self.__smtp is not None and any(getattr(settings, v) != getattr(previous, v) for v in SMTP_SETTINGS + ('smtp_max_idle',)):
+            self.__logger.info('SMTP settings modified, closing the SMTP connections...')
+            for session in self.__smtp_sessions:
+                session.close()
+            self.__smtp = SmtpSession(settings, self.__logger)
+            self.__smtp_sessions = [self.__smtp]
+        if self.__imap is not None and any(getattr(settings, v) != getattr(previous, v) for v in IMAP_SETTINGS):
+            self.__logger.info('IMAP settings modified, connecting again...')
+            # pylint: disable=broad-exception-caught
+            try:
+                self.__imap.logout()
+            except Exception as ex:
+                self.__logger.warning('IMAP4 logout failed: %s', str(ex))
+            # pylint: enable=broad-exception-caught
+            self.__imap = None
+            self._login()
+        self.__logger.info('Settings applied')
+        return True
+
+    def _login(self) -> None:
+        """
+        Login on the IMAP server, the SMTP connection is opened when a message is sent.
+        The login is attempted again using an exponential backoff when the error is transient, the other errors like an authentication failure are raised.
+        """
+        self.__logger.info('Login...')
+        for attempt in range(self.__login_retries):
+            # pylint: disable=broad-exception-caught
+            try:
+                if self.__settings.imap_use_ssl:
+                    if self.__logger.isEnabledFor(logging.DEBUG):
+                        self.__logger.debug('Using IMAP4 SSL and server: ' + self.__settings.imap_server + ' and port: ' + str(self.__settings.imap_port))
+                    self.__imap = IMAP4_SSL(self.__settings.imap_server, self.__settings.imap_port, timeout=self.__settings.imap_timeout)
+                else:
+                    if self.__logger.isEnabledFor(logging.DEBUG):
+                        self.__logger.debug('Using IMAP4 and server: ' + self.__settings.imap_server + ' and port: ' + str(self.__settings.imap_port))
+                    self.__imap = IMAP4(self.__settings.imap_server, self.__settings.imap_port, timeout=self.__settings.imap_timeout)
+                v: str = base64.b64decode(self.__settings.imap_password).decode('utf8')
+                self.__logger.info('IMAP4 login using user: ' + self.__settings.imap_user + ' and password: ' + re.sub('.', '*', v) + '...')
+                self.__imap.login(self.__settings.imap_user, v)
+                self.__selected = False
+                self.__last_noop = time.monotonic()
+                if self.__smtp is None:
+                    self.__smtp = SmtpSession(self.__settings, self.__logger)
+                    self.__smtp_sessions = [self.__smtp]
+                self.__logger.info('Login done')
+                return
+            except Exception as ex:
+                self._disconnect()
+                if not is_transient_error(ex) or attempt + 1 >= self.__login_retries:
+                    raise
+                delay: float = get_backoff_delay(attempt, self.__settings.imap_reconnect_delay, self.__settings.imap_reconnect_max_delay)
+                self.__logger.warning('Login failed: %s, retrying in %.1f s', str(ex) or ex.__class__.__name__, delay)
+                sleep(delay)
+            # pylint: enable=broad-exception-caught
+
+    def _disconnect(self) -> None:
+        """
+        Close the IMAP connection without waiting for the server, used when the connection is broken.
+        """
+        self.__selected = False
+        if self.__imap is None:
+            return
+        try:
+            self.__imap.shutdown()
+        except OSError as ex:
+            self.__logger.debug('IMAP4 shutdown failed: %s', str(ex))
+        self.__imap = None
+
+    def _reconnect(self, ex: BaseException) -> None:
+        """
+        Open again the connection which has failed: the SMTP connections are closed when the error comes from the SMTP server,
+        they are opened again when a message is sent, otherwise the IMAP connection is dropped and the login is done again.
+        :param ex: the error
+        """
+        if isinstance(ex, SMTPException):
+            for session in self.__smtp_sessions:
+                session.close()
+            return
+        self._disconnect()
+        self._login()
+
+    def _supervise(self, function: Callable[..., object], *args) -> None:
+        """
+        Call the function using the IMAP connection and call it again after a new login when it fails on a transient error, like a timeout
+        or a connection closed by the server. The delay before the new login grows exponentially with the number of consecutive failures.
+        :param function: the function
+        :param args: the arguments of the function
+        """
+        for attempt in range(self.__login_retries):
+            # pylint: disable=broad-exception-caught
+            try:
+                function(*args)
+                return
+            except Exception as ex:
+                if not is_transient_error(ex) or attempt + 1 >= self.__login_retries:
+                    raise
+                self.__metrics.inc(METRIC_RECONNECTIONS, mailbox=self.__settings.name)
+                delay: float = get_backoff_delay(attempt - 1, self.__settings.imap_reconnect_delay, self.__settings.imap_reconnect_max_delay) if attempt > 0 else 0
+                self.__logger.warning('Connection lost: %s, reconnecting in %.1f s...', str(ex) or ex.__class__.__name__, delay)
+                sleep(delay)
+                self._reconnect(ex)
+            # pylint: enable=broad-exception-caught
+
+    def _logout(self) -> None:
+        """
+        Close the IMAP and SMTP connections.
+        """
+        if self.__smtp_sessions:
+            self.__logger.debug('Closing SMTP connections...')
+            for session in self.__smtp_sessions:
+                session.close()
+        if self.__imap:
+            self.__logger.debug('Closing IMAP4 connection...')
+            try:
+                self.__imap.logout()
+            except (IMAP4.error, OSError) as ex:
+                self.__logger.debug('IMAP4 logout failed: %s', str(ex))
+                self._disconnect()
+            self.__imap = None
+        self.__selected = False
+
+    def close(self) -> None:
+        """
+        Close the IMAP and SMTP connections and the database.
+        """
+        self.__logger.info('Closing...')
+        if self.__metrics_server:
+            self.__metrics_server.stop()
+        self._logout()
+        if self.__store:
+            self._flush()
+            self._release_lease()
+            if not self.__store_shared:
+                self.__store.close()
+        self.__logger.info('Closing done')
+
+    def _is_skipped(self, original: message.Message) -> bool:
+        """
+        Internal check if the message must be processed or not
+        :param original: the message
+        :return: true to skip processing
+        """
+        return self._get_skip_reason(original) is not None
+
+    def _get_skip_reason(self, original: message.Message) -> str:
+        """
+        Check if the message must be processed or not, the sender of a processed message is blocked during the block hours
+        :param original: the message
+        :return: the reason (address, domain, subject or block) or None to process the message
+        """
+        sender: str = get_address(original['Reply-To'] or original['From']) or ''
+        subject: str = original['Subject'] or ''
+        detailed: bool = self._is_detailed(original)
+        if detailed:
+            self.__logger.info('Incoming message from %s (%s). Checking history...', sender, subject)
+        # Check if sender address, domain or subject is ignored
+        domain: str = sender.rpartition('@')[2]
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Domain: ' + domain + ', subject: ' + subject)
+        rule: tuple[str, str] = self.__skip_rules.match(sender, domain, subject)
+        if rule:
+            if detailed:
+                self.__logger.info('Mail from %s is rejected by %s filter: %s', sender, rule[0], rule[1])
+            self.__metrics.inc(METRIC_SKIPPED, reason=rule[0], mailbox=self.__settings.name)
+            return rule[0]
+        # Check for recent incoming mails from this address
+        skipped: bool = False
+        now: int = int(time.time())
+        try:
+            start: float = time.perf_counter()
+            then: int = self.__store.get(sender, self.__settings.name)
+            self._observe('lookup', start)
+            if then is not None:
+                if self.__logger.isEnabledFor(logging.DEBUG):
+                    self.__logger.debug('Found %s at %s', sender, str(datetime.datetime.fromtimestamp(then)))
+                if then >= now - self.__settings.block_hours * 3600:  # If Recent: Reject
+                    self.__logger.debug('Recent entry found. Not sending any mail')
+                    skipped = True
+            if skipped:
+                self.__metrics.inc(METRIC_SKIPPED, reason='block', mailbox=self.__settings.name)
+                return 'block'
+            # Accept, older entry is replaced
+            if detailed:
+                self.__logger.info('Memorizing %s', sender)
+            if not self.__claim:
+                self.__store.put(sender, now, self.__settings.name)
+            elif not self.__store.claim(sender, now, now - self.__settings.block_hours * 3600, self.__settings.name):
+                self.__logger.debug('Sender claimed by another process. Not sending any mail')
+                self.__metrics.inc(METRIC_SKIPPED, reason='block', mailbox=self.__settings.name)
+                return 'block'
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback4 = sys.exc_info()
+            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
+            self.__logger.error(ex)
+        # pylint: enable=broad-exception-caught
+        return None
+
+    def _is_detailed(self, original: message.Message) -> bool:
+        """
+        Check if the processing of the message is detailed in the logs according to the detail ratio of the settings.
+        The decision depends on the Message-ID header, so all the records of a message are written or none of them.
+        :param original: the message
+        :return: True if the records of the message are written
+        """
+        ratio: float = self.__settings.log_detail_ratio
+        if ratio >= 1 or ratio <= 0:
+            return ratio >= 1
+        key: str = original['Message-ID'] or ((original['From'] or '') + (original['Subject'] or ''))
+        return zlib.crc32(key.encode('utf-8', 'replace')) < ratio * 0x100000000
+
+    def _log_summary(self, start: float, counts: dict[str, float]) -> None:
+        """
+        Write a single record summarizing the check, the counts and the duration are also available using the summary attribute of the record
+        :param start: the time of the beginning of the check, given by the performance counter
+        :param counts: the values of the counters at the beginning of the check by name of counter
+        """
+        summary: dict[str, float] = {'duration': round(time.perf_counter() - start, 6)}
+        for name, value in counts.items():
+            summary[name] = int(self.__metrics.get(name, mailbox=self.__settings.name) - value)
+        self.__logger.info('Check done in %.3f s: %s searched, %s replied, %s skipped, %s failed', summary['duration'], summary[METRIC_SEARCHED],
+                           summary[METRIC_REPLIED], summary[METRIC_SKIPPED], summary[METRIC_FAILED], extra={'summary': summary})
+
+    def _observe(self, stage: str, start: float) -> None:
+        """
+        Add the duration of an operation to the histogram of its stage
+        :param stage: the stage, like fetch or send
+        :param start: the start of the operation given by time.perf_counter()
+        """
+        self.__metrics.observe(METRIC_STAGE, time.perf_counter() - start, stage=stage, mailbox=self.__settings.name)
+
+    def get_metrics(self) -> dict[str, list[dict]]:
+        """
+        Return a snapshot of the metrics, the result can be serialized using JSON
+        :return: the values by name of metric, see Metrics.snapshot
+        """
+        return self.__metrics.snapshot()
+
+    def _flush(self) -> None:
+        """
+        Write the pending changes of the database.
+        """
+        if self.__store is None:
+            return
+        try:
+            self.__store.flush()
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback4 = sys.exc_info()
+            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
+            self.__logger.error(ex)
+        # pylint: enable=broad-exception-caught
+
+    def _maintain(self) -> None:
+        """
+        Delete the addresses blocked before the block hours and release the free pages of the database when the maintenance interval is elapsed.
+        The maintenance is done after a check, while waiting for new messages.
+        """
+        if self.__store is None or self.__settings.maintenance_interval <= 0 or time.monotonic() < self.__next_maintenance:
+            return
+        self.__next_maintenance = time.monotonic() + self.__settings.maintenance_interval
+        try:
+            start: float = time.perf_counter()
+            purged: int = self.__store.purge(int(time.time()) - self.__settings.block_hours * 3600, self.__settings.name)
+            released: int = self.__store.compact()
+            self._observe('maintenance', start)
+            rows: int = self.__store.count()
+            size: int = self.__store.get_size()
+            self.__metrics.inc(METRIC_STORE_PURGED, purged, mailbox=self.__settings.name)
+            self.__metrics.set(METRIC_STORE_ROWS, rows)
+            self.__metrics.set(METRIC_STORE_BYTES, size)
+            self.__logger.info('Database maintenance done, expired entries deleted: %s, pages released: %s, entries: %s, size: %s bytes',
+                               str(purged), str(released), str(rows), str(size))
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback4 = sys.exc_info()
+            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
+            self.__logger.error(ex)
+        # pylint: enable=broad-exception-caught
+
+    def _create_table(self) -> None:
+        """
+        Open the database and create or upgrade the table if required.
+        """
+        self.__logger.info('Creating table if not present in the database...')
+        if self.__test and os.path.exists(self.__settings.db_path):
+            os.unlink(self.__settings.db_path)
+        if self.__store is None:
+            self.__store = SenderStore(self.__settings.db_path, self.__logger, self.__settings.block_cache_size, self.__settings.block_hours * 3600)
+        try:
+            self.__store.open()
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback4 = sys.exc_info()
+            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
+            self.__logger.error(ex)
+        # pylint: enable=broad-exception-caught
+        self.__logger.info('Table ready')
+
+    # noinspection PyTypeChecker
+    def _prepare_replies(self) -> None:
+        """
+        Build and serialize the replies for each address and language of the templates.
+        """
+        prepared: dict[tuple[int, int], PreparedReply] = {}
+        # A recipient without template of a type uses the default templates of this type, all the languages are used for each recipient
+        languages: set[str] = {DEFAULT_KEY}
+        for d1 in (self.__text_templates, self.__html_templates):
+            for d2 in d1.values():
+                languages.update(d2)
+        keys: list[tuple[str, str]] = [(r, v) for r in set(self.__text_templates) | set(self.__html_templates) for v in languages]
+        for recipient, language in keys:
+            text_template, html_template = self._find_templates(recipient, language)
+            if not text_template and not html_template:
+                continue
+            # Templates shared by several addresses or languages are serialized only once
+            key: tuple[int, int] = (id(text_template), id(html_template))
+            if key not in prepared:
+                prepared[key] = PreparedReply(self._create_reply_body(text_template, html_template))
+            self.__replies[(recipient, language)] = prepared[key]
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Replies prepared: ' + str(len(prepared)) + ' for ' + str(len(self.__replies)) + ' addresses and languages')
+
+    def _find_templates(self, recipient: str, language: str) -> tuple[ReplyTemplate, ReplyTemplate]:
+        """
+        Find the templates to use for the given recipient and language
+        :param recipient: the recipient of the original message
+        :param language: the language of the original message
+        :return: the text template and the HTML template, None if not available
+        """
+        result: list[ReplyTemplate] = []
+        for d1 in (self.__text_templates, self.__html_templates):
+            template: ReplyTemplate = None
+            if recipient in d1:
+                d2: dict[str, ReplyTemplate] = d1[recipient]
+                if language in d2:
+                    template = d2[language]
+                elif DEFAULT_KEY in d2:
+                    template = d2[DEFAULT_KEY]
+            elif DEFAULT_KEY in d1:
+                d2: dict[str, ReplyTemplate] = d1[DEFAULT_KEY]
+                if language in d2:
+                    template = d2[language]
+                elif DEFAULT_KEY in d2:
+                    template = d2[DEFAULT_KEY]
+            result.append(template)
+        return result[0], result[1]
+
+    def _get_language(self, original: message.Message) -> str:
+        """
+        Return the language of the message
+        :param original: original message
+        :return: the language
+        """
+        original_language: str = original['Content-Language']
+        if original_language is None:
+            sender: str = str(get_address(original['From'])).lower()
+            original_language = self.__languages.get(sender)
+            if original_language is None:
+                original_language = self.__detector.detect(get_message_text(original))
+                if original_language is None:
+                    original_language = DEFAULT_LANGUAGE
+                else:
+                    self.__languages.put(sender, original_language)
+        original_language = original_language.split(',')[0]
+        self.__logger.debug('Original language: %s', original_language)
+        return original_language
+
+    def _create_reply_body(self, text_template: ReplyTemplate, html_template: ReplyTemplate) -> MIMEMultipart:
+        """
+        Create the message using the templates, without the headers depending on the original message
+        :param text_template: the text template or None
+        :param html_template: the HTML template or None
+        :return: the message
+        """
+        mail: MIMEMultipart = MIMEMultipart('alternative')
+        if text_template:
+            if text_template.lang:
+                mail['Content-Language'] = text_template.lang
+            mail.attach(MIMEText(dedent(text_template.body), 'plain'))
+            self.__logger.debug('Using text plain template:\n%s', text_template.body)
+        if html_template:
+            if html_template.lang:
+                mail['Content-Language'] = html_template.lang
+            mail.attach(MIMEText(html_template.body, 'html'))
+            self.__logger.debug('Using HTML template:\n%s', html_template.body)
+        return mail
+
+    def _create_auto_reply(self, original: message.Message) -> MIMEMultipart:
+        """
+        Create the message, the templates are resolved and encoded for each message, see _render_auto_reply for the prepared replies
+        :param original: original message
+        :return: the message or None if no template is available
+        """
+        original_recipient: str = get_address(original['To'])
+        self.__logger.debug('Original recipient: %s', original_recipient)
+        text_template, html_template = self._find_templates(original_recipient, self._get_language(original))
+        if not text_template and not html_template:
+            return None
+        mail: MIMEMultipart = self._create_reply_body(text_template, html_template)
+        mail['Message-ID'] = make_msgid()
+        mail['References'] = mail['In-Reply-To'] = original['Message-ID']
+        mail['Subject'] = 'Re: ' + original['Subject']
+        mail['From'] = original_recipient
+        mail['To'] = original['Reply-To'] or original['From']
+        return mail
+
+    def _render_auto_reply(self, original: message.Message, language: str = None) -> bytes:
+        """
+        Render the reply using the replies prepared by _prepare_replies
+        :param original: original message
+        :param language: the language of the message when already known, detected otherwise
+        :return: the bytes of the reply or None if no template is available
+        """
+        original_recipient: str = get_address(original['To'])
+        self.__logger.debug('Original recipient: %s', original_recipient)
+        if original_recipient not in self.__text_templates and original_recipient not in self.__html_templates:
+            original_recipient = DEFAULT_KEY
+        reply: PreparedReply = self.__replies.get((original_recipient, language or self._get_language(original)))
+        if reply is None:
+            reply = self.__replies.get((original_recipient, DEFAULT_KEY))
+        if reply is None:
+            return None
+        return reply.render(original)
+
+    # noinspection PyBroadException
+    def _send_auto_reply(self, original: message.Message) -> bool:
+        """
+        Reply to the message
+        :param original: the message
+        :return: False if the reply has not been sent and the message must be checked again
+        """
+        data: bytes = self._render(original)
+        if not data:
+            return True
+        if self.__test:
+            if self._is_detailed(original):
+                self.__logger.info('Test mode activated, reply will not be sent')
+            return True
+        return self._send(original, data, self.__smtp)
+
+    # noinspection PyBroadException
+    def _render(self, original: message.Message, language: str = None) -> bytes:
+        """
+        Render the reply, the errors are logged
+        :param original: the message
+        :param language: the language of the message when already known, detected otherwise
+        :return: the bytes of the reply or None if the reply cannot be created
+        """
+        start: float = time.perf_counter()
+        try:
+            data: bytes = self._render_auto_reply(original, language)
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
+            self.__logger.error('Reply cannot be created: %s', str(ex))
+            self.__metrics.inc(METRIC_FAILED, mailbox=self.__settings.name)
+            return None
+        # pylint: enable=broad-exception-caught
+        self._observe('render', start)
+        if not data:
+            self.__logger.warning('No template available')
+            self.__metrics.inc(METRIC_FAILED, mailbox=self.__settings.name)
+        return data
+
+    # noinspection PyBroadException
+    def _send(self, original: message.Message, data: bytes, session: SmtpSession) -> bool:
+        """
+        Send the reply using the rate limiter, the reply is sent again after a transient failure using an exponential backoff.
+        The reply is not sent again when it is rejected by the server, like a recipient refused using a 5xx code.
+        :param original: the message
+        :param data: the bytes of the reply
+        :param session: the SMTP session
+        :return: True if the reply has been sent
+        """
+        for attempt in range(SMTP_SEND_ATTEMPTS):
+            if attempt > 0:
+                sleep(get_backoff_delay(attempt - 1))
+            self.__smtp_limiter.acquire()
+            start: float = time.perf_counter()
+            try:
+                session.send(original['To'], [original['From']], data)
+                self._observe('send', start)
+                self.__smtp_limiter.succeed()
+                if self._is_detailed(original):
+                    self.__logger.info('Replied to "%s" for the mail "%s"', original['From'], original['Subject'])
+                self.__metrics.inc(METRIC_REPLIED, mailbox=self.__settings.name)
+                return True
+            # pylint: disable=broad-exception-caught
+            except Exception as ex:
+                if not isinstance(ex, OSError):
+                    _, _, exc_traceback = sys.exc_info()
+                    traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
+                if not is_transient_error(ex):
+                    self.__logger.error('Reply to "%s" rejected: %s', original['From'], str(ex) or ex.__class__.__name__)
+                    break
+                self.__logger.warning('Reply to "%s" not sent: %s', original['From'], str(ex) or ex.__class__.__name__)
+                if isinstance(ex, SMTPResponseException):
+                    # Temporary failure like 421 or 451, the connection is usually closed by the server
+                    self.__smtp_limiter.throttle()
+                    session.close()
+            # pylint: enable=broad-exception-caught
+        else:
+            self.__logger.error('Reply to "%s" not sent after %s attempts', original['From'], str(SMTP_SEND_ATTEMPTS))
+        self.__metrics.inc(METRIC_FAILED, mailbox=self.__settings.name)
+        self._release_sender(original)
+        return False
+
+    # noinspection PyBroadException
+    def _release_sender(self, original: message.Message) -> None:
+        """
+        Remove the sender of the message from the database, so it is not blocked when the message is checked again
+        :param original: the message whose reply has not been sent
+        """
+        if self.__store is None:
+            return
+        sender: str = get_address(original['Reply-To'] or original['From']) or ''
+        try:
+            self.__store.remove(sender, self.__settings.name)
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
+            self.__logger.error(ex)
+        # pylint: enable=broad-exception-caught
+
+    def _get_checkpoint(self, uid: int) -> int:
+        """
+        Return the UID to store as checkpoint, lower than the messages whose reply has not been sent, so they are found by the next search
+        :param uid: the last processed UID
+        :return: the UID to store
+        """
+        if self.__failed:
+            return min(uid, min(self.__failed) - 1)
+        return uid
+
+    def _imap_uid(self, command: str, *args) -> tuple[str, list]:
+        """
+        Send the UID command using the rate limiter, the command is sent again when the server reports a throttling
+        :param command: the command, like FETCH
+        :param args: the arguments of the command
+        :return: the type of the response and the data
+        """
+        typ: str = None
+        data: list = None
+        for _ in range(IMAP_ATTEMPTS):
+            self.__imap_limiter.acquire()
+            try:
+                typ, data = self.__imap.uid(command, *args)
+            except IMAP4.abort:
+                raise
+            except IMAP4.error as ex:
+                if not IMAP_THROTTLING_PATTERN.search(str(ex).encode()):
+                    raise
+                typ, data = 'NO', [str(ex).encode()]
+            if typ == 'NO' and any(isinstance(v, bytes) and IMAP_THROTTLING_PATTERN.search(v) for v in data):
+                self.__imap_limiter.throttle()
+                continue
+            self.__imap_limiter.succeed()
+            return typ, data
+        return typ, data
+
+    def _is_language_required(self, original: message.Message) -> bool:
+        """
+        Check if the language of the message is required to select the templates
+        :param original: the message (headers only)
+        :return: True if the body must be retrieved to detect the language
+        """
+        if original['Content-Language'] or len(self.__detector.languages) < 2:
+            return False
+        original_recipient: str = get_address(original['To'])
+        if not any(len(set(d1.get(original_recipient, d1.get(DEFAULT_KEY, {}))) - {DEFAULT_KEY}) > 1 for d1 in (self.__text_templates, self.__html_templates)):
+            return False
+        return self.__languages.get(str(get_address(original['From'])).lower()) is None
+
+    def _flag(self, uid: int) -> None:
+        """
+        Add the message to the ones flagged at the end of the cycle
+        :param uid: unique identifier of the message
+        """
+        self.__flagged.append(uid)
+
+    def _store_flags(self) -> None:
+        """
+        Add the AUTOREPLIED flag to the messages processed during the cycle using a single UID STORE command, the mailbox must be selected.
+        The messages stay pending until their command is completed, so they are flagged by the next check when the connection is lost.
+        """
+        uids: list[int] = sorted(set(self.__flagged))
+        if not uids:
+            return
+        if self.__test:
+            self.__flagged = []
+            self.__logger.info('Test mode activated, incoming messages will not be marked as answered')
+            return
+        for i in range(0, len(uids), IMAP_STORE_BATCH_SIZE):
+            message_set: str = compress_uid_set(uids[i:i + IMAP_STORE_BATCH_SIZE])
+            start: float = time.perf_counter()
+            typ, _ = self._imap_uid('STORE', message_set, '+FLAGS.SILENT', f'({AUTOREPLIED_FLAG})')
+            self.__flagged = uids[i + IMAP_STORE_BATCH_SIZE:]
+            self._observe('store', start)
+            if typ != 'OK':
+                self.__logger.warning('Flags not stored for messages: %s', message_set)
+        self.__logger.info('%s flag added to %s messages', AUTOREPLIED_FLAG, str(len(uids)))
 
-    def _login(self) -> None:
+    def _is_accepted(self, flags: list[str], original: message.Message) -> bool:
         """
-        Login on the IMAP and SMTP servers.
+        Check if the message must be replied using its flags and its headers
+        :param flags: the flags of the message
+        :param original: the message (headers only)
+        :return: True if a reply must be sent
         """
-        self.__logger.info('Login...')
-        retry: int = self.__login_retries
-        while retry > 0:
+        flags_str: str = ' '.join(flags)
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Flags: %s', flags_str)
+        if AUTOREPLIED_FLAG in flags_str:
+            self.__logger.warning('Message already has the %s flag', AUTOREPLIED_FLAG)
+            self.__metrics.inc(METRIC_SKIPPED, reason='flagged', mailbox=self.__settings.name)
+            return False
+        # Check if address has been used 12h or if it must be ignored
+        if self._is_skipped(original):
+            if self._is_detailed(original):
+                self.__logger.info('Mail from "%s" will be ignored', original['From'])
+            return False
+        return True
+
+    def _fetch(self, uids: list[int], items: str) -> Iterator[FetchResult]:
+        """
+        Fetch the given items of the messages using a UID FETCH command, the mailbox must be selected
+        :param uids: the unique identifiers of the messages
+        :param items: the items to fetch, like (FLAGS RFC822)
+        :return: the iterator on the tuples (uid, flags, items by name)
+        """
+        message_set: str = compress_uid_set(uids)
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Fetching %s of messages: %s', items, message_set)
+        start: float = time.perf_counter()
+        typ, data = self._imap_uid('FETCH', message_set, items)
+        self._observe('fetch', start)
+        if typ != 'OK':
+            self.__logger.warning('Fetch failed for messages: %s', message_set)
+            return
+        yield from iter_fetch_response(data)
+
+    def _process(self, uids: list[int]) -> None:
+        """
+        Process a chunk of messages, the mailbox must be selected.
+        The headers are fetched first and the beginning of the body is only fetched when the language is required.
+        The messages are flagged at the end of the cycle, except the ones whose reply cannot be sent which are checked again by the next cycle.
+        :param uids: the unique identifiers of the messages
+        """
+        accepted: dict[int, message.Message] = {}
+        headers_by_uid: dict[int, bytes] = {}
+        for uid, flags, items in self._fetch(uids, f'(UID FLAGS BODY.PEEK[HEADER.FIELDS ({IMAP_HEADER_FIELDS})])'):
+            headers: bytes = get_fetch_item(items, 'BODY[HEADER')
+            if headers is None:
+                self.__logger.warning('No headers fetched for message %s', str(uid))
+                continue
+            original: message.Message = message_from_bytes(headers)
+            if self._is_accepted(flags, original):
+                accepted[uid] = original
+                headers_by_uid[uid] = headers
+            else:
+                self._flag(uid)
+        required: list[int] = [uid for uid, original in accepted.items() if self._is_language_required(original)]
+        if required:
+            for uid, _, items in self._fetch(required, f'(UID BODY.PEEK[TEXT]<0.{self.__settings.imap_body_max_size}>)'):
+                body: bytes = get_fetch_item(items, 'BODY[TEXT]')
+                if uid in accepted and body is not None:
+                    accepted[uid] = parse_message((headers_by_uid[uid], body), len(headers_by_uid[uid]) + self.__settings.imap_body_max_size)
+        if accepted:
+            self.__smtp.check()
+        for uid, original in accepted.items():
+            if self._send_auto_reply(original):
+                self._flag(uid)
+            else:
+                self.__failed.append(uid)
+
+    def _get_response_code(self, name: str) -> int:
+        """
+        Return the numeric value of a response code sent by the server, like UIDVALIDITY or UIDNEXT after a SELECT
+        :param name: the name of the response code
+        :return: the value or None if not sent by the server
+        """
+        _, data = self.__imap.response(name)
+        if data and data[-1]:
             try:
-                if self.__settings.imap_use_ssl:
-                    if self.__logger.isEnabledFor(logging.DEBUG):
-                        self.__logger.debug('Using IMAP4 SSL and server: ' + self.__settings.imap_server + ' and port: ' + str(self.__settings.imap_port))
-                    self.__imap = IMAP4_SSL(self.__settings.imap_server, self.__settings.imap_port)
-                else:
-                    if self.__logger.isEnabledFor(logging.DEBUG):
-                        self.__logger.debug('Using IMAP4 and server: ' + self.__settings.imap_server + ' and port: ' + str(self.__settings.imap_port))
-                    self.__imap = IMAP4(self.__settings.imap_server, self.__settings.imap_port)
-                v: str = base64.b64decode(self.__settings.imap_password).decode('utf8')
-                self.__logger.info('IMAP4 login using user: ' + self.__settings.imap_user + ' and password: ' + re.sub('.', '*', v) + '...')
-                self.__imap.login(self.__settings.imap_user, v)
-                if self.__settings.smtp_use_ssl:
-                    if self.__logger.isEnabledFor(logging.DEBUG):
-                        self.__logger.debug('Using SMTP SSL and server: ' + self.__settings.smtp_server + ' and port: ' + str(self.__settings.smtp_port))
-                    self.__smtp = SMTP_SSL(self.__settings.smtp_server, self.__settings.smtp_port)
-                else:
-                    if self.__logger.isEnabledFor(logging.DEBUG):
-                        self.__logger.debug('Using SMTP and server: ' + self.__settings.smtp_server + ' and port: ' + str(self.__settings.smtp_port))
-                    self.__smtp = SMTP(self.__settings.smtp_server, self.__settings.smtp_port)
-                v = base64.b64decode(self.__settings.smtp_password).decode('utf8')
-                self.__logger.info('SMTP login using user: ' + self.__settings.smtp_user + ' and password: ' + re.sub('.', '*', v) + '...')
-                self.__smtp.login(self.__settings.smtp_user, v)
-                self.__logger.info('Login done')
-                retry = 0
-            except socket.gaierror as ex:
-                retry = retry - 1
-                if retry <= 0:
-                    raise ex
-                self.__logger.warning('Login failed, retrying in ' + str(self.__login_retry_delay) + 's')
-                sleep(self.__login_retry_delay)
+                return int(data[-1])
+            except ValueError:
+                return None
+        return None
 
-    def close(self) -> None:
+    def _select(self) -> tuple[int, int]:
         """
-        Close the IMAP and SMTP connections.
+        Select the mailbox, the selection is kept across the checks and only refreshed using NOOP, so the changes of the mailbox are reported
+        by the server in its untagged responses
+        :return: the tuple (UIDVALIDITY or None, UIDNEXT or None when the mailbox was already selected)
         """
-        self.__logger.info('Closing...')
-        if self.__smtp:
-            self.__logger.debug('Closing SMTP connection...')
-            self.__smtp.close()
-        if self.__imap:
-            self.__logger.debug('Closing IMAP4 connection...')
-            self.__imap.logout()
-        self.__logger.info('Closing done')
+        if self.__selected:
+            self._noop()
+        else:
+            self.__imap_limiter.acquire()
+            self.__imap.select(readonly=False)
+            self.__selected = True
+            self.__last_noop = time.monotonic()
+        uidvalidity: int = self._get_response_code('UIDVALIDITY')
+        if uidvalidity is not None:
+            self.__uidvalidity = uidvalidity
+        return self.__uidvalidity, self._get_response_code('UIDNEXT')
 
-    # pylint: disable=too-complex
-    def _is_skipped(self, original: message.Message) -> bool:
+    def _noop(self) -> None:
         """
-        Internal check if the message must be processed or not
-        :param original: the message
-        :return: true to skip processing
+        Send the NOOP command to check the IMAP connection and to receive the changes of the selected mailbox
         """
-        sender_full: str = original['Reply-To'] or original['From']
-        sender: str = sender_full
-        if '<' in sender:
-            sender = (sender.split('<'))[1].split('>')[0]
-        self.__logger.info('Incoming message from ' + sender + ' (' + original['Subject'] + '). Checking history....')
-        # Check if sender address is ignored
-        for value in self.__skipped_addresses:
-            if isinstance(value, re.Pattern):
-                if value.match(sender):
-                    self.__logger.info('Mail from ' + sender + ' is rejected by address filter: ' + value.pattern)
-                    return True
-            elif value == sender:
-                return True
-        # Check if sender domain is ignored
-        domain: str = sender.split('@')[1]
+        self.__imap_limiter.acquire()
+        typ, data = self.__imap.noop()
+        if typ != 'OK':
+            raise IMAP4.abort('NOOP failed: ' + str(data))
+        self.__last_noop = time.monotonic()
+
+    def _wait(self, delay: float) -> None:
+        """
+        Wait while the process is active, the IMAP connection is checked using NOOP when it stays unused longer than the NOOP interval,
+        so a connection closed by the server or by a network device is detected before the next check, and the lease is renewed
+        :param delay: the delay in seconds
+        """
+        deadline: float = time.monotonic() + delay
+        while self.__active:
+            now: float = time.monotonic()
+            if now >= deadline:
+                return
+            if 0 < self.__settings.imap_noop_interval <= now - self.__last_noop:
+                self.__logger.debug('Checking the IMAP connection...')
+                self._noop()
+            # The lease does not expire when the refresh delay is longer than the lease duration
+            self._renew_lease()
+            # The wait is interrupted every second to handle the stop
+            sleep(min(deadline - now, 1.0))
+
+    def _search(self) -> tuple[int, int, list[int]]:
+        """
+        Select the mailbox and search the unseen and unanswered messages.
+        Only the messages received since the last processed UID are searched, unless the UIDVALIDITY of the mailbox has changed.
+        :return: the tuple (UIDVALIDITY or None, UID to store as checkpoint when all the messages are processed, UIDs of the messages)
+        """
+        since_date: datetime.datetime = (datetime.datetime.today() - datetime.timedelta(days=self.__age_in_days))
+        criteria: str = f'SINCE "{since_date.strftime(IMAP_DATE_FORMAT)}" UNSEEN UNANSWERED UNKEYWORD {AUTOREPLIED_FLAG}'
+        uidvalidity, uidnext = self._select()
+        # The new messages reported before the search are found by the search
+        self.__imap.response('EXISTS')
+        state: tuple[int, int] = self.__store.get_sync_state(self.__settings.name)
+        last_uid: int = 0
+        if state is not None and uidvalidity is not None and state[0] == uidvalidity:
+            last_uid = state[1]
+            criteria = f'UID {last_uid + 1}:* ' + criteria
+        elif state is not None:
+            self.__logger.info('UIDVALIDITY of the mailbox has changed, all the messages are checked')
         if self.__logger.isEnabledFor(logging.DEBUG):
-            self.__logger.debug('Domain: ' + domain)
-        for value in self.__skipped_domains:
-            if isinstance(value, re.Pattern):
-                if value.match(domain):
-                    self.__logger.info('Mail from ' + sender + ' is rejected by domain filter: ' + value.pattern)
-                    return True
-            elif value == domain:
-                return True
-        # Check if subject is ignored
-        subject: str = original['Subject']
+            self.__logger.debug('Searching messages using: %s', criteria)
+        start: float = time.perf_counter()
+        _, data = self._imap_uid('SEARCH', None, f'({criteria})')
+        self._observe('search', start)
+        # The range n:* always includes the last message, even if its UID is lower than n
+        uids: list[int] = sorted(v for v in (int(v) for v in data[0].split()) if v > last_uid)
+        self.__metrics.inc(METRIC_SEARCHED, len(uids), mailbox=self.__settings.name)
+        self.__metrics.set(METRIC_BACKLOG, len(uids), mailbox=self.__settings.name)
         if self.__logger.isEnabledFor(logging.DEBUG):
-            self.__logger.debug('Subject: ' + subject)
-        for value in self.__skipped_subjects:
-            if isinstance(value, re.Pattern):
-                if value.match(domain):
-                    self.__logger.info('Mail from ' + sender + ' is rejected by subject filter: ' + value.pattern + " and subject: " + subject)
-                    return True
-            elif value == subject:
-                return True
-        # Check for recent incoming mails from this address
-        con: sqlite3.Connection = self._db_connect()
-        skipped: bool = False
-        now: datetime.datetime = datetime.datetime.now()
+            self.__logger.debug('Messages found: %s', str(len(uids)))
+        # The messages received before the selection have been checked by the search
+        self.__last_uid = max([last_uid, (uidnext or 1) - 1] + uids)
+        return uidvalidity, self.__last_uid, uids
+
+    def _check_mails(self) -> None:
+        """
+        Check incoming unseen and unanswered messages.
+        The mailbox stays selected between the checks and the messages are processed by the asynchronous pipeline or sequentially by chunks.
+        """
+        self._reload_configuration()
+        if not self._renew_lease():
+            self.__logger.debug('Lease held by another node, check skipped')
+            return
+        start: float = time.perf_counter()
+        counts: dict[str, float] = {}
+        for name in (METRIC_SEARCHED, METRIC_REPLIED, METRIC_SKIPPED, METRIC_FAILED):
+            counts[name] = self.__metrics.get(name, mailbox=self.__settings.name)
+        self.__failed = []
         try:
-            cur: sqlite3.Cursor = con.cursor()
-            if self.__logger.isEnabledFor(logging.DEBUG):
-                for row in cur.execute("SELECT count(id) FROM senders"):
-                    self.__logger.debug('Entries in table: %s', str(row[0]))
-            for row in cur.execute("SELECT id,date FROM senders WHERE mail=?", (sender,)):
-                break_date = now - datetime.timedelta(hours=self.__settings.block_hours)
-                then = datetime.datetime.strptime(row[1], "%Y-%m-%d %H:%M:%S.%f")
-                self.__logger.info('Found %s at %s - ID %s', sender,  str(row[1]), str(row[0]))
-                if then < break_date:  # If older: Delete
-                    if self.__logger.isEnabledFor(logging.DEBUG):
-                        self.__logger.debug('Last entry %s from %s is old. Delete...', str(row[0]), sender)
-                    cur.execute("DELETE FROM senders WHERE id=?", (row[0],))
-                elif then >= break_date:  # If Recent: Reject
-                    self.__logger.debug('Recent entry found. Not sending any mail')
-                    skipped = True
-            if skipped:
-                return skipped
-            # Accept
-            self.__logger.info('Memorizing ' + sender)
-            cur.execute("INSERT INTO senders (mail, date) values (?, ?)", (sender, now))
-            con.commit()
-        # pylint: disable=broad-exception-caught
-        except Exception as ex:
-            _, _, exc_traceback4 = sys.exc_info()
-            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
-            self.__logger.error(ex)
-        # pylint: enable=broad-exception-caught
+            # The search is done first when the messages can be split between the worker processes
+            found: tuple[int, int, list[int]] = self._search() if self.__settings.shards > 1 else None
+            if found is not None and len(found[2]) >= max(1, self.__settings.shard_min_size):
+                self._check_mails_sharded(*found)
+            elif self.__settings.pipeline:
+                # pylint: disable=import-outside-toplevel
+                import asyncio
+                # pylint: enable=import-outside-toplevel
+                asyncio.run(self._check_mails_async(found))
+            else:
+                uidvalidity, checkpoint, uids = found or self._search()
+                batch_size: int = max(1, self.__settings.imap_batch_size)
+                for i in range(0, len(uids), batch_size):
+                    self._process(uids[i:i + batch_size])
+                    self.__metrics.add(METRIC_BACKLOG, -len(uids[i:i + batch_size]), mailbox=self.__settings.name)
+                    if uidvalidity is not None:
+                        self.__store.put_sync_state(uidvalidity, self._get_checkpoint(uids[min(i + batch_size, len(uids)) - 1]), self.__settings.name,
+                                                    self.__lease_token)
+                if uidvalidity is not None:
+                    self.__store.put_sync_state(uidvalidity, self._get_checkpoint(checkpoint), self.__settings.name, self.__lease_token)
         finally:
-            if con:
-                con.close()
-        return skipped
+            try:
+                self._store_flags()
+            finally:
+                self._flush()
+            for session in self.__smtp_sessions:
+                session.close_if_idle()
+            self.__metrics.set(METRIC_BACKLOG, 0, mailbox=self.__settings.name)
+            self.__metrics.set(METRIC_CYCLE, time.perf_counter() - start, mailbox=self.__settings.name)
+            self._log_summary(start, counts)
+        self._maintain()
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Rate limiters: %s, %s', str(self.__imap_limiter), str(self.__smtp_limiter))
+        self.__logger.debug('Search done')
 
-    def _db_connect(self) -> sqlite3.Connection:
+    def _renew_lease(self) -> bool:
         """
-        Connect to the SQLITE3 database.
+        Acquire or renew the lease of the mailbox when the leases are enabled and the renewal delay, a third of the lease duration, is elapsed.
+        The mailboxes are spread across the nodes alive using a rendezvous hashing: a free lease is taken by the preferred node of the mailbox,
+        the expired lease of a node which is not alive is taken by any node, the lease of another node alive is taken when it has expired
+        for more than the lease duration and the lease is handed over when its holder is not the preferred node.
+        :return: True if the mailbox can be checked by this node
         """
-        self.__logger.info('Connecting to the database: %s...', self.__settings.db_path)
-        con: sqlite3.Connection = sqlite3.connect(self.__settings.db_path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        # self.__db_con.set_trace_callback(print)
-        self.__logger.info('Connected to the database')
-        return con
+        duration: int = self.__settings.lease_duration
+        if duration <= 0 or self.__store is None:
+            return True
+        if time.monotonic() < self.__next_lease_renewal:
+            return self.__lease_token is not None
+        self.__next_lease_renewal = time.monotonic() + max(1.0, duration / 3)
+        node: str = self.__settings.node or socket.gethostname()
+        name: str = self.__settings.name
+        now: int = int(time.time())
+        token: int = None
+        try:
+            self.__store.heartbeat(node, now)
+            nodes: list[str] = self.__store.get_nodes(now - duration)
+            preferred: str = max(nodes, key=lambda v: zlib.crc32((v + '/' + name).encode('utf-8'))) if nodes else node
+            if self.__lease_token is not None and preferred != node:
+                self.__store.release_lease(name, node, self.__lease_token, now)
+                self.__logger.info('Lease of the mailbox handed over to node %s', preferred)
+                self.__lease_token = None
+            else:
+                token = self.__store.acquire_lease(name, node, now, duration, now if preferred == node else now - duration, nodes=nodes)
+        # pylint: disable=broad-exception-caught
+        except Exception as ex:
+            _, _, exc_traceback = sys.exc_info()
+            traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
+            self.__logger.error('Lease cannot be renewed: %s', str(ex))
+        # pylint: enable=broad-exception-caught
+        if token is not None and self.__lease_token is None:
+            self.__logger.info('Lease of the mailbox acquired by node %s, token: %s', node, str(token))
+        elif token is None and self.__lease_token is not None:
+            self.__logger.warning('Lease of the mailbox lost by node %s', node)
+        self.__lease_token = token
+        return token is not None
 
-    def _create_table(self) -> None:
+    def _release_lease(self) -> None:
         """
-        Create the table if it does not exist.
+        Release the lease of the mailbox, so another node can take it without waiting for its expiration.
         """
-        self.__logger.info('Creating table if not present in the database...')
-        if self.__test and os.path.exists(self.__settings.db_path):
-            os.unlink(self.__settings.db_path)
-        con: sqlite3.Connection = self._db_connect()
+        if self.__lease_token is None:
+            return
         try:
-            cur: sqlite3.Cursor = con.cursor()
-            cur.execute('''CREATE TABLE IF NOT EXISTS senders (id INTEGER PRIMARY KEY, mail text, date datetime)''')
-            con.commit()
-            if self.__logger.isEnabledFor(logging.DEBUG):
-                for row in cur.execute("SELECT count(id) FROM senders"):
-                    self.__logger.debug('Entries in table: %s', str(row[0]))
+            self.__store.release_lease(self.__settings.name, self.__settings.node or socket.gethostname(), self.__lease_token)
         # pylint: disable=broad-exception-caught
         except Exception as ex:
-            _, _, exc_traceback4 = sys.exc_info()
-            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
-            self.__logger.error(ex)
+            self.__logger.error('Lease cannot be released: %s', str(ex))
         # pylint: enable=broad-exception-caught
-        finally:
-            if con:
-                con.close()
-        self.__logger.info('Table ready')
+        self.__lease_token = None
+        self.__next_lease_renewal = 0
 
-    # noinspection PyTypeChecker
-    def _create_auto_reply(self, original: message.Message):
+    def _check_mails_sharded(self, uidvalidity: int, checkpoint: int, uids: list[int]) -> None:
         """
-        Create the message
-        :param original: original message
+        Split the messages found by the search in ranges of UIDs processed by worker processes, each one using its own IMAP and SMTP connections.
+        The senders are claimed in the database by the workers, so a sender is replied only once even if its messages are in several ranges.
+        The checkpoint is only written when all the ranges have been processed and stays lower than the messages whose reply has not been sent.
+        :param uidvalidity: the UIDVALIDITY of the mailbox or None
+        :param checkpoint: the UID to store as checkpoint
+        :param uids: the unique identifiers of the messages
         """
-        original_recipient: str = original['To']
-        if '<' in original_recipient:
-            original_recipient: str = (original_recipient.split('<'))[1].split('>')[0]
-        original_language: str = original['Content-Language']
-        if original_language is None:
-            original_language = get_message_language(original)
-            if original_language is None:
-                original_language = DEFAULT_LANGUAGE
-        original_language = original_language.split(',')[0]
-        self.__logger.debug('Original language: %s', original_language)
-        mail: MIMEMultipart = MIMEMultipart('alternative')
-        mail['Message-ID'] = make_msgid()
-        mail['References'] = mail['In-Reply-To'] = original['Message-ID']
-        mail['Subject'] = 'Re: ' + original['Subject']
-        mail['From'] = original_recipient
-        mail['To'] = original['Reply-To'] or original['From']
-        self.__logger.debug('Original recipient: %s', original_recipient)
-        template: ReplyTemplate = None
-        # Search in text templates
-        d1: dict[str, dict[str, ReplyTemplate]] = self.__text_templates
-        if original_recipient in d1:
-            d2: dict[str, ReplyTemplate] = d1[original_recipient]
-            if original_language in d2:
-                template = d2[original_language]
-            elif DEFAULT_KEY in d2:
-                template = d2[DEFAULT_KEY]
-        elif DEFAULT_KEY in d1:
-            d2: dict[str, ReplyTemplate] = d1[DEFAULT_KEY]
-            if DEFAULT_KEY in d2:
-                template = d2[DEFAULT_KEY]
-        if template:
-            if template.lang:
-                mail['Content-Language'] = template.lang
-            mail.attach(MIMEText(dedent(template.body), 'plain'))
-            self.__logger.debug('Using text plain template:\n%s', template.body)
-        # Search in HTML templates
-        template = None
-        d1: dict[str, dict[str, ReplyTemplate]] = self.__html_templates
-        if original_recipient in d1:
-            d2: dict[str, ReplyTemplate] = d1[original_recipient]
-            if original_language in d2:
-                template = d2[original_language]
-            elif DEFAULT_KEY in d2:
-                template = d2[DEFAULT_KEY]
-        elif DEFAULT_KEY in d1:
-            d2: dict[str, ReplyTemplate] = d1[DEFAULT_KEY]
-            if DEFAULT_KEY in d2:
-                template = d2[DEFAULT_KEY]
-        if template:
-            if template.lang:
-                mail['Content-Language'] = template.lang
-            mail.attach(MIMEText(template.body, 'html'))
-            self.__logger.debug('Using HTML template:\n%s', template.body)
-        if len(mail.items()) > 0:
-            return mail
-        return None
+        shards: int = min(self.__settings.shards, len(uids))
+        ranges: list[list[int]] = [uids[i * len(uids) // shards:(i + 1) * len(uids) // shards] for i in range(shards)]
+        self.__logger.info('Processing %s messages using %s processes', str(len(uids)), str(shards))
+        # The workers must see the dates written by this process
+        self._flush()
+        error: BaseException = None
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+        # pylint: enable=import-outside-toplevel
+        with concurrent.futures.ProcessPoolExecutor(shards, initializer=init_shard_worker, initargs=(self.__logger.name,)) as executor:
+            futures: list[concurrent.futures.Future] = [executor.submit(process_shard, self.__settings, self.__logger.name, v) for v in ranges]
+            for future, shard in zip(futures, ranges):
+                try:
+                    snapshot, failed = future.result()
+                    self.__metrics.merge(snapshot)
+                    self.__failed.extend(failed)
+                # pylint: disable=broad-exception-caught
+                except Exception as ex:
+                    _, _, exc_traceback = sys.exc_info()
+                    traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
+                    self.__logger.error('Messages %s not processed: %s', compress_uid_set(shard), str(ex))
+                    error = ex
+                # pylint: enable=broad-exception-caught
+                self.__metrics.add(METRIC_BACKLOG, -len(shard), mailbox=self.__settings.name)
+        # The dates written by the workers are read again from the database
+        self.__store.invalidate()
+        if error is not None:
+            raise error
+        if uidvalidity is not None:
+            self.__store.put_sync_state(uidvalidity, self._get_checkpoint(checkpoint), self.__settings.name, self.__lease_token)
 
-    # noinspection PyBroadException
-    def _send_auto_reply(self, original: message.Message) -> None:
+    def process_shard(self, uids: list[int]) -> tuple[dict[str, list[dict]], list[int]]:
         """
-        Check the sender and if not ignored, reply to the message
-        :param original: the message
+        Process the given messages in a worker process of the sharded mode, the senders are claimed in the database shared with the other workers.
+        The replier is logged in, the messages are processed sequentially by chunks and flagged, then the replier is closed.
+        :param uids: the unique identifiers of the messages
+        :return: the tuple (snapshot of the metrics of this replier, UIDs of the messages whose reply has not been sent)
         """
-        # Check if address has been used 12h or if it must be ignored
-        if self._is_skipped(original):
-            self.__logger.info('Mail from "%s" will be ignored', original['From'])
-            return
-        # Send with Rate limit & error prevention
-        success = False
-        i: int = 0
-        while not success and i < 5:
-            i = i + 1
+        self.__claim = True
+        self._create_table()
+        try:
+            self._login()
+            self.__imap.select(readonly=False)
             try:
-                reply: message = self._create_auto_reply(original)
-                success = True
-                if self.__test:
-                    self.__logger.info('Test mode activated, reply will not be sent')
-                elif reply:
-                    self.__smtp.sendmail(original['To'], [original['From']], reply.as_bytes())
-                else:
-                    self.__logger.warning('No template available')
-                    success = False
-                if success:
-                    self.__logger.info('Replied to "%s" for the mail "%s"', original['From'], original['Subject'])
-            # pylint: disable=broad-exception-caught
-            except Exception:
-                _, _, exc_traceback = sys.exc_info()
-                traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)
-                self.__logger.warning('Error on send (rate limit?). Wait 30s and reconnect....')
-                self.close()
-                time.sleep(30)
-                self._login()
-            # pylint: enable=broad-exception-caught
+                batch_size: int = max(1, self.__settings.imap_batch_size)
+                for i in range(0, len(uids), batch_size):
+                    self._process(uids[i:i + batch_size])
+            finally:
+                try:
+                    self._store_flags()
+                finally:
+                    self.__imap.close()
+        finally:
+            self.close()
+        return self.__metrics.snapshot(), self.__failed
 
-    def _reply(self, mail_id: str) -> None:
+    async def _check_mails_async(self, found: tuple[int, int, list[int]] = None) -> None:
         """
-        Reply to the message using its identifier
-        :param mail_id: identifier of the message
+        Check incoming unseen and unanswered messages using a pipeline of stages connected by bounded queues:
+        fetch of the headers, skip decision, fetch of the bodies, rendering, sending by several workers and collection of the messages to flag.
+        The IMAP commands are sent by a dedicated thread and the replies are sent by a thread by SMTP connection, so the waits
+        for the servers overlap instead of being summed.
+        :param found: the result of the search if already done or None
         """
-        try:
-            self.__imap.select(readonly=False)
-            _, data = self.__imap.fetch(mail_id, '(RFC822)')
-            flags = []
-            if data[1] is not None:
-                for flag in ParseFlags(str(data[1])):
-                    flags.append(flag.decode())
-            if self.__test:
-                self.__logger.info('Test mode activated, incoming message will not be marked as answered')
-            else:
-                self.__imap.store(mail_id, '+FLAGS', AUTOREPLIED_FLAG)
-                self.__imap.store(mail_id, '-FLAGS', '\\SEEN')
-                self.__logger.info('%s flag added to the message.', AUTOREPLIED_FLAG)
-            flags_str: str = ' '.join(flags)
-            if self.__logger.isEnabledFor(logging.DEBUG):
-                self.__logger.debug('Flags: %s', flags_str)
-            if AUTOREPLIED_FLAG in flags_str:
-                self.__logger.warning('Message already has the %s flag', AUTOREPLIED_FLAG)
+        # pylint: disable=import-outside-toplevel
+        import asyncio
+        import concurrent.futures
+        # pylint: enable=import-outside-toplevel
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        workers: int = max(1, self.__settings.smtp_workers)
+        while len(self.__smtp_sessions) < workers:
+            self.__smtp_sessions.append(SmtpSession(self.__settings, self.__logger))
+        with concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='imap') as imap_executor, \
+                concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='smtp') as smtp_executor:
+            if found is None:
+                found = await loop.run_in_executor(imap_executor, self._search)
+            uidvalidity, checkpoint, uids = found
+            if not uids:
+                # The checkpoint is written, so the next STATUS command reports the messages received after this search
+                if uidvalidity is not None:
+                    self.__store.put_sync_state(uidvalidity, checkpoint, self.__settings.name, self.__lease_token)
                 return
+            size: int = max(1, self.__settings.queue_size)
+            headers_queue: asyncio.Queue = asyncio.Queue(size)
+            bodies_queue: asyncio.Queue = asyncio.Queue(size)
+            render_queue: asyncio.Queue = asyncio.Queue(size)
+            send_queue: asyncio.Queue = asyncio.Queue(size)
+            flag_queue: asyncio.Queue = asyncio.Queue(size)
+            tasks: list[asyncio.Task] = [
+                asyncio.create_task(self._fetch_stage(loop, uids, headers_queue, imap_executor)),
+                asyncio.create_task(self._filter_stage(headers_queue, bodies_queue, flag_queue)),
+                asyncio.create_task(self._body_stage(loop, bodies_queue, render_queue, imap_executor)),
+                asyncio.create_task(self._render_stage(render_queue, send_queue, flag_queue, workers)),
+                asyncio.create_task(self._flag_stage(flag_queue, workers + 1))
+            ]
+            for session in self.__smtp_sessions[:workers]:
+                tasks.append(asyncio.create_task(self._send_stage(loop, send_queue, flag_queue, session, smtp_executor)))
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            if uidvalidity is not None:
+                self.__store.put_sync_state(uidvalidity, self._get_checkpoint(checkpoint), self.__settings.name, self.__lease_token)
+
+    async def _fetch_stage(self, loop: asyncio.AbstractEventLoop, uids: list[int], output: asyncio.Queue, imap_executor: concurrent.futures.Executor) -> None:
+        """
+        Fetch the flags and the headers of the messages by chunks
+        :param loop: the event loop
+        :param uids: the unique identifiers of the messages
+        :param output: the queue receiving the tuples (uid, flags, headers)
+        :param imap_executor: the executor used to send the IMAP commands
+        """
+        batch_size: int = max(1, self.__settings.imap_batch_size)
+        items: str = f'(UID FLAGS BODY.PEEK[HEADER.FIELDS ({IMAP_HEADER_FIELDS})])'
+        for i in range(0, len(uids), batch_size):
+            results: list[FetchResult] = await loop.run_in_executor(imap_executor, lambda chunk=uids[i:i + batch_size]: list(self._fetch(chunk, items)))
+            for uid, flags, fetched in results:
+                headers: bytes = get_fetch_item(fetched, 'BODY[HEADER')
+                if headers is None:
+                    self.__logger.warning('No headers fetched for message %s', str(uid))
+                    continue
+                await output.put((uid, flags, headers))
+        await output.put(None)
+
+    async def _filter_stage(self, source: asyncio.Queue, output: asyncio.Queue, flag_queue: asyncio.Queue) -> None:
+        """
+        Decide if the messages must be replied, the decisions are taken one by one so a sender is blocked before its next message is checked
+        :param source: the queue of the tuples (uid, flags, headers)
+        :param output: the queue receiving the tuples (uid, headers, message) of the accepted messages
+        :param flag_queue: the queue receiving the tuples (uid, True) of the rejected messages
+        """
+        while True:
+            item: tuple[int, list[str], bytes] = await source.get()
+            if item is None:
+                break
+            uid, flags, headers = item
+            original: message.Message = message_from_bytes(headers)
+            if self._is_accepted(flags, original):
+                await output.put((uid, headers, original))
+            else:
+                await flag_queue.put((uid, True))
+        await output.put(None)
+        await flag_queue.put(None)
+
+    async def _body_stage(self, loop: asyncio.AbstractEventLoop, source: asyncio.Queue, output: asyncio.Queue, imap_executor: concurrent.futures.Executor) -> None:
+        """
+        Fetch the beginning of the bodies of the messages when the language is required, the waiting messages are fetched together
+        :param loop: the event loop
+        :param source: the queue of the tuples (uid, headers, message)
+        :param output: the queue receiving the tuples (uid, message)
+        :param imap_executor: the executor used to send the IMAP commands
+        """
+        batch_size: int = max(1, self.__settings.imap_batch_size)
+        items: str = f'(UID BODY.PEEK[TEXT]<0.{self.__settings.imap_body_max_size}>)'
+        done: bool = False
+        while not done:
+            item: tuple[int, bytes, message.Message] = await source.get()
+            if item is None:
+                break
+            batch: list[tuple[int, bytes, message.Message]] = [item]
+            while len(batch) < batch_size and not source.empty():
+                item = source.get_nowait()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+            accepted: dict[int, message.Message] = {uid: original for uid, _, original in batch}
+            required: list[int] = [uid for uid, original in accepted.items() if self._is_language_required(original)]
+            if required:
+                results: list[FetchResult] = await loop.run_in_executor(imap_executor, lambda uids=required: list(self._fetch(uids, items)))
+                headers_by_uid: dict[int, bytes] = {uid: headers for uid, headers, _ in batch}
+                for uid, _, fetched in results:
+                    body: bytes = get_fetch_item(fetched, 'BODY[TEXT]')
+                    if uid in accepted and body is not None:
+                        accepted[uid] = parse_message((headers_by_uid[uid], body), len(headers_by_uid[uid]) + self.__settings.imap_body_max_size)
+            for uid, original in accepted.items():
+                await output.put((uid, original))
+        await output.put(None)
+
+    async def _render_stage(self, source: asyncio.Queue, output: asyncio.Queue, flag_queue: asyncio.Queue, workers: int) -> None:
+        """
+        Render the replies
+        :param source: the queue of the tuples (uid, message)
+        :param output: the queue receiving the tuples (uid, message, reply)
+        :param flag_queue: the queue receiving the tuples (uid, True) of the messages without reply
+        :param workers: the number of send workers
+        """
+        while True:
+            item: tuple[int, message.Message] = await source.get()
+            if item is None:
+                break
+            uid, original = item
+            data: bytes = self._render(original)
+            if data and self.__test and self._is_detailed(original):
+                self.__logger.info('Test mode activated, reply will not be sent')
+            if data and not self.__test:
+                await output.put((uid, original, data))
+            else:
+                await flag_queue.put((uid, True))
+        for _ in range(workers):
+            await output.put(None)
+
+    async def _send_stage(self, loop: asyncio.AbstractEventLoop, source: asyncio.Queue, flag_queue: asyncio.Queue, session: SmtpSession,
+                          smtp_executor: concurrent.futures.Executor) -> None:
+        """
+        Send the replies using the given SMTP session
+        :param loop: the event loop
+        :param source: the queue of the tuples (uid, message, reply)
+        :param flag_queue: the queue receiving the tuples (uid, True if the reply has been sent)
+        :param session: the SMTP session of the worker
+        :param smtp_executor: the executor used to send the replies
+        """
+        checked: bool = False
+        while True:
+            item: tuple[int, message.Message, bytes] = await source.get()
+            if item is None:
+                break
+            uid, original, data = item
+            if not checked:
+                await loop.run_in_executor(smtp_executor, session.check)
+                checked = True
+            sent: bool = await loop.run_in_executor(smtp_executor, self._send, original, data, session)
+            await flag_queue.put((uid, sent))
+        await flag_queue.put(None)
+
+    async def _flag_stage(self, source: asyncio.Queue, producers: int) -> None:
+        """
+        Collect the processed messages, the AUTOREPLIED flag is added at the end of the cycle to the ones which must not be checked again
+        :param source: the queue of the tuples (uid, True to flag the message)
+        :param producers: the number of stages sending messages, each one sends None when done
+        """
+        while producers > 0:
+            item: tuple[int, bool] = await source.get()
+            if item is None:
+                producers -= 1
+                continue
+            if item[1]:
+                self._flag(item[0])
+            else:
+                self.__failed.append(item[0])
+            self.__metrics.add(METRIC_BACKLOG, -1, mailbox=self.__settings.name)
+
+    def _is_idle_supported(self) -> bool:
+        """
+        Check if the IDLE command can be used.
+        :return: True if IDLE is enabled and advertised by the server
+        """
+        return self.__settings.imap_idle and 'IDLE' in self.__imap.capabilities
+
+    def _is_buffered(self) -> bool:
+        """
+        Check if data has already been received from the IMAP server and is waiting in the buffers of the connection.
+        Several responses sent in a single segment are read from the socket at once, so the socket is not reported as readable for the next ones.
+        :return: True if the SSL layer or the buffered reader of the connection holds data
+        """
+        sock: socket.socket = self.__imap.sock
+        # SSL sockets may already hold decrypted data
+        if hasattr(sock, 'pending') and sock.pending() > 0:
+            return True
+        # The buffered reader reads the socket when its buffer is empty, so the socket must not block
+        timeout: float = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return len(self.__imap.file.peek(1)) > 0
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
         finally:
-            self.__imap.close()
-        self._send_auto_reply(message_from_bytes(data[0][1]))
+            sock.settimeout(timeout)
 
-    def _check_mails(self) -> None:
+    def _idle(self) -> bool:
         """
-        Check incoming unseen and unanswered messages.
+        Wait for new messages using the IDLE command (RFC 2177) on the selected mailbox.
+        The command is terminated when the server notifies new messages, when the timeout is reached or when the process is stopped.
+        It is also terminated and issued again after the NOOP interval, so a broken connection is detected by the timeout of the socket.
+        :return: True if new messages have been notified
         """
-        since_date: datetime.datetime = (datetime.datetime.today() - datetime.timedelta(days=self.__age_in_days))
+        notified: bool = False
+        deadline: float = time.monotonic() + self.__settings.imap_idle_timeout
+        _, uidnext = self._select()
+        # Messages received since the last search are not notified by the IDLE command
+        _, exists = self.__imap.response('EXISTS')
+        if (uidnext is not None and self.__last_uid is not None and uidnext - 1 > self.__last_uid) or (uidnext is None and any(exists)):
+            self.__logger.debug('New messages received since the last check')
+            return True
+        self.__logger.debug('Waiting for new messages using IDLE...')
+        waiting: bool = True
+        while waiting and not notified and time.monotonic() < deadline:
+            self.__imap.send(IMAP_IDLE_TAG + b' IDLE\r\n')
+            line: bytes = self.__imap.readline()
+            if not line:
+                raise IMAP4.abort('Connection closed before IDLE')
+            if not line.startswith(b'+'):
+                raise IMAP4.error('IDLE rejected: ' + line.decode(errors='replace').strip())
+            renewal: float = deadline if self.__settings.imap_noop_interval <= 0 else min(deadline, time.monotonic() + self.__settings.imap_noop_interval)
+            sock: socket.socket = self.__imap.sock
+            while not notified and time.monotonic() < renewal:
+                waiting = self.__active and not self._is_configuration_changed() and self._renew_lease()
+                if not waiting:
+                    break
+                if self._is_buffered() or select.select([sock], [], [], 1.0)[0]:
+                    line = self.__imap.readline()
+                    if not line:
+                        raise IMAP4.abort('Connection closed during IDLE')
+                    notified = IMAP_IDLE_PATTERN.match(line) is not None
+            self.__imap.send(b'DONE\r\n')
+            while True:
+                line = self.__imap.readline()
+                if not line:
+                    raise IMAP4.abort('Connection closed during IDLE')
+                if line.startswith(IMAP_IDLE_TAG):
+                    break
+                notified = notified or IMAP_IDLE_PATTERN.match(line) is not None
+            self.__last_noop = time.monotonic()
+        if notified:
+            self.__logger.debug('New messages notified')
+        return notified
+
+    def check(self) -> bool:
+        """
+        Check the incoming messages one time.
+        :return: False if the expiration date is passed
+        """
+        if datetime.datetime.now() >= self.__settings.date:
+            self.__logger.info('Date passed... stopping')
+            return False
+        if self.__store is None:
+            self._create_table()
+        self._supervise(self._check_mails)
+        return True
+
+    def poll(self) -> bool:
+        """
+        Check the incoming messages one time using an IMAP connection opened for the check, so an idle mailbox does not hold a connection.
+        The mailbox is only selected and searched when the STATUS command reports messages received since the last check.
+        :return: False if the expiration date is passed
+        """
+        if datetime.datetime.now() >= self.__settings.date:
+            self.__logger.info('Date passed... stopping')
+            return False
+        if self.__store is None:
+            self._create_table()
+        try:
+            self._supervise(self._poll)
+        finally:
+            self._logout()
+        return True
+
+    def _poll(self) -> None:
+        """
+        Login if required and check the incoming messages when the STATUS command reports new messages, see poll
+        """
+        if self.__imap is None:
+            self._login()
+        if not self._renew_lease():
+            self.__logger.debug('Lease held by another node, check skipped')
+        elif self._has_new_messages():
+            self._check_mails()
+        else:
+            self.__logger.debug('No new message')
+            self._maintain()
+
+    def _has_new_messages(self) -> bool:
+        """
+        Check using the STATUS command if messages have been received since the last check, the mailbox is not selected
+        :return: True if the mailbox must be searched
+        """
+        state: tuple[int, int] = self.__store.get_sync_state(self.__settings.name)
+        if state is None:
+            return True
+        self.__imap_limiter.acquire()
+        typ, data = self.__imap.status('INBOX', '(UIDNEXT UIDVALIDITY)')
+        if typ != 'OK' or not data or not isinstance(data[0], bytes):
+            return True
+        values: dict[bytes, int] = {k: int(v) for k, v in IMAP_STATUS_PATTERN.findall(data[0])}
+        if b'UIDNEXT' not in values or values.get(b'UIDVALIDITY') != state[0]:
+            return True
         if self.__logger.isEnabledFor(logging.DEBUG):
-            self.__logger.debug('Searching messages using: SINCE "%s" UNSEEN UNANSWERED', since_date.strftime(IMAP_DATE_FORMAT))
+            self.__logger.debug('Next UID: %s, last checked UID: %s', str(values[b'UIDNEXT']), str(state[1]))
+        return values[b'UIDNEXT'] - 1 > state[1]
+
+    def run_once(self) -> bool:
+        """
+        Check the incoming messages one time and close the connections, for a periodic invocation like a cron task.
+        The expiration date is checked before any connection and the mailbox is only selected and searched when the STATUS command
+        reports messages received since the last check, the SMTP connection is only opened to send a reply.
+        The replier must be created without login.
+        :return: False if the expiration date is passed
+        """
+        if datetime.datetime.now() >= self.__settings.date:
+            self.__logger.info('Date passed... stopping')
+            return False
         try:
-            self.__imap.select(readonly=False)
-            _, data = self.__imap.search(None, f'(SINCE "{since_date.strftime(IMAP_DATE_FORMAT)}" UNSEEN UNANSWERED)')
+            self._create_table()
+            self._login()
+            if self._has_new_messages():
+                self._supervise(self._check_mails)
+            else:
+                self.__logger.info('No new message')
         finally:
-            self.__imap.close()
-        for mail_id in data[0].split():
-            self._reply(mail_id)
-            time.sleep(self.__rate_limit)  # Rate Limit prevention
-        self.__logger.debug('Search done')
+            self.close()
+        return True
+
+    def replay(self, path: str, report_path: str = None) -> dict[str, float]:
+        """
+        Take the decisions for the messages of a local mbox file or Maildir directory, without any connection to the servers.
+        The skip rules, the block of the senders, the language detection and the rendering of the replies use the settings of this replier,
+        but the senders are kept in a database in memory and no reply is sent. The replier must be created without login.
+        :param path: the path of the mbox file or of the Maildir directory
+        :param report_path: the path of the file receiving the decision for each message as a JSON object by line, or None
+        :return: the numbers of messages by decision, the elapsed time and the number of messages processed by second
+        """
+        if self.__store is None:
+            self.__store = SenderStore(':memory:', self.__logger, self.__settings.block_cache_size, self.__settings.block_hours * 3600)
+            self.__store.open()
+        # pylint: disable=import-outside-toplevel
+        import json
+        from mailbox import Maildir, mbox
+        # pylint: enable=import-outside-toplevel
+        if os.path.isdir(path):
+            box: Mailbox = Maildir(path, factory=None, create=False)
+        else:
+            box: Mailbox = mbox(path, factory=None, create=False)
+        start: float = time.perf_counter()
+        counts: dict[str, float] = {}
+        for name in (METRIC_SEARCHED, METRIC_REPLIED, METRIC_SKIPPED, METRIC_FAILED):
+            counts[name] = self.__metrics.get(name, mailbox=self.__settings.name)
+        result: dict[str, float] = {'messages': 0, 'replied': 0, 'skipped': 0, 'failed': 0}
+        # pylint: disable=consider-using-with
+        report: TextIO = open(report_path, 'w', encoding='utf-8') if report_path else None
+        # pylint: enable=consider-using-with
+        try:
+            for key in box.iterkeys():
+                message_start: float = time.perf_counter()
+                with box.get_file(key) as f:
+                    original: message.Message = parse_message(iter(lambda f=f: f.read(MESSAGE_PARSE_CHUNK_SIZE), b''),
+                                                              REPLAY_HEADER_MAX_SIZE + self.__settings.imap_body_max_size)
+                self.__metrics.inc(METRIC_SEARCHED, mailbox=self.__settings.name)
+                decision: dict[str, object] = {'key': str(key), 'message_id': original['Message-ID'], 'from': original['From'], 'subject': original['Subject']}
+                reason: str = self._get_skip_reason(original)
+                if reason is not None:
+                    decision['decision'] = 'skipped'
+                    decision['reason'] = reason
+                else:
+                    decision['language'] = self._get_language(original)
+                    data: bytes = self._render(original, decision['language'])
+                    if data:
+                        self.__metrics.inc(METRIC_REPLIED, mailbox=self.__settings.name)
+                        decision['decision'] = 'replied'
+                        decision['reply_size'] = len(data)
+                    else:
+                        decision['decision'] = 'failed'
+                decision['duration_ms'] = round((time.perf_counter() - message_start) * 1000, 3)
+                result['messages'] += 1
+                result[decision['decision']] += 1
+                if report:
+                    report.write(json.dumps(decision, ensure_ascii=False) + '\n')
+        finally:
+            if report:
+                report.close()
+            box.close()
+        self._log_summary(start, counts)
+        result['elapsed_seconds'] = round(time.perf_counter() - start, 6)
+        result['messages_per_second'] = round(result['messages'] / result['elapsed_seconds'], 3) if result['elapsed_seconds'] > 0 else 0
+        return result
 
     def is_running(self) -> bool:
         """
@@ -780,6 +3837,7 @@ class AutoReplier:
                 return
         with self.__stop_lock:
             self.__active = False
+            self._flush()
 
     def start(self) -> None:
         """
@@ -791,16 +3849,200 @@ class AutoReplier:
         with self.__start_lock:
             try:
                 self._create_table()
+                if self.__settings.metrics_port > 0 and self.__metrics_server is None:
+                    self.__metrics_server = MetricsServer(self.__metrics, self.__settings.metrics_address, self.__settings.metrics_port, self.__logger)
+                    self.__metrics_server.start()
                 self.__logger.info('Now checking... Blocking rebounds for %s hours', str(self.__settings.block_hours))
                 self.__active = True
                 if datetime.datetime.now() >= self.__settings.date:
                     self.__logger.info('Date passed... stopping')
                     return
-                self._check_mails()
+                self._supervise(self._check_mails)
                 if self.__settings.refresh_delay > 0:
-                    sleep(self.__settings.refresh_delay)
+                    idle: bool = self._is_idle_supported()
+                    if idle:
+                        self.__logger.info('Using IDLE to wait for new messages')
                     while self.__active:
-                        self._check_mails()
-                        sleep(self.__settings.refresh_delay)
+                        # The connections are opened again when the wait or the check fails on a transient error
+                        if not self._renew_lease():
+                            # The lease is taken when the node holding it stops renewing it
+                            self._supervise(self._wait, self.__next_lease_renewal - time.monotonic())
+                        elif idle:
+                            # A check is also done when IDLE is issued again to recover missed notifications
+                            self._supervise(self._idle)
+                        else:
+                            self._supervise(self._wait, self.__settings.refresh_delay)
+                        if self.__active:
+                            self._supervise(self._check_mails)
             finally:
                 self.close()
+
+
+def init_shard_worker(logger_name: str) -> None:
+    """
+    Initialize a worker process of the sharded mode.
+    The records put in the queue of the logger by a forked process are not written, so the handlers of the listener are directly used.
+    :param logger_name: the name of the logger
+    """
+    logger: logging.Logger = logging.getLogger(logger_name)
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler) and getattr(handler, 'listener', None) is not None:
+            logger.removeHandler(handler)
+            for v in handler.listener.handlers:
+                logger.addHandler(v)
+
+
+def process_shard(settings: AutoReplierSettings, logger_name: str, uids: list[int]) -> tuple[dict[str, list[dict]], list[int]]:
+    """
+    Process the given messages using a dedicated replier, called in a worker process of the sharded mode
+    :param settings: the settings
+    :param logger_name: the name of the logger
+    :param uids: the unique identifiers of the messages
+    :return: the tuple (snapshot of the metrics of the replier, UIDs of the messages whose reply has not been sent)
+    """
+    return AutoReplier(settings, logging.getLogger(logger_name), login=False).process_shard(uids)
+
+
+class AutoReplierPool:
+    """
+    Host the repliers of several mailboxes in a single process.
+    The checks of the mailboxes are scheduled on a shared pool of threads and the senders are kept in a single store using the names of the mailboxes.
+    Each check opens its own IMAP connection and only selects the mailbox when the STATUS command reports new messages, so an idle mailbox
+    does not hold a connection between its checks.
+    """
+    __logger: logging.Logger = None
+    __store: SenderStore = None
+    __metrics: Metrics = None
+    __metrics_server: MetricsServer = None
+    __active: bool = False
+
+    def __init__(self, settings: list[AutoReplierSettings], logger: logging.Logger):
+        """
+        Initialize, the mailboxes are logged in by their checks
+        :param settings: the settings of the mailboxes
+        :param logger: the logger
+        """
+        if not settings:
+            raise ValueError('No mailbox specified')
+        self.__settings: list[AutoReplierSettings] = settings
+        self.__logger = logger
+        self.__logger.info('Initializing ' + self.__class__.__name__ + ' with ' + str(len(settings)) + ' mailboxes...')
+        self.__active = False
+        self.__lock: threading.RLock = threading.RLock()
+        self.__store = SenderStore(settings[0].db_path, logger, max(v.block_cache_size for v in settings), max(v.block_hours for v in settings) * 3600)
+        self.__metrics = Metrics()
+        self.__repliers: list[AutoReplier] = []
+        for v in settings:
+            self.__repliers.append(AutoReplier(v, logger.getChild(v.name) if v.name else logger, self.__store, False, self.__metrics, hooks=False))
+        # Hooks
+        atexit.register(self.stop)
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+
+    def close(self) -> None:
+        """
+        Close the connections of the mailboxes and the database.
+        """
+        for replier in self.__repliers:
+            try:
+                replier.close()
+            # pylint: disable=broad-exception-caught
+            except Exception as ex:
+                self.__logger.error(ex)
+            # pylint: enable=broad-exception-caught
+        if self.__metrics_server:
+            self.__metrics_server.stop()
+        self.__store.close()
+
+    def get_metrics(self) -> dict[str, list[dict]]:
+        """
+        Return a snapshot of the metrics of all the mailboxes, the values are labelled by the names of the mailboxes
+        :return: the values by name of metric, see Metrics.snapshot
+        """
+        return self.__metrics.snapshot()
+
+    def is_running(self) -> bool:
+        """
+        Check if running.
+        :return: True if running
+        """
+        return self.__active
+
+    def run_once(self) -> bool:
+        """
+        Check each mailbox one time and close the connections and the database, see AutoReplier.run_once
+        :return: False if the expiration dates of all the mailboxes are passed
+        """
+        result: bool = False
+        if all(datetime.datetime.now() >= v.date for v in self.__settings):
+            self.__logger.info('Date passed for all the mailboxes... stopping')
+            return result
+        self.__store.open()
+        try:
+            for i, replier in enumerate(self.__repliers):
+                try:
+                    result = replier.run_once() or result
+                # pylint: disable=broad-exception-caught
+                except Exception as ex:
+                    _, _, exc_traceback4 = sys.exc_info()
+                    traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
+                    self.__logger.error('Check failed for mailbox %s: %s', self.__settings[i].name, str(ex))
+                # pylint: enable=broad-exception-caught
+        finally:
+            self.close()
+        return result
+
+    def stop(self) -> None:
+        """
+        Stop the process, the running checks are completed.
+        """
+        with self.__lock:
+            self.__active = False
+
+    def start(self) -> None:
+        """
+        Start the process.
+        Each mailbox is checked again after its refresh delay and until its expiration date is passed.
+        """
+        with self.__lock:
+            if self.__active:
+                return
+            self.__active = True
+        self.__store.open()
+        if self.__settings[0].metrics_port > 0:
+            self.__metrics_server = MetricsServer(self.__metrics, self.__settings[0].metrics_address, self.__settings[0].metrics_port, self.__logger)
+            self.__metrics_server.start()
+        # pylint: disable=import-outside-toplevel
+        import concurrent.futures
+        # pylint: enable=import-outside-toplevel
+        queue: list[tuple[float, int]] = [(0.0, i) for i in range(len(self.__repliers))]
+        running: dict[concurrent.futures.Future, int] = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.__settings[0].workers), thread_name_prefix='AutoReplier') as executor:
+                while self.__active and (queue or running):
+                    now: float = time.monotonic()
+                    while queue and queue[0][0] <= now:
+                        _, i = heapq.heappop(queue)
+                        running[executor.submit(self.__repliers[i].poll)] = i
+                    # The loop is awakened every second to handle the stop
+                    timeout: float = min(queue[0][0] - now, 1.0) if queue else 1.0
+                    if running:
+                        done, _ = concurrent.futures.wait(running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                    else:
+                        done = set()
+                        sleep(timeout)
+                    for future in done:
+                        i = running.pop(future)
+                        active: bool = True
+                        try:
+                            active = future.result()
+                        # pylint: disable=broad-exception-caught
+                        except Exception as ex:
+                            _, _, exc_traceback4 = sys.exc_info()
+                            traceback.print_tb(exc_traceback4, limit=6, file=sys.stderr)
+                            self.__logger.error('Check failed for mailbox %s: %s', self.__settings[i].name, str(ex))
+                        # pylint: enable=broad-exception-caught
+                        if active and self.__settings[i].refresh_delay > 0:
+                            heapq.heappush(queue, (time.monotonic() + self.__settings[i].refresh_delay, i))
+        finally:
+            self.__active = False
+            self.close()
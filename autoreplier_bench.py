@@ -0,0 +1,415 @@
+#!/usr/bin/python
+# -*- coding: utf-8-
+"""
+Benchmarks of the auto-replier.
+The end-to-end benchmark drives the replier against in-process IMAP and SMTP servers using a synthetic mailbox,
+the results can be written to a JSON file and compared to a baseline to detect the regressions.
+"""
+import argparse
+import base64
+import datetime
+import json
+import logging
+import math
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from email import message_from_bytes, message
+from autoreplier import AutoReplier, AutoReplierSettings, LanguageDetector, LANGUAGE_SAMPLES, METRIC_FAILED, METRIC_REPLIED, METRIC_SKIPPED, ReplyTemplate, \
+    ReplyTemplateType, get_message_text
+from autoreplier_fakes import FakeIMAPServer, FakeMailbox, FakeSMTPServer
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+BENCH_LANGUAGES: list[str] = ['en', 'fr', 'de']
+BENCH_ADDRESSES: list[str] = ['me@example.com', 'sales@example.com']
+BENCH_TEXT_BODY: str = """
+    Hello,
+    I am out of the office until ${date} with limited access to my messages.
+    For urgent matters, please contact the support team.
+    Best regards
+    """
+BENCH_HTML_BODY: str = '<html><body><p>Hello,</p><p>I am out of the office until ${date}.</p><p>Best regards</p></body></html>'
+BENCH_SKIPPED_DOMAIN: str = 'notifications.example.net'  # Domain of the senders matching a skip rule
+BENCH_TIMEOUT: float = 600  # Maximum duration in seconds of the end-to-end benchmark
+BENCH_IN_REPLY_TO_PATTERN: re.Pattern = re.compile(rb'^In-Reply-To: *(.*?)\r?$', re.MULTILINE | re.IGNORECASE)
+# Results where a lower value is better, the other results are rates
+BENCH_LOWER_IS_BETTER: set[str] = {'latency_p50_ms', 'latency_p99_ms', 'peak_rss_kb', 'is_skipped_ms', 'language_detection_ms'}
+
+
+def create_template(lang: str, template_type: ReplyTemplateType, email: str, body: str) -> ReplyTemplate:
+    """
+    Create a template
+    :param lang: the language
+    :param template_type: the type of template
+    :param email: the address or None for the default templates
+    :param body: the body
+    :return: the template
+    """
+    template: ReplyTemplate = ReplyTemplate()
+    template.lang = lang
+    template.type = template_type
+    template.email = email
+    template.body = body
+    return template
+
+
+def create_settings(path: str = None) -> AutoReplierSettings:
+    """
+    Create the settings using the given configuration file or synthetic templates
+    :param path: the path of the configuration file or None
+    :return: the settings
+    """
+    settings: AutoReplierSettings = AutoReplierSettings()
+    settings.db_path = os.path.join(tempfile.mkdtemp(), 'autoreplier_bench.db')
+    if path:
+        settings.parse(path)
+        settings.db_path = os.path.join(tempfile.mkdtemp(), 'autoreplier_bench.db')
+        if settings.date <= datetime.datetime.now():
+            settings.date = datetime.datetime.now() + datetime.timedelta(days=7)
+        return settings
+    settings.date = datetime.datetime.now() + datetime.timedelta(days=7)
+    for email in [None] + BENCH_ADDRESSES:
+        for lang in BENCH_LANGUAGES:
+            settings.templates.append(create_template(lang, ReplyTemplateType.TEXT, email, BENCH_TEXT_BODY))
+            settings.templates.append(create_template(lang, ReplyTemplateType.HTML, email, BENCH_HTML_BODY))
+    return settings
+
+
+def create_messages(count: int, addresses: list[str]) -> list[message.Message]:
+    """
+    Create the incoming messages
+    :param count: the number of messages
+    :param addresses: the recipients of the messages
+    :return: the messages
+    """
+    result: list[message.Message] = []
+    for i in range(count):
+        data: str = ('From: Sender ' + str(i) + ' <sender' + str(i) + '@example.org>\r\n'
+                     + 'To: ' + addresses[i % len(addresses)] + '\r\n'
+                     + 'Subject: Question number ' + str(i) + '\r\n'
+                     + 'Message-ID: <' + str(i) + '@example.org>\r\n'
+                     + 'Content-Language: ' + BENCH_LANGUAGES[i % len(BENCH_LANGUAGES)] + '\r\n'
+                     + 'Content-Type: text/plain; charset=utf-8\r\n\r\n'
+                     + LANGUAGE_SAMPLES[BENCH_LANGUAGES[i % len(BENCH_LANGUAGES)]] + '\r\n')
+        result.append(message_from_bytes(data.encode()))
+    return result
+
+
+def bench_replies(replier: AutoReplier, messages: list[message.Message]) -> dict[str, float]:
+    """
+    Measure the number of replies created per second, by building the MIME message of each reply and by rendering the prepared replies
+    :param replier: the replier
+    :param messages: the incoming messages
+    :return: the replies per second by method
+    """
+    result: dict[str, float] = {}
+    start: float = time.perf_counter()
+    for original in messages:
+        replier._create_auto_reply(original).as_bytes()
+    result['build'] = len(messages) / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for original in messages:
+        replier._render_auto_reply(original)
+    result['prepared'] = len(messages) / (time.perf_counter() - start)
+    return result
+
+
+def bench_language_detection(messages: list[message.Message]) -> float:
+    """
+    Measure the time used to detect the language of the messages among the languages of the detector
+    :param messages: the incoming messages
+    :return: the average time in milliseconds
+    """
+    detector: LanguageDetector = LanguageDetector(list(LANGUAGE_SAMPLES))
+    start: float = time.perf_counter()
+    for original in messages:
+        detector.detect(get_message_text(original))
+    return (time.perf_counter() - start) * 1000 / len(messages)
+
+
+# noinspection PyProtectedMember
+def bench_skip(replier: AutoReplier, messages: list[message.Message]) -> float:
+    """
+    Measure the time used to decide if the messages must be skipped, using the skip rules and the store of the senders
+    :param replier: the replier, its store is created if required
+    :param messages: the incoming messages
+    :return: the average time in milliseconds
+    """
+    replier._create_table()
+    start: float = time.perf_counter()
+    for original in messages:
+        replier._is_skipped(original)
+    return (time.perf_counter() - start) * 1000 / len(messages)
+
+
+# pylint: disable=too-many-positional-arguments
+def create_mailbox_messages(count: int, size: int, attachment_ratio: float, languages: dict[str, float], repeat_ratio: float, skip_ratio: float,
+                            addresses: list[str], seed: int = 1) -> list[bytes]:
+    """
+    Create the messages of a synthetic mailbox, the same seed gives the same messages
+    :param count: the number of messages
+    :param size: the size in bytes of the text of the messages and of the attachments
+    :param attachment_ratio: the ratio of messages having an attachment
+    :param languages: the weight of each language of the texts, the languages must have a sample
+    :param repeat_ratio: the ratio of messages sent by a sender who already sent a message
+    :param skip_ratio: the ratio of messages sent from a domain matching a skip rule
+    :param addresses: the recipients of the messages
+    :param seed: the seed of the random generator
+    :return: the messages
+    """
+    rng: random.Random = random.Random(seed)
+    senders: list[str] = []
+    result: list[bytes] = []
+    for i in range(count):
+        v: float = rng.random()
+        if v < skip_ratio:
+            sender: str = 'robot' + str(i) + '@' + BENCH_SKIPPED_DOMAIN
+        elif senders and v < skip_ratio + repeat_ratio:
+            sender: str = rng.choice(senders)
+        else:
+            sender: str = 'sender' + str(i) + '@example.org'
+            senders.append(sender)
+        lang: str = rng.choices(list(languages), weights=list(languages.values()))[0]
+        text: str = LANGUAGE_SAMPLES[lang] + '\r\n'
+        text = (text * (size // len(text) + 1))[:size]
+        headers: str = ('From: ' + sender + '\r\n'
+                        + 'To: ' + addresses[i % len(addresses)] + '\r\n'
+                        + 'Subject: Question number ' + str(i) + '\r\n'
+                        + 'Message-ID: <' + str(i) + '@bench.example.org>\r\n'
+                        + 'MIME-Version: 1.0\r\n')
+        if rng.random() < attachment_ratio:
+            attachment: str = base64.encodebytes(rng.randbytes(size)).decode().replace('\n', '\r\n')
+            data: str = (headers + 'Content-Type: multipart/mixed; boundary="bench"\r\n\r\n'
+                         + '--bench\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' + text + '\r\n'
+                         + '--bench\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n'
+                         + 'Content-Disposition: attachment; filename="data.bin"\r\n\r\n' + attachment + '--bench--\r\n')
+        else:
+            data: str = headers + 'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n' + text + '\r\n'
+        result.append(data.encode())
+    return result
+# pylint: enable=too-many-positional-arguments
+
+
+def get_percentile(values: list[float], ratio: float) -> float:
+    """
+    Return the percentile of the values using the nearest rank
+    :param values: the values
+    :param ratio: the ratio, like 0.99
+    :return: the percentile or 0 if there is no value
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[max(0, math.ceil(ratio * len(values)) - 1)]
+
+
+def get_peak_rss() -> int:
+    """
+    Return the peak resident set size of the process, including the in-process servers
+    :return: the size in kilobytes or 0 if not available
+    """
+    if resource is None:
+        return 0
+    v: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # The size is given in bytes on macOS
+    return v // 1024 if sys.platform == 'darwin' else v
+
+
+def get_decided(replier: AutoReplier) -> int:
+    """
+    Return the number of messages which have been replied, skipped or which failed
+    :param replier: the replier
+    :return: the number of messages
+    """
+    metrics: dict[str, list[dict]] = replier.get_metrics()
+    return int(sum(v['value'] for name in (METRIC_REPLIED, METRIC_SKIPPED, METRIC_FAILED) for v in metrics.get(name, [])))
+
+
+def bench_end_to_end(settings: AutoReplierSettings, messages: list[bytes], arrival_rate: float = 0, imap_latency: float = 0,
+                     smtp_latency: float = 0) -> dict[str, float]:
+    """
+    Measure the processing of the messages by the replier connected to in-process IMAP and SMTP servers.
+    The messages are stored before the start when the arrival rate is 0, otherwise they are appended at the given rate
+    while the replier waits for them. The latency of a message is measured from its arrival, or from the start for the stored
+    messages, to the reception of its reply by the SMTP server.
+    :param settings: the settings, the servers and the rate limits are overridden
+    :param messages: the messages
+    :param arrival_rate: the number of messages appended by second or 0
+    :param imap_latency: the delay in seconds added to each IMAP response
+    :param smtp_latency: the delay in seconds used by the SMTP server to accept each message
+    :return: the results
+    """
+    mailbox: FakeMailbox = FakeMailbox()
+    imap_server: FakeIMAPServer = FakeIMAPServer(mailbox, imap_latency)
+    smtp_server: FakeSMTPServer = FakeSMTPServer(smtp_latency)
+    imap_server.start()
+    smtp_server.start()
+    arrivals: dict[bytes, float] = {}  # Time of the arrival by Message-ID
+    try:
+        settings.imap_server, settings.imap_port = imap_server.server_address
+        settings.smtp_server, settings.smtp_port = smtp_server.server_address
+        settings.imap_user = settings.smtp_user = 'bench'
+        settings.imap_password = settings.smtp_password = base64.b64encode(b'bench').decode()
+        settings.imap_use_ssl = settings.smtp_use_ssl = False
+        settings.imap_rate = settings.smtp_rate = 0
+        settings.metrics_port = 0
+        settings.refresh_delay = 1 if arrival_rate > 0 else -1
+        settings.imap_idle = True
+        settings.skipped_domains = settings.skipped_domains + [BENCH_SKIPPED_DOMAIN]
+        if arrival_rate <= 0:
+            for data in messages:
+                mailbox.append(data)
+        logger: logging.Logger = logging.getLogger('autoreplier_bench')
+        replier: AutoReplier = AutoReplier(settings, logger)
+        start: float = time.perf_counter()
+        if arrival_rate <= 0:
+            replier.start()
+            end: float = time.perf_counter()
+            arrivals = {f'<{i}@bench.example.org>'.encode(): start for i in range(len(messages))}
+        else:
+            thread: threading.Thread = threading.Thread(target=replier.start, name='bench-replier')
+            thread.start()
+            deadline: float = start + BENCH_TIMEOUT
+            for i, data in enumerate(messages):
+                time.sleep(max(0.0, start + i / arrival_rate - time.perf_counter()))
+                arrivals[f'<{i}@bench.example.org>'.encode()] = time.perf_counter()
+                mailbox.append(data)
+            while get_decided(replier) < len(messages) and time.perf_counter() < deadline:
+                time.sleep(0.01)
+            end: float = time.perf_counter()
+            replier.stop()
+            thread.join()
+        elapsed: float = end - start
+        latencies: list[float] = []
+        for _, _, data, received in smtp_server.received:
+            m: re.Match = BENCH_IN_REPLY_TO_PATTERN.search(data)
+            if m and m.group(1) in arrivals:
+                latencies.append((received - arrivals[m.group(1)]) * 1000)
+        return {
+            'messages': len(messages),
+            'replies': len(smtp_server.received),
+            'elapsed_seconds': round(elapsed, 6),
+            'messages_per_second': round(len(messages) / elapsed, 3) if elapsed > 0 else 0,
+            'latency_p50_ms': round(get_percentile(latencies, 0.5), 3),
+            'latency_p99_ms': round(get_percentile(latencies, 0.99), 3),
+            'peak_rss_kb': get_peak_rss()
+        }
+    finally:
+        imap_server.stop()
+        smtp_server.stop()
+
+
+def compare_results(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """
+    Compare the results to a baseline
+    :param results: the results by section
+    :param baseline: the results of the baseline by section
+    :param tolerance: the accepted degradation ratio, like 0.2
+    :return: the descriptions of the regressions
+    """
+    result: list[str] = []
+    for section in ('end_to_end', 'operations'):
+        for name, reference in baseline.get(section, {}).items():
+            v: float = results.get(section, {}).get(name)
+            if v is None or not reference or name in {'messages', 'replies', 'elapsed_seconds'}:
+                continue
+            if name in BENCH_LOWER_IS_BETTER:
+                regressed: bool = v > reference * (1 + tolerance)
+            else:
+                regressed: bool = v < reference * (1 - tolerance)
+            if regressed:
+                result.append(section + '.' + name + ': ' + str(v) + ' (baseline: ' + str(reference) + ')')
+    return result
+
+
+def parse_languages(value: str) -> dict[str, float]:
+    """
+    Parse the language mix, like en:0.6,fr:0.3,de:0.1 or en,fr for equal weights
+    :param value: the language mix
+    :return: the weight by language
+    """
+    result: dict[str, float] = {}
+    for item in value.split(','):
+        lang, _, weight = item.strip().partition(':')
+        if lang not in LANGUAGE_SAMPLES:
+            raise argparse.ArgumentTypeError('No sample for language: ' + lang + ', available: ' + ', '.join(LANGUAGE_SAMPLES))
+        result[lang] = float(weight) if weight else 1.0
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='Autoreplier benchmark', description='Benchmarks of the auto-replier')
+    parser.add_argument('-f', help='Configuration file providing the templates, synthetic templates are used if not specified')
+    parser.add_argument('-n', type=int, default=10000, help='Number of messages used to measure the operations')
+    parser.add_argument('-m', type=int, default=1000, help='Number of messages of the synthetic mailbox, 0 to skip the end-to-end benchmark')
+    parser.add_argument('-o', help='Path of the JSON file receiving the results')
+    parser.add_argument('--size', type=int, default=2048, help='Size in bytes of the text of the messages and of the attachments')
+    parser.add_argument('--attachments', type=float, default=0.1, help='Ratio of messages having an attachment')
+    parser.add_argument('--languages', type=parse_languages, default='en:0.5,fr:0.3,de:0.2', help='Language mix, like en:0.5,fr:0.3,de:0.2')
+    parser.add_argument('--repeat', type=float, default=0.2, help='Ratio of messages sent by a sender who already sent a message')
+    parser.add_argument('--skip', type=float, default=0.1, help='Ratio of messages matching a skip rule')
+    parser.add_argument('--rate', type=float, default=0, help='Arrival rate of the messages by second, 0 to process a stored backlog')
+    parser.add_argument('--imap-latency', type=float, default=0, help='Delay in milliseconds added to each IMAP response')
+    parser.add_argument('--smtp-latency', type=float, default=0, help='Delay in milliseconds used by the SMTP server to accept each message')
+    parser.add_argument('--sequential', action='store_true', help='Process the messages sequentially instead of using the pipeline')
+    parser.add_argument('--shards', type=int, default=0, help='Number of worker processes used to process the backlog, 0 to use this process')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generator of the synthetic mailbox')
+    parser.add_argument('--baseline', help='JSON file of previous results, the exit code is 1 if a result is worse than the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Accepted degradation ratio compared to the baseline')
+    args = parser.parse_args()
+    bench_logger: logging.Logger = logging.getLogger('autoreplier_bench')
+    bench_logger.setLevel(logging.ERROR)
+    bench_addresses: list[str] = BENCH_ADDRESSES + ['unknown@example.com']
+    if args.f:
+        bench_addresses = [t.email for t in create_settings(args.f).templates if t.email] + ['unknown@example.com']
+    bench_results: dict[str, dict] = {
+        'parameters': {k: v for k, v in vars(args).items() if k not in {'o', 'baseline'}},
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(), 'processors': os.cpu_count()}
+    }
+    if args.m > 0:
+        # Run first as the peak resident set size of the process is measured
+        bench_settings: AutoReplierSettings = create_settings(args.f)
+        bench_settings.pipeline = not args.sequential
+        bench_settings.shards, bench_settings.shard_min_size = args.shards, 1
+        bench_results['end_to_end'] = bench_end_to_end(bench_settings, create_mailbox_messages(args.m, args.size, args.attachments, args.languages,
+                                                                                               args.repeat, args.skip, bench_addresses, args.seed),
+                                                       args.rate, args.imap_latency / 1000, args.smtp_latency / 1000)
+        for result_name, result_value in bench_results['end_to_end'].items():
+            print('End-to-end ' + result_name.replace('_', ' ') + ': ' + str(result_value))
+    bench_replier: AutoReplier = AutoReplier(create_settings(args.f), bench_logger, login=False)
+    bench_messages: list[message.Message] = create_messages(args.n, bench_addresses)
+    rates: dict[str, float] = bench_replies(bench_replier, bench_messages)
+    bench_results['operations'] = {
+        'create_auto_reply_per_second': round(rates['build'], 3),
+        'render_auto_reply_per_second': round(rates['prepared'], 3),
+        'is_skipped_ms': round(bench_skip(bench_replier, bench_messages), 6),
+        'language_detection_ms': round(bench_language_detection(create_messages(min(args.n, 1000), bench_addresses)), 6)
+    }
+    bench_replier.close()
+    print('Replies per second using the MIME messages built for each reply: ' + str(round(rates['build'])))
+    print('Replies per second using the prepared replies: ' + str(round(rates['prepared'])))
+    print('Speedup: ' + str(round(rates['prepared'] / rates['build'], 1)) + 'x')
+    print('Skip decision: ' + str(round(bench_results['operations']['is_skipped_ms'], 3)) + ' ms per message')
+    print('Language detection: ' + str(round(bench_results['operations']['language_detection_ms'], 3)) + ' ms per message')
+    if args.o:
+        with open(args.o, 'w', encoding='utf-8') as file:
+            json.dump(bench_results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            bench_baseline: dict[str, dict] = json.load(file)
+        if {k: v for k, v in bench_baseline.get('parameters', {}).items() if k != 'tolerance'} != \
+                {k: v for k, v in bench_results['parameters'].items() if k != 'tolerance'}:
+            print('Warning: the parameters of the baseline are different')
+        regressions: list[str] = compare_results(bench_results, bench_baseline, args.tolerance)
+        for regression in regressions:
+            print('Regression: ' + regression)
+        sys.exit(1 if regressions else 0)
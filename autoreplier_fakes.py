@@ -0,0 +1,468 @@
+#!/usr/bin/python
+# -*- coding: utf-8-
+"""
+In-process IMAP4 and SMTP servers used by the tests and the benchmarks of the auto-replier.
+Only the commands sent by the replier are implemented.
+"""
+import re
+import socket
+import socketserver
+import threading
+import time
+
+FAKE_CAPABILITIES: bytes = b'IMAP4rev1 IDLE UIDPLUS'
+FAKE_HEADER_FIELDS_PATTERN: re.Pattern = re.compile(r'BODY(?:\.PEEK)?\[HEADER\.FIELDS \(([^)]*)\)\]')
+FAKE_TEXT_PATTERN: re.Pattern = re.compile(r'BODY(?:\.PEEK)?\[TEXT\](?:<(\d+)\.(\d+)>)?')
+FAKE_RFC822_PATTERN: re.Pattern = re.compile(r'RFC822(?![.A-Z])')
+FAKE_UID_PATTERN: re.Pattern = re.compile(r'UID (\S+)')
+FAKE_UNKEYWORD_PATTERN: re.Pattern = re.compile(r'UNKEYWORD (\S+)')
+
+
+def split_message(data: bytes) -> tuple[bytes, bytes]:
+    """
+    Split the message in headers (including the empty line) and body
+    :param data: the message
+    :return: the headers and the body
+    """
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        i: int = data.find(separator)
+        if i >= 0:
+            return data[:i + len(separator)], data[i + len(separator):]
+    return data, b''
+
+
+def get_header_fields(data: bytes, names: set[str]) -> bytes:
+    """
+    Return the given header fields of the message, like BODY[HEADER.FIELDS (...)]
+    :param data: the message
+    :param names: the names of the fields in uppercase
+    :return: the fields followed by an empty line
+    """
+    headers, _ = split_message(data)
+    result: list[bytes] = []
+    keep: bool = False
+    for line in headers.splitlines(keepends=True):
+        if line in {b'\r\n', b'\n'}:
+            break
+        if line[:1] in {b' ', b'\t'}:
+            if keep:
+                result.append(line)
+            continue
+        keep = line.split(b':', 1)[0].strip().upper().decode() in names
+        if keep:
+            result.append(line)
+    return b''.join(result) + b'\r\n'
+
+
+class FakeMailbox:
+    """
+    Messages of the fake IMAP server, the listeners are notified when a message is appended.
+    """
+    def __init__(self):
+        """
+        Initialize
+        """
+        self.lock: threading.RLock = threading.RLock()
+        self.messages: dict[int, list] = {}  # Flags, data and time of the append by UID
+        self.uidvalidity: int = 1
+        self.uidnext: int = 1
+        self.listeners: list = []
+
+    def append(self, data: bytes, flags: tuple = ()) -> int:
+        """
+        Append a message
+        :param data: the message
+        :param flags: the flags of the message
+        :return: the UID of the message
+        """
+        with self.lock:
+            uid: int = self.uidnext
+            self.uidnext += 1
+            self.messages[uid] = [set(flags), data, time.perf_counter()]
+            count: int = len(self.messages)
+            listeners: list = list(self.listeners)
+        for listener in listeners:
+            listener(count)
+        return uid
+
+    def flagged(self, flag: str) -> list[int]:
+        """
+        Return the UIDs of the messages having the flag
+        :param flag: the flag
+        :return: the UIDs
+        """
+        with self.lock:
+            return [uid for uid, v in self.messages.items() if flag in v[0]]
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """
+    Connection to the fake IMAP server.
+    """
+    exists: int = 0  # Number of messages reported to the client
+
+    def send(self, data: bytes) -> None:
+        """
+        Send a response
+        :param data: the response
+        """
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        """
+        Handle the commands of the client.
+        """
+        mailbox: FakeMailbox = self.server.mailbox
+        self.server.connections.append(self.connection)
+        self.send(b'* OK [CAPABILITY ' + FAKE_CAPABILITIES + b'] ready\r\n')
+        while True:
+            line: bytes = self.rfile.readline()
+            if not line:
+                return
+            parts: list[str] = line.rstrip(b'\r\n').decode().split(' ', 2)
+            tag: bytes = parts[0].encode()
+            command: str = parts[1].upper() if len(parts) > 1 else ''
+            args: str = parts[2] if len(parts) > 2 else ''
+            self.server.commands.append(command + ' ' + args)
+            if self.server.disconnect_on and (command + ' ' + args).startswith(self.server.disconnect_on):
+                # The connection is closed one time without response
+                self.server.disconnect_on = None
+                return
+            if command == 'CAPABILITY':
+                self.send(b'* CAPABILITY ' + FAKE_CAPABILITIES + b'\r\n' + tag + b' OK done\r\n')
+            elif command == 'LOGIN':
+                self.send(tag + b' OK logged in\r\n')
+            elif command == 'LOGOUT':
+                self.send(b'* BYE logging out\r\n' + tag + b' OK done\r\n')
+                return
+            elif command in {'SELECT', 'EXAMINE'}:
+                with mailbox.lock:
+                    self.exists = len(mailbox.messages)
+                    data: bytes = (f'* {len(mailbox.messages)} EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY {mailbox.uidvalidity}] valid\r\n'
+                                   f'* OK [UIDNEXT {mailbox.uidnext}] next\r\n* FLAGS (\\Seen \\Answered)\r\n').encode()
+                self.send(data + tag + b' OK [READ-WRITE] selected\r\n')
+            elif command in {'NOOP', 'CHECK'}:
+                # The new messages are reported as the server does for the selected mailbox
+                with mailbox.lock:
+                    data: bytes = b''
+                    if self.exists and len(mailbox.messages) != self.exists:
+                        self.exists = len(mailbox.messages)
+                        data = f'* {self.exists} EXISTS\r\n'.encode()
+                self.send(data + tag + b' OK done\r\n')
+            elif command == 'CLOSE':
+                self.send(tag + b' OK done\r\n')
+            elif command == 'STATUS':
+                with mailbox.lock:
+                    unseen: int = sum(1 for v in mailbox.messages.values() if '\\Seen' not in v[0])
+                    data: bytes = (f'* STATUS INBOX (MESSAGES {len(mailbox.messages)} UNSEEN {unseen} UIDNEXT {mailbox.uidnext} '
+                                   f'UIDVALIDITY {mailbox.uidvalidity})\r\n').encode()
+                self.send(data + tag + b' OK done\r\n')
+            elif command == 'IDLE':
+                self.idle(tag)
+            elif command == 'UID':
+                self.uid(tag, args)
+            else:
+                self.send(tag + b' BAD unknown command\r\n')
+
+    def idle(self, tag: bytes) -> None:
+        """
+        Handle the IDLE command, the messages received since the last report and the new messages are notified until DONE is received
+        :param tag: the tag of the command
+        """
+        mailbox: FakeMailbox = self.server.mailbox
+        # The responses are sent one time in the same segment as the continuation
+        self.send(b'+ idling\r\n' + (self.server.idle_responses or b''))
+        self.server.idle_responses = None
+
+        def listener(count: int) -> None:
+            self.exists = count
+            try:
+                self.wfile.write(f'* {count} EXISTS\r\n'.encode())
+                self.wfile.flush()
+            except OSError:
+                # The connection has been closed by the client or by disconnect
+                pass
+        with mailbox.lock:
+            mailbox.listeners.append(listener)
+            if len(mailbox.messages) != self.exists:
+                listener(len(mailbox.messages))
+        try:
+            self.rfile.readline()
+        finally:
+            with mailbox.lock:
+                mailbox.listeners.remove(listener)
+        self.send(tag + b' OK idle done\r\n')
+
+    def uid(self, tag: bytes, args: str) -> None:
+        """
+        Handle the UID SEARCH, FETCH and STORE commands
+        :param tag: the tag of the command
+        :param args: the arguments of the command
+        """
+        mailbox: FakeMailbox = self.server.mailbox
+        command, _, args = args.partition(' ')
+        command = command.upper()
+        if command == 'SEARCH':
+            uids: list[int] = self.search(args)
+            self.send(('* SEARCH ' + ' '.join(str(v) for v in uids) + '\r\n').encode() + tag + b' OK done\r\n')
+        elif command == 'FETCH':
+            message_set, _, items = args.partition(' ')
+            self.send(b''.join(self.fetch(message_set, items)) + tag + b' OK done\r\n')
+        elif command == 'STORE':
+            message_set, operation, flags = args.split(' ', 2)
+            values: set[str] = set(flags.strip('()').split())
+            with mailbox.lock:
+                for uid in self.get_uids(message_set):
+                    current: set[str] = mailbox.messages[uid][0]
+                    if operation.startswith('+'):
+                        current |= values
+                    elif operation.startswith('-'):
+                        current -= values
+                    else:
+                        current.clear()
+                        current |= values
+            self.server.stores += 1
+            self.send(tag + b' OK done\r\n')
+        else:
+            self.send(tag + b' BAD unknown command\r\n')
+
+    def get_uids(self, message_set: str) -> list[int]:
+        """
+        Return the UIDs of the existing messages of the set, n:* always includes the last message
+        :param message_set: the set, like 1:3,5,8:*
+        :return: the UIDs
+        """
+        with self.server.mailbox.lock:
+            existing: list[int] = sorted(self.server.mailbox.messages)
+        last: int = existing[-1] if existing else 0
+        result: list[int] = []
+        for part in message_set.split(','):
+            bounds: list[int] = [last if v == '*' else int(v) for v in part.split(':')]
+            low, high = min(bounds), max(bounds)
+            result.extend(v for v in existing if low <= v <= high)
+        return result
+
+    def search(self, criteria: str) -> list[int]:
+        """
+        Search the messages, only the UID, UNSEEN, UNANSWERED and UNKEYWORD criteria are used
+        :param criteria: the criteria
+        :return: the UIDs
+        """
+        criteria = criteria.strip('()').upper()
+        m: re.Match = FAKE_UID_PATTERN.search(criteria)
+        allowed: set[int] = set(self.get_uids(m.group(1))) if m else None
+        m = FAKE_UNKEYWORD_PATTERN.search(criteria)
+        keyword: str = m.group(1) if m else None
+        result: list[int] = []
+        with self.server.mailbox.lock:
+            for uid, (flags, _, _) in sorted(self.server.mailbox.messages.items()):
+                if allowed is not None and uid not in allowed:
+                    continue
+                if 'UNSEEN' in criteria and '\\Seen' in flags:
+                    continue
+                if 'UNANSWERED' in criteria and '\\Answered' in flags:
+                    continue
+                if keyword and keyword in {v.upper() for v in flags}:
+                    continue
+                result.append(uid)
+        return result
+
+    def fetch(self, message_set: str, items: str) -> list[bytes]:
+        """
+        Fetch the messages
+        :param message_set: the set of UIDs
+        :param items: the items, like (UID FLAGS BODY.PEEK[TEXT]<0.100>)
+        :return: the responses
+        """
+        mailbox: FakeMailbox = self.server.mailbox
+        items = items.upper()
+        result: list[bytes] = []
+        for number, uid in enumerate(self.get_uids(message_set), 1):
+            with mailbox.lock:
+                flags, data, _ = mailbox.messages[uid]
+                flags = set(flags)
+            response: list[bytes] = [f'* {number} FETCH (UID {uid}'.encode()]
+            if 'FLAGS' in items:
+                response.append(f' FLAGS ({" ".join(sorted(flags))})'.encode())
+            m: re.Match = FAKE_HEADER_FIELDS_PATTERN.search(items)
+            if m:
+                value: bytes = get_header_fields(data, set(m.group(1).split()))
+                response.append(f' BODY[HEADER.FIELDS ({m.group(1)})] {{{len(value)}}}\r\n'.encode() + value)
+            m = FAKE_TEXT_PATTERN.search(items)
+            if m:
+                _, value = split_message(data)
+                name: str = 'BODY[TEXT]'
+                if m.group(1):
+                    value = value[int(m.group(1)):int(m.group(1)) + int(m.group(2))]
+                    name += '<' + m.group(1) + '>'
+                response.append(f' {name} {{{len(value)}}}\r\n'.encode() + value)
+            if FAKE_RFC822_PATTERN.search(items):
+                response.append(f' RFC822 {{{len(data)}}}\r\n'.encode() + data)
+                with mailbox.lock:
+                    mailbox.messages[uid][0].add('\\Seen')
+            response.append(b')\r\n')
+            result.append(b''.join(response))
+        return result
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    Fake IMAP server listening on a free port of the loopback interface.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: FakeMailbox, latency: float = 0):
+        """
+        Initialize
+        :param mailbox: the messages
+        :param latency: the delay in seconds added before each response
+        """
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.mailbox: FakeMailbox = mailbox
+        self.latency: float = latency
+        self.stores: int = 0  # Number of STORE commands
+        self.commands: list[str] = []
+        self.connections: list[socket.socket] = []
+        self.disconnect_on: str = None  # Beginning of the command closing the connection without response
+        self.idle_responses: bytes = None  # Untagged responses sent with the continuation of the IDLE command
+
+    def start(self) -> None:
+        """
+        Start serving in a daemon thread.
+        """
+        threading.Thread(target=self.serve_forever, name='fake-imap', daemon=True).start()
+
+    def disconnect(self) -> None:
+        """
+        Close the connections of the clients without any response, like a server restarting or a network failure.
+        """
+        connections: list[socket.socket] = self.connections
+        self.connections = []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self) -> None:
+        """
+        Stop serving.
+        """
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Connection to the fake SMTP server.
+    """
+    def send(self, data: bytes) -> None:
+        """
+        Send a response
+        :param data: the response
+        """
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self) -> None:
+        """
+        Handle the commands of the client.
+        """
+        with self.server.lock:
+            self.server.connections += 1
+        self.send(b'220 fake ESMTP\r\n')
+        sender: str = None
+        recipients: list[str] = []
+        while True:
+            line: bytes = self.rfile.readline()
+            if not line:
+                return
+            command: str = line.rstrip(b'\r\n').decode()
+            upper: str = command.upper()
+            if upper.startswith('EHLO'):
+                self.send(b'250-fake\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+            elif upper.startswith('HELO'):
+                self.send(b'250 fake\r\n')
+            elif upper.startswith('AUTH'):
+                self.send(b'235 authenticated\r\n')
+            elif upper.startswith('MAIL'):
+                sender = command[10:]
+                recipients = []
+                self.send(b'250 ok\r\n')
+            elif upper.startswith('RCPT'):
+                if command[8:] in self.server.refused:
+                    self.send(b'550 refused\r\n')
+                    continue
+                recipients.append(command[8:])
+                self.send(b'250 ok\r\n')
+            elif upper.startswith('DATA'):
+                self.send(b'354 go ahead\r\n')
+                lines: list[bytes] = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in {b'.\r\n', b''}:
+                        break
+                    lines.append(line)
+                if self.server.latency > 0:
+                    time.sleep(self.server.latency)
+                if self.server.rejected.intersection(recipients):
+                    self.send(b'554 rejected\r\n')
+                    continue
+                with self.server.lock:
+                    deferred: bool = self.server.deferred > 0
+                    self.server.deferred -= int(deferred)
+                if deferred:
+                    self.send(b'451 try again later\r\n')
+                    continue
+                with self.server.lock:
+                    self.server.received.append((sender, recipients, b''.join(lines), time.perf_counter()))
+                self.send(b'250 queued\r\n')
+                if self.server.drop:
+                    return
+            elif upper.startswith('NOOP') or upper.startswith('RSET'):
+                self.send(b'250 ok\r\n')
+            elif upper.startswith('QUIT'):
+                self.send(b'221 bye\r\n')
+                return
+            else:
+                self.send(b'502 unknown command\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Fake SMTP server listening on a free port of the loopback interface, the received messages are kept in memory.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0):
+        """
+        Initialize
+        :param latency: the delay in seconds used to accept each message
+        """
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.lock: threading.Lock = threading.Lock()
+        self.latency: float = latency
+        self.received: list[tuple[str, list[str], bytes, float]] = []  # Sender, recipients, data and time of the reception
+        self.connections: int = 0
+        self.drop: bool = False  # Set True to close the connection after each message
+        self.rejected: set[str] = set()  # Recipients, like <john@domain.com>, of the messages rejected by the server
+        self.refused: set[str] = set()  # Recipients refused by the RCPT command
+        self.deferred: int = 0  # Number of the next messages rejected by a temporary failure
+
+    def start(self) -> None:
+        """
+        Start serving in a daemon thread.
+        """
+        threading.Thread(target=self.serve_forever, name='fake-smtp', daemon=True).start()
+
+    def stop(self) -> None:
+        """
+        Stop serving.
+        """
+        self.shutdown()
+        self.server_close()
@@ -3,33 +3,1015 @@
 """
 Main test suite
 """
+import atexit
+import base64
+import datetime
+import importlib.util
+import json
+import logging
+import mailbox
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
-from autoreplier import AutoReplier, AutoReplierSettings
+from unittest import mock
+from collections.abc import Iterator
+from email import message_from_bytes, message
+from imaplib import IMAP4
+from logging.handlers import QueueHandler
+from smtplib import SMTPAuthenticationError, SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+from autoreplier import AutoReplier, AutoReplierPool, AutoReplierSettings, LanguageDetector, Metrics, ReplyTemplate, ReplyTemplateType, SenderStore, SkipRules, TTLCache, TokenBucket, compress_uid_set, \
+    create_rotating_log, get_backoff_delay, get_message_text, is_transient_error, iter_fetch_response, parse_message, METRIC_FAILED, METRIC_RECONNECTIONS, METRIC_REPLIED, \
+    METRIC_SEARCHED, METRIC_SKIPPED
+from autoreplier_fakes import FakeIMAPServer, FakeMailbox, FakeSMTPServer
 
 
 class AutoReplierTest(unittest.TestCase):
     """
     Test suite for class AutoReplier
     """
+    def setUp(self) -> None:
+        # The directory is used by all the tests of the suite, it is removed by the cleanup after tearDown
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        self.mailbox = FakeMailbox()
+        for sender in ('john@domain.com', 'john@domain.com', 'news@linkedin.com'):
+            self.append(sender)
+        self.imap_server = FakeIMAPServer(self.mailbox)
+        self.smtp_server = FakeSMTPServer()
+        self.imap_server.start()
+        self.smtp_server.start()
+
+    def tearDown(self) -> None:
+        self.imap_server.stop()
+        self.smtp_server.stop()
+
+    def append(self, sender: str) -> None:
+        """
+        Append a message to the mailbox of the fake IMAP server
+        :param sender: the sender of the message
+        """
+        i: int = self.mailbox.uidnext
+        self.mailbox.append(('From: ' + sender + '\r\nTo: me@domain.com\r\nSubject: Hello ' + str(i) + '\r\nMessage-ID: <' + str(i)
+                             + '@domain.com>\r\nContent-Type: text/plain\r\n\r\nHello\r\n').encode())
+
+    def create_replier(self, refresh_delay: int = -1, pipeline: bool = True, login: bool = True, date: datetime.datetime = datetime.datetime(2050, 1, 1)) \
+            -> AutoReplier:
+        """
+        Create a replier connected to the fake servers
+        :param refresh_delay: the check interval in seconds
+        :param pipeline: False to process the messages sequentially
+        :param login: False to skip the login
+        :param date: the expiration date
+        :return: the replier
+        """
+        return AutoReplier(self.create_settings(refresh_delay, pipeline, date), logging.getLogger('test'), login=login)
+
+    def create_settings(self, refresh_delay: int = -1, pipeline: bool = True, date: datetime.datetime = datetime.datetime(2050, 1, 1)) -> AutoReplierSettings:
+        """
+        Create the settings of a replier connected to the fake servers
+        :param refresh_delay: the check interval in seconds
+        :param pipeline: False to process the messages sequentially
+        :param date: the expiration date
+        :return: the settings
+        """
+        settings: AutoReplierSettings = AutoReplierSettings()
+        settings.date = date
+        settings.refresh_delay = refresh_delay
+        settings.pipeline = pipeline
+        settings.imap_server, settings.imap_port = self.imap_server.server_address
+        settings.smtp_server, settings.smtp_port = self.smtp_server.server_address
+        settings.imap_user = settings.smtp_user = 'me@domain.com'
+        settings.imap_password = settings.smtp_password = base64.b64encode(b'secret').decode()
+        settings.smtp_rate = settings.imap_rate = 0
+        settings.db_path = os.path.join(self.directory.name, 'autoreplier.db')
+        settings.skipped_domains = ['linkedin.com']
+        template: ReplyTemplate = ReplyTemplate()
+        template.lang, template.type, template.email, template.body = 'en', ReplyTemplateType.TEXT, None, 'Away'
+        settings.templates.append(template)
+        return settings
+
+    def wait_replies(self, count: int) -> None:
+        """
+        Wait for the replies received by the fake SMTP server
+        :param count: the expected number of replies
+        """
+        deadline: float = time.monotonic() + 10
+        while len(self.smtp_server.received) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(count, len(self.smtp_server.received))
+
     def test_close(self) -> None:
         """
         Test close on AutoReplier
         """
+        replier: AutoReplier = self.create_replier()
+        replier.close()
+        self.assertIn('LOGOUT ', self.imap_server.commands)
 
     def test_start(self) -> None:
         """
         Test start on AutoReplier
         """
+        self.create_replier().start()
+        # A single reply is sent to the sender of the two messages and the skipped domain is ignored
+        self.assertEqual(1, len(self.smtp_server.received))
+        sender, recipients, data, _ = self.smtp_server.received[0]
+        self.assertEqual('<me@domain.com>', sender)
+        self.assertEqual(['<john@domain.com>'], recipients)
+        reply: message.Message = message_from_bytes(data)
+        self.assertEqual('<1@domain.com>', reply['In-Reply-To'])
+        self.assertEqual('Re: Hello 1', reply['Subject'])
+        self.assertIn('LOGOUT ', self.imap_server.commands)
+        # The messages are flagged by a single command at the end of the cycle
+        self.assertEqual([1, 2, 3], self.mailbox.flagged('AUTOREPLIED'))
+        self.assertEqual(['UID STORE 1:3 +FLAGS.SILENT (AUTOREPLIED)'], [v for v in self.imap_server.commands if 'STORE' in v])
+
+    def test_log_summary(self) -> None:
+        """
+        Test the check is summarized by a single record and the records of the messages are not written when the detail ratio is 0
+        """
+        settings: AutoReplierSettings = self.create_settings()
+        settings.log_detail_ratio = 0
+        with self.assertLogs('test', logging.INFO) as logs:
+            AutoReplier(settings, logging.getLogger('test')).start()
+        self.assertEqual(1, len(self.smtp_server.received))
+        self.assertFalse([v for v in logs.output if 'Replied to' in v or 'Incoming message' in v])
+        summaries: list[logging.LogRecord] = [v for v in logs.records if hasattr(v, 'summary')]
+        self.assertEqual(1, len(summaries))
+        self.assertEqual(3, summaries[0].summary[METRIC_SEARCHED])
+        self.assertEqual(1, summaries[0].summary[METRIC_REPLIED])
+        self.assertEqual(2, summaries[0].summary[METRIC_SKIPPED])
+        self.assertEqual(0, summaries[0].summary[METRIC_FAILED])
+
+    def test_create_rotating_log(self) -> None:
+        """
+        Test the records are written by the listener of the queue
+        """
+        path: str = os.path.join(self.directory.name, 'autoreplier.log')
+        logger: logging.Logger = create_rotating_log(path, 'INFO', queued=True)
+        handler: logging.Handler = logger.handlers[-1]
+        try:
+            self.assertIsInstance(handler, QueueHandler)
+            logger.info('Queued record')
+            handler.listener.stop()
+            atexit.unregister(handler.listener.stop)
+        finally:
+            logger.removeHandler(handler)
+        with open(path, encoding='utf-8') as f:
+            self.assertIn('Queued record', f.read())
+
+    def test_reload(self) -> None:
+        """
+        Test the modifications of the configuration file are applied without connecting again
+        """
+        path: str = os.path.join(self.directory.name, 'autoreplier.xml')
+        imap_port: int = self.imap_server.server_address[1]
+        smtp_port: int = self.smtp_server.server_address[1]
+
+        def write(domain: str, body: str) -> None:
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(f"""<?xml version="1.0" encoding="utf-8"?>
+<configuration date="2050-01-01" reload-interval="1">
+    <accounts><account id="id1" user="me@domain.com" password="c2VjcmV0" /></accounts>
+    <imap server="127.0.0.1" port="{imap_port}" account-id="id1" rate="0" />
+    <smtp server="127.0.0.1" port="{smtp_port}" account-id="id1" rate="0" />
+    <skipped><domains><domain>{domain}</domain></domains></skipped>
+    <templates><template lang="en" type="TEXT">{body}</template></templates>
+</configuration>
+""")
+        write('linkedin.com', 'Away')
+        settings: AutoReplierSettings = AutoReplierSettings()
+        settings.db_path = os.path.join(self.directory.name, 'autoreplier.db')
+        settings.parse(path)
+        replier: AutoReplier = AutoReplier(settings, logging.getLogger('test'))
+        try:
+            replier.check()
+            self.assertEqual(1, len(self.smtp_server.received))
+            write('example.org', 'Back soon')
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+            time.sleep(1.1)
+            self.append('jane@domain.com')
+            self.append('bot@example.org')
+            self.append('alerts@linkedin.com')
+            replier.check()
+            self.assertEqual(3, len(self.smtp_server.received))
+            self.assertIn(b'Back soon', self.smtp_server.received[-1][2])
+            self.assertEqual(['<alerts@linkedin.com>'], self.smtp_server.received[-1][1])
+            self.assertEqual(1, len([v for v in self.imap_server.commands if v.startswith('LOGIN')]))
+        finally:
+            replier.close()
+
+    def test_run_once(self) -> None:
+        """
+        Test run_once on AutoReplier, the mailbox is only searched when new messages are reported by the STATUS command
+        """
+        self.assertTrue(self.create_replier(login=False).run_once())
+        self.assertEqual(1, len(self.smtp_server.received))
+        self.imap_server.commands.clear()
+        self.assertTrue(self.create_replier(login=False).run_once())
+        self.assertEqual(['CAPABILITY ', 'LOGIN', 'STATUS', 'LOGOUT'], [v.split(' ')[0] if v != 'CAPABILITY ' else v for v in self.imap_server.commands])
+        self.assertEqual(1, self.smtp_server.connections)
+        self.append('jane@domain.com')
+        self.assertTrue(self.create_replier(login=False).run_once())
+        self.assertEqual(2, len(self.smtp_server.received))
+        self.imap_server.commands.clear()
+        self.assertFalse(self.create_replier(login=False, date=datetime.datetime(2000, 1, 1)).run_once())
+        self.assertEqual([], self.imap_server.commands)
+
+    def test_send_retry(self) -> None:
+        """
+        Test the reply is sent again after a delay when the failure is temporary and is not sent again when the recipient is refused
+        """
+        self.smtp_server.deferred = 1
+        self.smtp_server.refused.add('<jane@domain.com>')
+        self.append('jane@domain.com')
+        start: float = time.monotonic()
+        self.create_replier(pipeline=False).start()
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(['<john@domain.com>'], [v[1][0] for v in self.smtp_server.received])
+        # The connection closed after the temporary failure is opened again, the refusal keeps the connection
+        self.assertEqual(2, self.smtp_server.connections)
+        self.assertEqual([1, 2, 3], self.mailbox.flagged('AUTOREPLIED'))
+
+    def test_pool(self) -> None:
+        """
+        Test start on AutoReplierPool, the mailboxes are logged in by their checks and logged out at the end of each check
+        """
+        mailboxes: list[AutoReplierSettings] = [self.create_settings(), self.create_settings()]
+        mailboxes[0].name, mailboxes[1].name = 'john', 'jane'
+        # The mailboxes use the same fake mailbox, so the second one only finds flagged messages
+        mailboxes[0].workers = 1
+        pool: AutoReplierPool = AutoReplierPool(mailboxes, logging.getLogger('test'))
+        self.assertEqual([], self.imap_server.commands)
+        pool.start()
+        self.assertEqual(1, len(self.smtp_server.received))
+        self.assertEqual([1, 2, 3], self.mailbox.flagged('AUTOREPLIED'))
+        commands: list[str] = [v.split(' ')[0] for v in self.imap_server.commands]
+        self.assertEqual(2, commands.count('LOGIN'))
+        self.assertEqual(2, commands.count('LOGOUT'))
+        # The idle mailboxes are not selected
+        self.imap_server.commands.clear()
+        pool.start()
+        self.assertEqual(['CAPABILITY', 'LOGIN', 'STATUS', 'LOGOUT'] * 2, [v.split(' ')[0] for v in self.imap_server.commands])
+
+    def test_start_sequential(self) -> None:
+        """
+        Test start on AutoReplier without the pipeline, the message whose reply cannot be sent is not flagged and is replied by the next start
+        """
+        self.smtp_server.rejected.add('<jane@domain.com>')
+        self.append('jane@domain.com')
+        self.create_replier(pipeline=False).start()
+        self.assertEqual(1, len(self.smtp_server.received))
+        self.assertEqual([1, 2, 3], self.mailbox.flagged('AUTOREPLIED'))
+        self.assertEqual(['UID STORE 1:3 +FLAGS.SILENT (AUTOREPLIED)'], [v for v in self.imap_server.commands if 'STORE' in v])
+        self.smtp_server.rejected.clear()
+        self.create_replier(pipeline=False).start()
+        self.assertEqual(['<jane@domain.com>'], self.smtp_server.received[-1][1])
+        self.assertEqual([1, 2, 3, 4], self.mailbox.flagged('AUTOREPLIED'))
+
+    def test_retry(self) -> None:
+        """
+        Test the message whose reply cannot be sent is fetched and replied by the next check, even if a later message has been processed
+        """
+        self.smtp_server.rejected.add('<jane@domain.com>')
+        self.append('jane@domain.com')
+        self.append('bob@domain.com')
+        replier: AutoReplier = self.create_replier()
+        try:
+            replier.check()
+            self.assertEqual(['<john@domain.com>', '<bob@domain.com>'], [v[1][0] for v in self.smtp_server.received])
+            self.assertEqual([1, 2, 3, 5], self.mailbox.flagged('AUTOREPLIED'))
+            self.smtp_server.rejected.clear()
+            self.imap_server.commands.clear()
+            replier.check()
+            self.assertTrue([v for v in self.imap_server.commands if v.startswith('UID FETCH 4 ')])
+            self.assertEqual(['<jane@domain.com>'], self.smtp_server.received[-1][1])
+            self.assertEqual([1, 2, 3, 4, 5], self.mailbox.flagged('AUTOREPLIED'))
+        finally:
+            replier.close()
+
+    def test_start_sharded(self) -> None:
+        """
+        Test start on AutoReplier using worker processes, the sender of messages processed by two workers is replied only once
+        """
+        self.append('jane@domain.com')
+        self.append('john@domain.com')
+        settings: AutoReplierSettings = self.create_settings()
+        settings.shards, settings.shard_min_size = 2, 1
+        replier: AutoReplier = AutoReplier(settings, logging.getLogger('test'))
+        replier.start()
+        self.assertEqual(['<jane@domain.com>', '<john@domain.com>'], sorted(v[1][0] for v in self.smtp_server.received))
+        self.assertEqual([1, 2, 3, 4, 5], self.mailbox.flagged('AUTOREPLIED'))
+        self.assertEqual(2, len([v for v in self.imap_server.commands if 'STORE' in v]))
+        metrics: dict = replier.get_metrics()
+        self.assertEqual(2, sum(v['value'] for v in metrics[METRIC_REPLIED]))
+        self.assertEqual(3, sum(v['value'] for v in metrics[METRIC_SKIPPED]))
+
+    def test_lease(self) -> None:
+        """
+        Test the mailbox is only checked by the node holding the lease and is taken by another node when the lease is released
+        or when its holder stops without releasing it
+        """
+        repliers: list[AutoReplier] = []
+        # The first node is the preferred node of the mailbox
+        for node in ('b', 'a', 'c'):
+            settings: AutoReplierSettings = self.create_settings(refresh_delay=6)
+            settings.node, settings.lease_duration, settings.imap_idle = node, 2, False
+            repliers.append(AutoReplier(settings, logging.getLogger('test')))
+        thread: threading.Thread = threading.Thread(target=repliers[0].start)
+        thread.start()
+        self.wait_replies(1)
+        # The lease is renewed while waiting, even if the refresh delay is longer than the lease duration
+        time.sleep(4.5)
+        self.assertTrue(repliers[1].check())
+        self.assertTrue(repliers[2].check())
+        self.assertEqual(1, len(self.smtp_server.received))
+        self.assertEqual(1, len([v for v in self.imap_server.commands if v.startswith('SELECT')]))
+        repliers[0].stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.append('jane@domain.com')
+        time.sleep(1.1)
+        while len(self.smtp_server.received) < 2 and repliers[1].check() and repliers[2].check():
+            time.sleep(0.1)
+        self.assertEqual(['<jane@domain.com>'], self.smtp_server.received[1][1])
+        # The node holding the lease stops without releasing it, the lease expires at most one lease duration after its last renewal
+        # and the other node tries to take it every third of the lease duration
+        holder, other = (repliers[1], repliers[2]) if repliers[1].get_metrics().get(METRIC_REPLIED) else (repliers[2], repliers[1])
+        self.append('jack@domain.com')
+        start: float = time.monotonic()
+        while len(self.smtp_server.received) < 3 and time.monotonic() - start < 10:
+            self.assertTrue(other.check())
+            time.sleep(0.1)
+        self.assertEqual(['<jack@domain.com>'], self.smtp_server.received[2][1])
+        self.assertLess(time.monotonic() - start, 2 * 4 / 3 + 1)
+        holder.close()
+        other.close()
+        # The state written using the token of the first node is ignored
+        store: SenderStore = SenderStore(os.path.join(self.directory.name, 'autoreplier.db'), logging.getLogger('test'))
+        store.open()
+        store.put_sync_state(1, 99, '', 1)
+        store.flush()
+        self.assertEqual((1, 5), store.get_sync_state(''))
+        store.close()
 
     def test_stop(self) -> None:
         """
         Test stop on AutoReplier
         """
+        replier: AutoReplier = self.create_replier(refresh_delay=1)
+        thread: threading.Thread = threading.Thread(target=replier.start)
+        thread.start()
+        self.wait_replies(1)
+        # The message is notified by the IDLE command
+        self.append('jane@domain.com')
+        self.wait_replies(2)
+        replier.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_idle_buffered(self) -> None:
+        """
+        Test a notification sent in the same segment as the continuation of the IDLE command is handled without waiting for the socket
+        """
+        self.imap_server.idle_responses = b'* 3 EXISTS\r\n'
+        replier: AutoReplier = self.create_replier(refresh_delay=1)
+        thread: threading.Thread = threading.Thread(target=replier.start)
+        thread.start()
+        deadline: float = time.monotonic() + 2
+        while len([v for v in self.imap_server.commands if v.startswith('UID SEARCH')]) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        replier.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        # The notification triggers a second check
+        self.assertEqual(2, len([v for v in self.imap_server.commands if v.startswith('UID SEARCH')]))
+
+    def test_reconnect(self) -> None:
+        """
+        Test the mailbox stays selected between the checks and the connection is opened again when the server drops it during IDLE,
+        the SMTP connection is kept
+        """
+        replier: AutoReplier = self.create_replier(refresh_delay=1)
+        thread: threading.Thread = threading.Thread(target=replier.start)
+        thread.start()
+        self.wait_replies(1)
+        self.append('jane@domain.com')
+        self.wait_replies(2)
+        self.assertEqual(1, len([v for v in self.imap_server.commands if v.startswith('SELECT')]))
+        self.imap_server.disconnect()
+        self.append('jack@domain.com')
+        self.wait_replies(3)
+        metrics: dict = replier.get_metrics()
+        replier.stop()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(2, len([v for v in self.imap_server.commands if v.startswith('LOGIN')]))
+        self.assertEqual(1, sum(v['value'] for v in metrics[METRIC_RECONNECTIONS]))
+        self.assertEqual(1, self.smtp_server.connections)
+
+    def test_reconnect_on_store(self) -> None:
+        """
+        Test the messages are flagged after a new login when the connection is lost during the UID STORE command
+        """
+        self.imap_server.disconnect_on = 'UID STORE'
+        self.create_replier().start()
+        self.assertEqual(1, len(self.smtp_server.received))
+        self.assertEqual(2, len([v for v in self.imap_server.commands if v.startswith('LOGIN')]))
+        self.assertEqual([1, 2, 3], self.mailbox.flagged('AUTOREPLIED'))
 
     def test_is_running(self) -> None:
         """
         Test is_running on AutoReplier
         """
+        replier: AutoReplier = self.create_replier(refresh_delay=1)
+        self.assertFalse(replier.is_running())
+        thread: threading.Thread = threading.Thread(target=replier.start)
+        thread.start()
+        self.wait_replies(1)
+        self.assertTrue(replier.is_running())
+        replier.stop()
+        thread.join(10)
+        self.assertFalse(replier.is_running())
+
+    # noinspection PyProtectedMember
+    def test_replay(self) -> None:
+        """
+        Test the replay of a mbox file and of a Maildir directory without connection to the servers
+        """
+        messages: list[bytes] = [data for _, data, _ in self.mailbox.messages.values()]
+        box: mailbox.mbox = mailbox.mbox(os.path.join(self.directory.name, 'mbox'))
+        maildir: mailbox.Maildir = mailbox.Maildir(os.path.join(self.directory.name, 'maildir'))
+        for data in messages:
+            box.add(data)
+            maildir.add(data)
+        box.close()
+        report_path: str = os.path.join(self.directory.name, 'report.jsonl')
+        # The language of a replied message is detected once for the report and the rendering
+        with mock.patch.object(LanguageDetector, 'detect', autospec=True, side_effect=LanguageDetector.detect) as detect:
+            result: dict = self.create_replier(login=False).replay(os.path.join(self.directory.name, 'mbox'), report_path)
+        self.assertEqual(1, detect.call_count)
+        self.assertEqual({'messages': 3, 'replied': 1, 'skipped': 2, 'failed': 0}, {k: result[k] for k in ('messages', 'replied', 'skipped', 'failed')})
+        self.assertGreater(result['messages_per_second'], 0)
+        with open(report_path, encoding='utf-8') as f:
+            decisions: list[dict] = [json.loads(v) for v in f]
+        self.assertEqual(['replied', 'skipped', 'skipped'], [v['decision'] for v in decisions])
+        self.assertEqual(['block', 'domain'], [v['reason'] for v in decisions[1:]])
+        self.assertEqual('<1@domain.com>', decisions[0]['message_id'])
+        self.assertEqual('en', decisions[0]['language'])
+        result = self.create_replier(login=False).replay(os.path.join(self.directory.name, 'maildir'))
+        self.assertEqual(1, result['replied'])
+        self.assertEqual([], self.imap_server.commands)
+        self.assertEqual(0, self.smtp_server.connections)
+
+    def test_render_auto_reply(self) -> None:
+        """
+        Test the prepared replies are equivalent to the replies built for each message
+        """
+        settings: AutoReplierSettings = AutoReplierSettings()
+        settings.date = datetime.datetime(2050, 1, 1)
+        for lang, template_type, email, body in (('en', ReplyTemplateType.TEXT, None, 'Away'), ('fr', ReplyTemplateType.TEXT, None, 'Absent'),
+                                                 ('fr', ReplyTemplateType.HTML, 'john@domain.com', '<p>Absent</p>')):
+            template: ReplyTemplate = ReplyTemplate()
+            template.lang, template.type, template.email, template.body = lang, template_type, email, body
+            settings.templates.append(template)
+        replier: AutoReplier = AutoReplier(settings, logging.getLogger('test'), login=False)
+        for recipient, lang in (('John <john@domain.com>', 'fr'), ('john@domain.com', 'de'), ('jane@domain.com', 'fr')):
+            original: message.Message = message_from_bytes(('From: a@b.org\r\nTo: ' + recipient + '\r\nSubject: Hello\r\nMessage-ID: <1@b.org>\r\n'
+                                                             + 'Content-Language: ' + lang + '\r\n\r\n').encode())
+            built: message.Message = replier._create_auto_reply(original)
+            rendered: bytes = replier._render_auto_reply(original)
+            if built is None:
+                self.assertIsNone(rendered)
+                continue
+            reply: message.Message = message_from_bytes(rendered)
+            for name in ('From', 'To', 'Subject', 'In-Reply-To', 'References', 'Content-Language'):
+                self.assertEqual(built.get_all(name), reply.get_all(name))
+            self.assertEqual([v.get_payload() for v in built.get_payload()], [v.get_payload() for v in reply.get_payload()])
+
+
+class CustomAutoReplierTest(unittest.TestCase):
+    """
+    Test suite for the script custom_autoreplier.py
+    """
+    def setUp(self) -> None:
+        # The directory is used by all the tests of the suite, it is removed by the cleanup after tearDown
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        self.mailbox = FakeMailbox()
+        self.mailbox.append(b'From: john@domain.com\r\nTo: me@domain.com\r\nSubject: Hello\r\nMessage-ID: <1@domain.com>\r\n\r\nHello\r\n')
+        self.imap_server = FakeIMAPServer(self.mailbox)
+        self.smtp_server = FakeSMTPServer()
+        self.imap_server.start()
+        self.smtp_server.start()
+        self.addCleanup(self.imap_server.stop)
+        self.addCleanup(self.smtp_server.stop)
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'custom_autoreplier.py')
+        self.path = os.path.join(self.directory.name, 'autoreplier.xml')
+        with open(self.path, 'w', encoding='utf-8') as file:
+            file.write(f"""<?xml version="1.0" encoding="utf-8"?>
+<configuration date="2050-01-01" refresh-delay="1" lease-duration="3">
+    <accounts><account id="id1" user="me@domain.com" password="c2VjcmV0" /></accounts>
+    <imap server="127.0.0.1" port="{self.imap_server.server_address[1]}" account-id="id1" rate="0" />
+    <smtp server="127.0.0.1" port="{self.smtp_server.server_address[1]}" account-id="id1" rate="0" />
+    <templates><template lang="en" type="TEXT">Away</template></templates>
+</configuration>
+""")
+
+    @unittest.skipUnless(importlib.util.find_spec('filelock'), 'filelock is required by custom_autoreplier.py')
+    def test_nodes(self) -> None:
+        """
+        Test two nodes started by custom_autoreplier.py on the same host with the same configuration and database, both nodes join the leases
+        """
+        # pylint: disable=consider-using-with
+        processes: list[subprocess.Popen] = [subprocess.Popen([sys.executable, self.script, '-f', self.path, '-l', 'INFO', '--node', v],
+                                                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for v in ('a', 'b')]
+        # pylint: enable=consider-using-with
+        try:
+            nodes: list[tuple[str]] = []
+            deadline: float = time.monotonic() + 20
+            while nodes != [('a',), ('b',)] and time.monotonic() < deadline:
+                time.sleep(0.1)
+                con: sqlite3.Connection = sqlite3.connect(os.path.join(self.directory.name, 'autoreplier.db'))
+                try:
+                    nodes = con.execute('SELECT node FROM nodes ORDER BY node').fetchall()
+                except sqlite3.OperationalError:
+                    # The database is not yet created
+                    nodes = []
+                finally:
+                    con.close()
+            self.assertEqual([('a',), ('b',)], nodes)
+            while not self.smtp_server.received and time.monotonic() < deadline:
+                time.sleep(0.1)
+            self.assertEqual(1, len(self.smtp_server.received))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(10)
+
+    @unittest.skipUnless(importlib.util.find_spec('filelock'), 'filelock is required by custom_autoreplier.py')
+    def test_replay(self) -> None:
+        """
+        Test the replay by custom_autoreplier.py logs to the standard error and keeps the log file of the replier
+        """
+        box: mailbox.mbox = mailbox.mbox(os.path.join(self.directory.name, 'mbox'))
+        for _, data, _ in self.mailbox.messages.values():
+            box.add(data)
+        box.close()
+        log_path: str = os.path.join(self.directory.name, 'autoreplier.log')
+        with open(log_path, 'w', encoding='utf-8') as file:
+            file.write('Previous record\n')
+        result: subprocess.CompletedProcess = subprocess.run([sys.executable, self.script, '-f', self.path, '-l', 'INFO', '--replay',
+                                                              os.path.join(self.directory.name, 'mbox')], capture_output=True, check=True, timeout=30)
+        self.assertEqual(1, json.loads(result.stdout)['replied'])
+        self.assertIn(b'INFO', result.stderr)
+        with open(log_path, encoding='utf-8') as file:
+            self.assertEqual('Previous record\n', file.read())
+        self.assertEqual([], self.imap_server.commands)
+
+
+CONFIGURATION: str = """<?xml version="1.0" encoding="utf-8"?>
+<configuration block-hours="12" refresh-delay="300" date="2050-01-01">
+    <accounts>
+        <account id="id1" user="john@domain.com" password="c2VjcmV0" />
+        <account id="id2" user="jane@domain.com" password="c2VjcmV0" />
+    </accounts>
+    <mailboxes>
+        <mailbox name="john">
+            <imap server="imap.domain.com" port="993" ssl="True" account-id="id1" />
+            <smtp server="smtp.domain.com" port="465" ssl="True" account-id="id1" />
+            <skipped><domains><domain>john.org</domain></domains></skipped>
+        </mailbox>
+        <mailbox name="jane" date="2050-02-01">
+            <imap server="imap.domain.com" port="993" ssl="True" account-id="id2" timeout="30" reconnect-max-delay="60" />
+            <smtp server="smtp.domain.com" port="465" ssl="True" account-id="id2" timeout="20" />
+            <templates><template lang="fr" type="TEXT">Absente</template></templates>
+        </mailbox>
+    </mailboxes>
+    <skipped><domains><domain>linkedin.com</domain></domains></skipped>
+    <templates><template lang="en" type="TEXT">Away</template></templates>
+</configuration>
+"""
+
+
+class AutoReplierSettingsTest(unittest.TestCase):
+    """
+    Test suite for class AutoReplierSettings
+    """
+    def test_parse_all(self) -> None:
+        """
+        Test parse_all on a configuration describing several mailboxes
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path: str = os.path.join(directory, 'autoreplier.xml')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(CONFIGURATION)
+            settings: AutoReplierSettings = AutoReplierSettings()
+            settings.db_path = os.path.join(directory, 'autoreplier.db')
+            result: list[AutoReplierSettings] = settings.parse_all(path)
+            # The date is required on the configuration or on each mailbox
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(CONFIGURATION.replace(' date="2050-01-01"', ''))
+            with self.assertRaisesRegex(IOError, 'mailbox john'):
+                AutoReplierSettings().parse_all(path)
+        self.assertEqual(['john', 'jane'], [v.name for v in result])
+        self.assertEqual(['john@domain.com', 'jane@domain.com'], [v.imap_user for v in result])
+        self.assertEqual(['linkedin.com', 'john.org'], result[0].skipped_domains)
+        self.assertEqual(['linkedin.com'], result[1].skipped_domains)
+        self.assertEqual(['Away'], [v.body for v in result[0].templates])
+        self.assertEqual(['Absente'], [v.body for v in result[1].templates])
+        self.assertEqual(datetime.datetime(2050, 1, 1), result[0].date)
+        self.assertEqual(datetime.datetime(2050, 2, 1), result[1].date)
+        self.assertEqual(settings.db_path, result[1].db_path)
+        self.assertEqual([60.0, 30.0], [v.imap_timeout for v in result])
+        self.assertEqual([300.0, 60.0], [v.imap_reconnect_max_delay for v in result])
+        self.assertEqual([60.0, 20.0], [v.smtp_timeout for v in result])
+
+
+class ReconnectTest(unittest.TestCase):
+    """
+    Test suite for the functions used to open the connections again
+    """
+    def test_is_transient_error(self) -> None:
+        """
+        Test is_transient_error
+        """
+        for ex in (IMAP4.abort('socket error: EOF'), TimeoutError(), ConnectionResetError(), SMTPServerDisconnected(), SMTPResponseException(421, b'Busy'),
+                   SMTPRecipientsRefused({'a@b.org': (450, b'Greylisted')})):
+            self.assertTrue(is_transient_error(ex), repr(ex))
+        for ex in (IMAP4.error('LOGIN failed'), SMTPAuthenticationError(535, b'Denied'), SMTPRecipientsRefused({'a@b.org': (550, b'Unknown')}), FileNotFoundError(),
+                   ValueError()):
+            self.assertFalse(is_transient_error(ex), repr(ex))
+
+    def test_get_backoff_delay(self) -> None:
+        """
+        Test get_backoff_delay
+        """
+        for attempt, expected in ((0, 1.0), (3, 8.0), (20, 300.0)):
+            delay: float = get_backoff_delay(attempt)
+            self.assertTrue(expected / 2 <= delay <= expected, str(delay))
+
+
+class FetchTest(unittest.TestCase):
+    """
+    Test suite for the functions used to fetch messages
+    """
+    def test_compress_uid_set(self) -> None:
+        """
+        Test compress_uid_set
+        """
+        self.assertEqual('1:3,5,7,9:10', compress_uid_set([5, 1, 2, 3, 7, 9, 10, 3]))
+        self.assertEqual('', compress_uid_set([]))
+
+    def test_iter_fetch_response(self) -> None:
+        """
+        Test iter_fetch_response
+        """
+        data = [(b'1 (UID 5 FLAGS (\\Seen) RFC822 {3}', b'abc'), b')', b'2 (UID 6 FLAGS ())',
+                (b'3 (UID 8 BODY[HEADER.FIELDS (FROM)] {2}', b'hh'), (b' BODY[TEXT]<0> {2}', b'bb'), b' FLAGS (\\Flagged))']
+        result = list(iter_fetch_response(data))
+        self.assertEqual(3, len(result))
+        self.assertEqual((5, ['\\Seen'], {'RFC822': b'abc'}), result[0])
+        self.assertEqual((6, [], {}), result[1])
+        self.assertEqual(8, result[2][0])
+        self.assertEqual(['\\Flagged'], result[2][1])
+        self.assertEqual(b'bb', result[2][2]['BODY[TEXT]<0>'])
+
+    def test_parse_message(self) -> None:
+        """
+        Test parse_message stops after the first text part and keeps the size of the parsed bytes below the maximum
+        """
+        attachment: bytes = base64.encodebytes(os.urandom(1024 * 1024))
+        data: bytes = (b'From: john@domain.com\r\nContent-Type: multipart/mixed; boundary="b"\r\n\r\n--b\r\nContent-Type: application/pdf\r\n'
+                       + b'Content-Transfer-Encoding: base64\r\n\r\n' + attachment + b'\r\n--b\r\nContent-Type: text/plain\r\n\r\nHello world\r\n--b\r\n'
+                       + b'Content-Type: image/png\r\nContent-Transfer-Encoding: base64\r\n\r\n' + attachment + b'\r\n--b--\r\n')
+        end: int = data.index(b'Hello world') + 18
+        chunks: Iterator[bytes] = iter([data[:end], data[end:]])
+        value: message.Message = parse_message(chunks, len(data))
+        self.assertEqual(data[end:], next(chunks))
+        self.assertEqual('john@domain.com', value['From'])
+        self.assertEqual('Hello world', get_message_text(value))
+        self.assertEqual('text/plain', value.get_payload()[1].get_content_type())
+        self.assertEqual('', value.get_payload()[0].get_payload())
+        value = parse_message([data[:200], data[200:]], 300)
+        self.assertEqual('', get_message_text(value))
+        self.assertLessEqual(len(value.get_payload()[0].get_payload()), 300)
+
+
+class SenderStoreTest(unittest.TestCase):
+    """
+    Test suite for class SenderStore
+    """
+    def setUp(self) -> None:
+        # The directory is used by all the tests of the suite, it is removed by the cleanup after tearDown
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'autoreplier.db')
+
+    def test_migrate(self) -> None:
+        """
+        Test the migration of a database using dates as text
+        """
+        con: sqlite3.Connection = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES)
+        con.execute('CREATE TABLE IF NOT EXISTS senders (id INTEGER PRIMARY KEY, mail text, date datetime)')
+        now: datetime.datetime = datetime.datetime.now().replace(microsecond=0)
+        con.execute('INSERT INTO senders (mail, date) VALUES (?, ?)', ('a@b.org', now - datetime.timedelta(hours=1)))
+        con.execute('INSERT INTO senders (mail, date) VALUES (?, ?)', ('a@b.org', now))
+        con.execute('INSERT INTO senders (mail, date) VALUES (?, ?)', ('c@b.org', now))
+        con.commit()
+        con.close()
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        try:
+            self.assertEqual(2, store.count())
+            self.assertEqual(int(now.timestamp()), store.get('a@b.org'))
+        finally:
+            store.close()
+
+    def test_put(self) -> None:
+        """
+        Test put and get on SenderStore
+        """
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        try:
+            self.assertIsNone(store.get('a@b.org'))
+            store.put('a@b.org', 10)
+            now: int = int(time.time())
+            store.put('a@b.org', now)
+            self.assertEqual(now, store.get('a@b.org'))
+            self.assertEqual(1, store.count())
+        finally:
+            store.close()
+
+    def test_remove(self) -> None:
+        """
+        Test remove on SenderStore, the pending and the written dates are removed
+        """
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        try:
+            store.put('a@b.org', 10)
+            store.put('c@b.org', 10)
+            store.flush()
+            store.put('a@b.org', 20)
+            store.remove('a@b.org')
+            self.assertIsNone(store.get('a@b.org'))
+            self.assertEqual(1, store.count())
+        finally:
+            store.close()
+
+    def test_flush(self) -> None:
+        """
+        Test the pending dates are written on close
+        """
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        store.put('a@b.org', 10)
+        store.close()
+        con: sqlite3.Connection = sqlite3.connect(self.path)
+        try:
+            self.assertEqual([('a@b.org', 10)], con.execute('SELECT mail, date FROM senders').fetchall())
+        finally:
+            con.close()
+
+    def test_purge(self) -> None:
+        """
+        Test the expired addresses are deleted and the free pages are released
+        """
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        try:
+            now: int = int(time.time())
+            for i in range(3000):
+                store.put('user' + str(i) + '@b.org', 10 if i < 2000 else now)
+            store.put('user0@b.org', 10, 'john')
+            self.assertEqual(3001, store.count())
+            size: int = store.get_size()
+            self.assertEqual(2000, store.purge(now - 3600))
+            self.assertEqual(1001, store.count())
+            self.assertEqual(10, store.get('user0@b.org', 'john'))
+            self.assertGreater(store.compact(), 0)
+            self.assertLess(store.get_size(), size)
+        finally:
+            store.close()
+
+    def test_sync_state(self) -> None:
+        """
+        Test the synchronization state of the mailboxes is written with the dates
+        """
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        self.assertIsNone(store.get_sync_state('john'))
+        store.put_sync_state(7, 120, 'john')
+        self.assertEqual((7, 120), store.get_sync_state('john'))
+        store.close()
+        store.open()
+        try:
+            self.assertEqual((7, 120), store.get_sync_state('john'))
+            self.assertIsNone(store.get_sync_state('jane'))
+        finally:
+            store.close()
+
+    def test_acquire_lease(self) -> None:
+        """
+        Test the lease is renewed by its holder and taken by another node only when expired
+        """
+        store: SenderStore = SenderStore(self.path, logging.getLogger('test'))
+        store.open()
+        try:
+            self.assertEqual(1, store.acquire_lease('john', 'a', 1000, 60, 1000))
+            self.assertIsNone(store.acquire_lease('john', 'b', 1030, 60, 1030))
+            self.assertEqual(1, store.acquire_lease('john', 'a', 1030, 60, 1030))
+            self.assertIsNone(store.acquire_lease('john', 'b', 1100, 60, 1100 - 60))
+            self.assertEqual(2, store.acquire_lease('john', 'b', 1100, 60, 1100))
+            store.release_lease('john', 'a', 1)
+            self.assertIsNone(store.acquire_lease('john', 'a', 1110, 60, 1110))
+            store.release_lease('john', 'b', 2)
+            self.assertEqual(3, store.acquire_lease('john', 'a', 1110, 60, 1110 - 60))
+            # The expired lease of a node which is not alive is taken without waiting for one more lease duration
+            self.assertEqual(1, store.acquire_lease('jane', 'a', 1000, 60, 1000))
+            self.assertIsNone(store.acquire_lease('jane', 'b', 1030, 60, 1030 - 60, nodes=['b']))
+            self.assertIsNone(store.acquire_lease('jane', 'b', 1060, 60, 1060 - 60, nodes=['a', 'b']))
+            self.assertEqual(2, store.acquire_lease('jane', 'b', 1060, 60, 1060 - 60, nodes=['b']))
+            store.heartbeat('a', 1000)
+            store.heartbeat('b', 1100)
+            self.assertEqual(['b'], store.get_nodes(1050))
+        finally:
+            store.close()
+
+
+class MetricsTest(unittest.TestCase):
+    """
+    Test suite for class Metrics
+    """
+    def test_snapshot(self) -> None:
+        """
+        Test the values of the counters, gauges and histograms
+        """
+        metrics: Metrics = Metrics()
+        metrics.inc('skipped', reason='domain')
+        metrics.inc('skipped', 2, reason='domain')
+        metrics.set('backlog', 5)
+        metrics.add('backlog', -1)
+        metrics.observe('duration', 0.002)
+        metrics.observe('duration', 20)
+        snapshot: dict = metrics.snapshot()
+        self.assertEqual([{'labels': {'reason': 'domain'}, 'value': 3}], snapshot['skipped'])
+        self.assertEqual(4, snapshot['backlog'][0]['value'])
+        self.assertEqual(2, snapshot['duration'][0]['count'])
+        self.assertEqual(0, snapshot['duration'][0]['buckets']['0.001'])
+        self.assertEqual(1, snapshot['duration'][0]['buckets']['10.0'])
+        metrics.inc('skipped', reason='block')
+        self.assertEqual(4, metrics.get('skipped'))
+        self.assertEqual(1, metrics.get('skipped', reason='block'))
+        self.assertEqual(0, metrics.get('replied'))
+
+    def test_to_prometheus(self) -> None:
+        """
+        Test the Prometheus text format
+        """
+        metrics: Metrics = Metrics()
+        metrics.inc('autoreplier_messages_replied_total', mailbox='a"b')
+        metrics.observe('autoreplier_stage_seconds', 0.5, stage='send')
+        text: str = metrics.to_prometheus()
+        self.assertIn('# TYPE autoreplier_messages_replied_total counter\n', text)
+        self.assertIn('autoreplier_messages_replied_total{mailbox="a\\"b"} 1.0\n', text)
+        self.assertIn('autoreplier_stage_seconds_bucket{stage="send",le="0.25"} 0\n', text)
+        self.assertIn('autoreplier_stage_seconds_bucket{stage="send",le="+Inf"} 1\n', text)
+        self.assertIn('autoreplier_stage_seconds_count{stage="send"} 1\n', text)
+
+
+class TTLCacheTest(unittest.TestCase):
+    """
+    Test suite for class TTLCache
+    """
+    def test_eviction(self) -> None:
+        """
+        Test the least recently used entries are evicted
+        """
+        cache: TTLCache = TTLCache(2, 60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+
+    def test_expiration(self) -> None:
+        """
+        Test the expired entries are not returned
+        """
+        cache: TTLCache = TTLCache(2, -1)
+        cache.put('a', 1)
+        self.assertEqual('x', cache.get('a', 'x'))
+
+
+class SkipRulesTest(unittest.TestCase):
+    """
+    Test suite for class SkipRules
+    """
+    def setUp(self) -> None:
+        self.rules = SkipRules(['jenkins.*', 'alert@.*', 'john@doe.org', 'noreply@', '(bad'], ['linkedin.com', '*.example.org', r'mail\d+\.net'],
+                               ['Jenkins build is.*', 'Hello', 'Out of office'], logging.getLogger('test'))
+
+    def test_address(self) -> None:
+        """
+        Test the rules using addresses
+        """
+        self.assertEqual((SkipRules.ADDRESS, 'john@doe.org'), self.rules.match('John@doe.org', 'doe.org', ''))
+        self.assertEqual((SkipRules.ADDRESS, 'alert@.*'), self.rules.match('alert@x.org', 'x.org', ''))
+        self.assertEqual((SkipRules.ADDRESS, 'noreply@'), self.rules.match('noreply@x.com', 'x.com', ''))
+        self.assertEqual((SkipRules.ADDRESS, '(bad'), self.rules.match('(bad', '', ''))
+        self.assertIsNone(self.rules.match('bob@x.org', 'x.org', ''))
+
+    def test_domain(self) -> None:
+        """
+        Test the rules using domains
+        """
+        self.assertEqual((SkipRules.DOMAIN, 'linkedin.com'), self.rules.match('a@linkedin.com', 'linkedin.com', ''))
+        self.assertEqual((SkipRules.DOMAIN, 'linkedin.com'), self.rules.match('a@linkedin.com.au', 'linkedin.com.au', ''))
+        self.assertIsNone(self.rules.match('a@www.linkedin.com', 'www.linkedin.com', ''))
+        self.assertEqual((SkipRules.DOMAIN, '*.example.org'), self.rules.match('a@a.b.example.org', 'a.b.example.org', ''))
+        self.assertIsNone(self.rules.match('a@example.org', 'example.org', ''))
+        self.assertEqual((SkipRules.DOMAIN, r'mail\d+\.net'), self.rules.match('a@mail12.net', 'mail12.net', ''))
+
+    def test_subject(self) -> None:
+        """
+        Test the rules using subjects
+        """
+        self.assertEqual((SkipRules.SUBJECT, 'Jenkins build is.*'), self.rules.match('a@x.org', 'x.org', 'Jenkins build is back'))
+        self.assertEqual((SkipRules.SUBJECT, 'Hello'), self.rules.match('a@x.org', 'x.org', 'Hello'))
+        self.assertEqual((SkipRules.SUBJECT, 'Hello'), self.rules.match('a@x.org', 'x.org', 'Hello world'))
+        self.assertEqual((SkipRules.SUBJECT, 'Out of office'), self.rules.match('a@x.org', 'x.org', 'Out of office: back Monday'))
+        self.assertIsNone(self.rules.match('a@x.org', 'x.org', 'Re: Hello'))
+
+
+class TokenBucketTest(unittest.TestCase):
+    """
+    Test suite for class TokenBucket
+    """
+    def test_reserve(self) -> None:
+        """
+        Test the delay is only required when the burst is exceeded
+        """
+        bucket: TokenBucket = TokenBucket('test', 1, 2, logging.getLogger('test'))
+        self.assertEqual(0, bucket.reserve())
+        self.assertEqual(0, bucket.reserve())
+        self.assertAlmostEqual(1, bucket.reserve(), delta=0.1)
+
+    def test_throttle(self) -> None:
+        """
+        Test the rate is reduced after a throttling and restored after successful operations
+        """
+        bucket: TokenBucket = TokenBucket('test', 10, 1, logging.getLogger('test'))
+        bucket.reserve()
+        bucket.throttle()
+        self.assertAlmostEqual(0.2, bucket.reserve(), delta=0.05)
+        for _ in range(10):
+            bucket.succeed()
+        self.assertIn('rate: 10/s', str(bucket))
+
+    def test_unlimited(self) -> None:
+        """
+        Test no delay is required without rate
+        """
+        bucket: TokenBucket = TokenBucket('test', 0, 1, logging.getLogger('test'))
+        for _ in range(10):
+            self.assertEqual(0, bucket.reserve())
+
+
+class LanguageDetectorTest(unittest.TestCase):
+    """
+    Test suite for class LanguageDetector
+    """
+    def test_detect(self) -> None:
+        """
+        Test the detection among the configured languages
+        """
+        detector: LanguageDetector = LanguageDetector(['en', 'FR', 'de', 'xx'])
+        self.assertEqual(['de', 'en', 'fr'], detector.languages)
+        self.assertEqual('fr', detector.detect('Votre commande a été expédiée et devrait arriver sous trois jours ouvrés.'))
+        self.assertEqual('de', detector.detect('Ihre Bestellung wurde versandt und sollte innerhalb von drei Werktagen ankommen.'))
+        self.assertEqual('en', detector.detect('Your order has shipped and should arrive within three business days.'))
+        self.assertIsNone(detector.detect('12345'))
+        self.assertIsNone(LanguageDetector(['en']).detect('Votre commande a été expédiée.'))
+
+    def test_get_message_text(self) -> None:
+        """
+        Test the text of a message truncated in the middle of a base64 content
+        """
+        data: bytes = base64.encodebytes('Bonjour à tous, '.encode() * 20)[:101]
+        value: message.Message = message_from_bytes(b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: base64\r\n\r\n' + data)
+        self.assertTrue(get_message_text(value).startswith('Bonjour à tous, Bonjour'))
+        value = message_from_bytes(b'Content-Type: text/html\r\n\r\n<p>Hello &amp; welcome</p>')
+        self.assertEqual('Hello & welcome', get_message_text(value))
 
 
 if __name__ == '__main__':
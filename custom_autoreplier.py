@@ -4,16 +4,25 @@
 Customization and initialization of auto-replier
 """
 import argparse
+import json
 import os
 import pathlib
+import socket
 import sys
+import tempfile
 import traceback
+import zlib
 from filelock import FileLock
-from autoreplier import AutoReplier, AutoReplierSettings, create_rotating_log
+from autoreplier import AutoReplier, AutoReplierPool, AutoReplierSettings, create_console_log, create_rotating_log
 
 parser = argparse.ArgumentParser(prog='Autoreplier', description='Tool used to reply to incoming messages')
 parser.add_argument('-l', help='Log level', default='DEBUG')
 parser.add_argument('-f', required=True, help='Configuration file')
+parser.add_argument('--node', help='Name of the node used by the leases of the mailboxes, the host name by default')
+parser.add_argument('--once', action='store_true', help='Check the mailboxes one time and exit, for a periodic invocation like a cron task')
+parser.add_argument('--replay', help='Take the decisions for the messages of a mbox file or a Maildir directory without connection to the servers and exit')
+parser.add_argument('--report', help='File receiving the decision of each replayed message as a JSON object by line')
+parser.add_argument('--mailbox', help='Name of the mailbox whose settings are used by the replay, the first mailbox by default')
 args = parser.parse_args()
 
 LOG_LEVEL: str = args.l
@@ -33,13 +42,32 @@ LOCK_PATH: str = os.path.abspath(os.path.dirname(CONFIG_PATH)) + os.sep + '.auto
 settings: AutoReplierSettings = AutoReplierSettings()
 settings.log_path = LOG_PATH
 settings.log_level = LOG_LEVEL
+settings.node = args.node
 settings.db_path = os.path.splitext(CONFIG_PATH)[0] + '.db'
-settings.parse(os.path.abspath(CONFIG_PATH))
+mailboxes: list[AutoReplierSettings] = settings.parse_all(os.path.abspath(CONFIG_PATH))
+if any(v.lease_duration > 0 for v in mailboxes):
+    # The nodes share the directory of the configuration and of the database, the lock only prevents a second process on the same node
+    LOCK_PATH = (tempfile.gettempdir() + os.sep + '.autoreplier-' + (args.node or socket.gethostname()) + '-'
+                 + format(zlib.crc32(os.path.abspath(CONFIG_PATH).encode('utf-8')), '08x') + '.lck')
 
-if __name__ == '__main__':
+if __name__ == '__main__' and args.replay:
+    replayed: list[AutoReplierSettings] = [v for v in mailboxes if not args.mailbox or v.name == args.mailbox]
+    if not replayed:
+        sys.exit('Mailbox not found in the configuration: ' + args.mailbox)
+    # The replay may run beside the replier, so it logs to the standard error and keeps the log file of the replier
+    print(json.dumps(AutoReplier(replayed[0], create_console_log(settings.log_level), login=False).replay(args.replay, args.report), indent=2))
+elif __name__ == '__main__':
     with FileLock(LOCK_PATH):
         try:
-            AutoReplier(settings, create_rotating_log(settings.log_path, settings.log_level)).start()
+            logger = create_rotating_log(settings.log_path, settings.log_level, mailboxes[0].log_queued)
+            if args.once and len(mailboxes) > 1:
+                AutoReplierPool(mailboxes, logger).run_once()
+            elif args.once:
+                AutoReplier(mailboxes[0], logger, login=False).run_once()
+            elif len(mailboxes) > 1:
+                AutoReplierPool(mailboxes, logger).start()
+            else:
+                AutoReplier(mailboxes[0], logger).start()
         except KeyboardInterrupt:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             traceback.print_tb(exc_traceback, limit=6, file=sys.stderr)